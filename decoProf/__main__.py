@@ -0,0 +1,5 @@
+from decoProf.decoProf import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import os
+import sys
+import ast
+import json
+import errno
+import tempfile
+import subprocess
+
+from decoProf.io_manager import IOManager
+from decoProf.core import Core
+from decoProf.import_hook import ImportHook
+from decoProf.call_graph import module_name
+from decoProf.name_index import QualifiedNameIndex
+
+
+class AutoProfiler:
+    def __init__(self, io_man=None):
+        """
+        :_io_man: Object of the IO manager
+        :_core: Object of the Core, used to look up the profiler types
+        :_hook: Object of the import hook running the second pass
+        """
+        self._io_man = io_man if io_man is not None else IOManager(debug=False)
+        self._core = Core(self._io_man)
+        self._hook = ImportHook()
+
+    def sample_script(self, args):
+        """
+        First pass: run the script in a child process under the stack sampler
+        :param args: Object of parsed arguments
+        :return: List of (file name, first line, function name, self time, total time) tuples
+        """
+        handle, output_file_name = tempfile.mkstemp(prefix='decoProf_auto_', suffix='.json')
+        os.close(handle)
+        # The child imports decoProf from this installation
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_dir, env.get('PYTHONPATH')]))
+        try:
+            process = subprocess.run([sys.executable, '-m', 'decoProf.auto', output_file_name,
+                                      str(args.sampling_frequency), args.sampling_clock, args.script]
+                                     + list(args.script_args), env=env)
+            with open(output_file_name) as file:
+                content = file.read()
+        finally:
+            os.remove(output_file_name)
+
+        if not content:
+            self._io_man.print_err_info('The sampling pass failed (exit code %d)'
+                                        % process.returncode)
+            exit(errno.EFAULT)
+        if process.returncode != 0:
+            self._io_man.print_err_info('The script exited with code %d in the sampling pass'
+                                        % process.returncode)
+        return [tuple(function) for function in json.loads(content)]
+
+    def qualified_names(self, file_name, project_dir, script):
+        """
+        Map the definitions of a project file to the names accepted by the "run" command
+        :param file_name: Path to the source file
+        :param project_dir: Project folder, the module names are relative to it
+        :param script: Path to the script, its functions belong to "__main__"
+        :return: Dictionary {line number: fully qualified name}. Both the line of "def"
+                 and of the first decorator are keys, the code objects use the latter
+        """
+        if os.path.abspath(file_name) == os.path.abspath(script):
+            prefix = '__main__.'
+        else:
+            prefix = module_name(os.path.relpath(file_name, project_dir)) + '.'
+        try:
+            with open(file_name, 'rb') as file:
+                index = QualifiedNameIndex(ast.parse(file.read(), file_name))
+        except (OSError, SyntaxError, ValueError):
+            return {}
+
+        names = {}
+        for name, node in index.functions():
+            for line_no in [node.lineno] + [decorator.lineno for decorator in node.decorator_list]:
+                names[line_no] = prefix + name
+        return names
+
+    def rank_functions(self, functions, project_dir, script, rank_by):
+        """
+        Keep the functions of the project which can be decorated and rank them
+        :param functions: Result of the sampling pass
+        :param project_dir: Project folder
+        :param script: Path to the script
+        :param rank_by: "self" or "total" time
+        :return: List of (qualified name, self time, total time) tuples, the hottest first
+        """
+        project_dir = os.path.abspath(project_dir)
+        indices = {}
+        ranked = {}
+        for file_name, line_no, _, own, total in functions:
+            path = os.path.abspath(file_name)
+            if not os.path.isfile(path) or os.path.commonpath([path, project_dir]) != project_dir:
+                continue
+            if path not in indices:
+                indices[path] = self.qualified_names(path, project_dir, script)
+            # Lambdas, comprehensions and module bodies can't be decorated
+            name = indices[path].get(line_no)
+            if name is None:
+                continue
+            times = ranked.setdefault(name, [0.0, 0.0])
+            times[0] += own
+            times[1] += total
+
+        key = 0 if rank_by == 'self' else 1
+        return sorted(((name, times[0], times[1]) for name, times in ranked.items()),
+                      key=lambda item: item[1 + key], reverse=True)
+
+    def print_ranking(self, ranked, top):
+        """
+        :param ranked: Ranked functions, see rank_functions()
+        :param top: Number of functions selected for profiling
+        :return: None
+        """
+        sampled_time = max((total for _, _, total in ranked), default=0.0)
+        row = '{:>4} {:>8} {:>8}  {}'
+        print(row.format('Rank', 'Self, s', 'Total, s', 'Function'))
+        for rank, (name, own, total) in enumerate(ranked[:top], 1):
+            print(row.format(rank, '%.3f' % own, '%.3f' % total, name))
+        if not sampled_time:
+            self._io_man.print_err_info('No samples were taken in the functions of the project, '
+                                        'try a higher --sampling-frequency or a longer run')
+
+    def run(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Run the script under the stack sampler and rank its functions
+        3) Run it again with the decorators injected into the hottest ones
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_auto_cli(self._core.get_profiler_types(), argv)
+        project_dir = args.p if args.p is not None \
+            else os.path.dirname(os.path.abspath(args.script))
+
+        self._io_man.print_msg_with_header('', 'Sampling pass...')
+        ranked = self.rank_functions(self.sample_script(args), project_dir, args.script, args.rank)
+        self.print_ranking(ranked, args.k)
+        key = 1 if args.rank == 'self' else 2
+        targets = [function[0] for function in ranked[:args.k] if function[key] > 0]
+        if not targets:
+            exit(errno.EFAULT)
+
+        self._io_man.print_msg_with_header('', 'Profiling pass (%s): %s'
+                                           % (args.t, ', '.join(targets)))
+        self._hook.profile(targets, args)
+
+
+def _sampling_pass(output_file_name, frequency, clock, script, script_args):
+    """
+    Run the script in this process sampling the main thread and write the time of every
+    function (code object) into a JSON file
+    :param output_file_name: Path to the output file
+    :param frequency: Sampling frequency in Hz
+    :param clock: Clock of the sampler, "cpu" or "wall"
+    :param script: Path to the script
+    :param script_args: Arguments passed to the script
+    :return: None
+    """
+    from decoProf.genericProfiler import _StackSamplerBackend, _import_backend
+
+    _import_backend(_StackSamplerBackend)
+    sampler = _StackSamplerBackend(frequency=frequency, clock=clock)
+    sampler.start()
+    try:
+        ImportHook().run_script(script, script_args)
+    finally:
+        sampler.stop()
+        sampler.release()
+        functions = [(code.co_filename, code.co_firstlineno, code.co_name, own, total)
+                     for code, own, total in sampler.function_times()]
+        with open(output_file_name, 'w') as file:
+            json.dump(functions, file)
+
+
+if __name__ == '__main__':
+    _sampling_pass(sys.argv[1], float(sys.argv[2]), sys.argv[3], sys.argv[4], sys.argv[5:])
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import errno
+import glob
+import random
+import socket
+import shutil
+import tempfile
+import subprocess
+import importlib.util
+
+from decoProf.io_manager import IOManager
+from decoProf.core import Core
+from decoProf.genericProfiler import ProfileDecorators
+
+
+def _noop():
+    pass
+
+
+def _leaf(x):
+    return x + 1
+
+
+def _arithmetic():
+    res = 0
+    for n in range(100):
+        res += n * n
+    return res
+
+
+def _nested_calls():
+    res = 0
+    for n in range(20):
+        res = _leaf(res)
+    return res
+
+
+def _allocations():
+    return [[n] * 10 for n in range(50)]
+
+
+# Synthetic micro-kernels: (name, function, arguments). The "noop" kernel measures the
+# fixed cost of a profiled call and is used for the calibration
+_MICRO_KERNELS = [('noop', _noop, ()),
+                  ('arithmetic', _arithmetic, ()),
+                  ('nested_calls', _nested_calls, ()),
+                  ('allocations', _allocations, ()),
+                  ]
+_CALIBRATION_KERNEL = 'noop'
+# Profiler types whose decorators have no session mode
+_SESSIONLESS_TYPES = ('latency', 'call_tree')
+
+# Script measuring the startup cost of an instrumented program in a fresh interpreter:
+# the import of the decorators and the decoration of a function
+_IMPORT_SCRIPT = '''
+import time
+start_time = time.perf_counter()
+from decoProf.genericProfiler import ProfileDecorators
+{decorate}
+print(time.perf_counter() - start_time)
+'''
+
+
+class BenchmarkSuite:
+    def __init__(self, io_man=None):
+        """
+        :_io_man: Object of the IO manager
+        :_core: Object of the Core, used to look up the profiler types
+        :_workloads: List of (name, function, arguments) tuples
+        :_budget: Minimum duration of a single measurement in seconds
+        :_repeat: Number of measurements, the fastest one is reported
+        """
+        self._io_man = io_man if io_man is not None else IOManager(debug=False)
+        self._core = Core(self._io_man)
+        self._workloads = list(_MICRO_KERNELS)
+        self._budget = 0.2
+        self._repeat = 3
+
+    def load_module(self, file_name):
+        """
+        Import an example script by its path without executing its "__main__" block
+        :param file_name: Path to the script
+        :return: Module object
+        """
+        name = 'decoProf_bench_' + os.path.splitext(os.path.basename(file_name))[0]
+        spec = importlib.util.spec_from_file_location(name, file_name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def add_examples(self, examples_dir):
+        """
+        Add the functions of the example scripts to the workloads
+        :param examples_dir: Folder with the examples shipped with the repository
+        :return: None
+        """
+        try:
+            dummy_work = self.load_module(os.path.join(examples_dir, 'dummy_work.py'))
+            factorial = self.load_module(os.path.join(examples_dir, 'factorial.py'))
+            dot = self.load_module(os.path.join(examples_dir, 'subfolder', 'dot.py'))
+        except OSError as error:
+            self._io_man.print_err_info('Can\'t load the examples: ' + str(error))
+            exit(errno.EFAULT)
+
+        x = [random.random() for _ in range(100)]
+        y = [random.random() for _ in range(100)]
+        self._workloads += [('dummy_work.add', dummy_work.add, ('', 1)),
+                            ('factorial.factorial', factorial.factorial, (30,)),
+                            ('factorial.taylor_exp', factorial.taylor_exp, (30,)),
+                            ('subfolder.dot.dot', dot.dot, (x, y)),
+                            ]
+
+    def time_per_call(self, function, args):
+        """
+        Measure the time of a call. The number of calls is doubled until the measurement
+        takes at least the time budget, the fastest of several measurements is taken
+        :param function: Function to be called
+        :param args: Tuple of arguments
+        :return: Tuple of the time per call in seconds and the number of calls
+        """
+        n_calls = 1
+        while True:
+            start_time = time.perf_counter()
+            for _ in range(n_calls):
+                function(*args)
+            elapsed = time.perf_counter() - start_time
+            if elapsed >= self._budget:
+                break
+            n_calls *= 2
+
+        best = elapsed
+        for _ in range(self._repeat - 1):
+            start_time = time.perf_counter()
+            for _ in range(n_calls):
+                function(*args)
+            best = min(best, time.perf_counter() - start_time)
+        return best / n_calls, n_calls
+
+    def decorate(self, profiler_type, function, session, **options):
+        """
+        Wrap a function into the decorator of the given profiler type
+        :param profiler_type: Profiler type, e.g. "cpu"
+        :param function: Function to be profiled
+        :param session: Session mode (ignored by the latency histogram and the call tree)
+        :param options: Other options of the decorator
+        :return: Tuple of the wrapped function and the title of the profiler
+        """
+        decorator_name = self._core.get_profiler_types()[profiler_type].split('.')[-1]
+        decorator = getattr(ProfileDecorators, decorator_name)
+        if profiler_type not in _SESSIONLESS_TYPES:
+            options['session'] = session
+        return decorator(**options)(function), decorator.title
+
+    def measure(self, profiler_types, session):
+        """
+        Run every workload without instrumentation and under every profiler type
+        :param profiler_types: List of profiler types
+        :param session: Session mode of the decorators
+        :return: List of result dictionaries
+        """
+        results = []
+        for name, function, args in self._workloads:
+            baseline, _ = self.time_per_call(function, args)
+            for profiler_type in profiler_types:
+                wrapper, title = self.decorate(profiler_type, function, session)
+                wrapper(*args)
+                profiled, n_calls = self.time_per_call(wrapper, args)
+                # The reports are not needed, only the timings
+                ProfileDecorators.reset()
+                results.append({'workload': name,
+                                'type': profiler_type,
+                                'profiler': title,
+                                'calls': n_calls,
+                                'baseline': baseline,
+                                'profiled': profiled,
+                                'overhead': profiled - baseline,
+                                'slowdown': profiled / baseline if baseline > 0 else float('inf'),
+                                })
+        return results
+
+    def calibrate(self, profiler_types, session):
+        """
+        Measure the overhead per call of every profiler as seen by the decorator itself,
+        i.e. the time it reports for calls of the "noop" kernel
+        :param profiler_types: List of profiler types
+        :param session: Session mode of the decorators
+        :return: Dictionary of profiler titles and their overhead per call in seconds
+        """
+        _, function, args = next(kernel for kernel in _MICRO_KERNELS
+                                 if kernel[0] == _CALIBRATION_KERNEL)
+        overhead = {}
+        output_dir = tempfile.mkdtemp(prefix='decoProf_calibration_')
+        try:
+            for profiler_type in profiler_types:
+                wrapper, title = self.decorate(profiler_type, function, session,
+                                               output_dir=output_dir)
+                _, n_calls = self.time_per_call(wrapper, args)
+                ProfileDecorators.reset()
+                for _ in range(n_calls):
+                    wrapper(*args)
+                # The summary contains the time measured by the decorator
+                ProfileDecorators.flush()
+                for file_name in glob.glob(os.path.join(output_dir, '*.json')):
+                    with open(file_name) as file:
+                        summary = json.load(file)
+                    if summary.get('profiler') == title and summary['calls']:
+                        overhead[title] = summary['total_time'] / summary['calls']
+                    os.remove(file_name)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        return overhead
+
+    def run_interpreter(self, code):
+        """
+        Run the code in a new interpreter which imports decoProf from this installation
+        :param code: Python code printing the time it measured
+        :return: Tuple of the printed time and the wall time of the process in seconds
+        """
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_dir, env.get('PYTHONPATH')]))
+        start_time = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True,
+                                 text=True)
+        elapsed = time.perf_counter() - start_time
+        if process.returncode != 0:
+            self._io_man.print_err_info('Can\'t measure the import time: ' + process.stderr)
+            exit(errno.EFAULT)
+        return float(process.stdout.split()[-1]), elapsed
+
+    def measure_import_time(self, profiler_types):
+        """
+        Measure the startup cost of an instrumented program: the import of the decorators
+        alone and followed by the decoration of a function, which loads the profiler.
+        Every case runs in a fresh interpreter, the fastest of the repetitions is taken
+        :param profiler_types: List of profiler types
+        :return: List of result dictionaries
+        """
+        cases = [('python', None), ('import', '')]
+        cases += [(profiler_type, 'ProfileDecorators.%s(lambda: None)'
+                   % self._core.get_profiler_types()[profiler_type].split('.')[-1])
+                  for profiler_type in profiler_types]
+
+        results = []
+        for name, decorate in cases:
+            code = 'print(0.0)' if decorate is None else _IMPORT_SCRIPT.format(decorate=decorate)
+            timings = [self.run_interpreter(code) for _ in range(self._repeat)]
+            results.append({'case': name,
+                            'import': min(timing[0] for timing in timings),
+                            'process': min(timing[1] for timing in timings),
+                            })
+        return results
+
+    def print_import_results(self, results):
+        """
+        :param results: List of result dictionaries, see measure_import_time()
+        :return: None
+        """
+        row = '{:<12} {:>12} {:>12}'
+        print(row.format('Type', 'Import, ms', 'Process, ms'))
+        for result in results:
+            print(row.format(result['case'], '%.1f' % (result['import'] * 1e3),
+                             '%.1f' % (result['process'] * 1e3)))
+
+    def print_results(self, results):
+        """
+        :param results: List of result dictionaries
+        :return: None
+        """
+        row = '{:<24} {:<12} {:>10} {:>14} {:>14} {:>14} {:>10}'
+        print(row.format('Workload', 'Type', 'Calls', 'Baseline, us', 'Profiled, us',
+                         'Overhead, us', 'Slowdown'))
+        for result in results:
+            print(row.format(result['workload'], result['type'], result['calls'],
+                             '%.3f' % (result['baseline'] * 1e6),
+                             '%.3f' % (result['profiled'] * 1e6),
+                             '%.3f' % (result['overhead'] * 1e6),
+                             '%.1fx' % result['slowdown']))
+
+    def save_calibration(self, overhead, file_name):
+        """
+        Store the overhead per call of the profilers, so it can be subtracted from the
+        reported timings (see the "subtract_overhead" decorator option)
+        :param overhead: Dictionary of profiler titles and their overhead per call
+        :param file_name: Calibration file
+        :return: None
+        """
+        calibration = {'host': socket.gethostname(),
+                       'python': sys.version,
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'overhead': overhead,
+                       }
+        with open(file_name, 'w') as file:
+            json.dump(calibration, file, indent=1)
+        self._io_man.print_msg_with_header('Calibration is written to', file_name)
+
+    def run(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Measure the workloads with and without profilers (or the import time)
+        3) Print the results and save the calibration
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_bench_cli(self._core.get_profiler_types(), argv)
+        self._budget = args.budget
+        self._repeat = args.repeat
+        if args.import_time:
+            self.print_import_results(self.measure_import_time(args.t))
+            return
+
+        if args.p is not None:
+            self.add_examples(args.p)
+
+        results = self.measure(args.t, args.s)
+        self.print_results(results)
+        if args.save_calibration is not None:
+            self.save_calibration(self.calibrate(args.t, args.s), args.save_calibration
+                                  or self._io_man.get_calibration_file_name())
@@ -0,0 +1,117 @@
+import os
+import json
+
+
+def module_name(rel_path):
+    """
+    Convert a path relative to the project folder into a module name, e.g.
+    "subfolder/dot.py" -> "subfolder.dot", "pkg/__init__.py" -> "pkg"
+    :param rel_path: Path to the Python file relative to the project folder
+    :return: Module name
+    """
+    name = os.path.splitext(os.path.normpath(rel_path))[0].replace(os.sep, '.')
+    if name.endswith('.__init__'):
+        name = name[:-len('.__init__')]
+    return name
+
+
+class CallGraph:
+    def __init__(self, edges=None):
+        """
+        Call graph in the PyCG format: every node is a fully qualified function name,
+        e.g. "subfolder.dot.benchmark", and is mapped to the list of its callees
+        :param edges: Dictionary of nodes and their callees
+        """
+        self._edges = {node: list(callees) for node, callees in (edges or {}).items()}
+        self._callers = None
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        Read the call graph from a JSON file produced by PyCG
+        :param file_name: Filename
+        :return: CallGraph object
+        """
+        with open(file_name) as json_file:
+            return cls(json.load(json_file))
+
+    def to_dict(self):
+        return self._edges
+
+    def nodes(self):
+        return list(self._edges)
+
+    def __contains__(self, node):
+        return node in self._edges
+
+    def callees(self, node):
+        """
+        Get the functions called by the node
+        :param node: Fully qualified function name
+        :return: List of fully qualified function names
+        """
+        return self._edges.get(node, [])
+
+    def callers(self, node):
+        """
+        Get the functions calling the node
+        :param node: Fully qualified function name
+        :return: List of fully qualified function names
+        """
+        if self._callers is None:
+            self._callers = {}
+            for caller, callees in self._edges.items():
+                for callee in callees:
+                    self._callers.setdefault(callee, []).append(caller)
+        return self._callers.get(node, [])
+
+    def reachable(self, node, depth):
+        """
+        Collect the transitive callees of the node using breadth-first search
+        :param node: Fully qualified function name
+        :param depth: Maximum number of call edges between the node and a callee
+        :return: Dictionary of reachable nodes (including the node itself) and their
+                 distance from the node
+        """
+        distances = {node: 0}
+        front = [node]
+        for distance in range(1, depth + 1):
+            next_front = []
+            for current in front:
+                for callee in self.callees(current):
+                    if callee not in distances:
+                        distances[callee] = distance
+                        next_front.append(callee)
+            front = next_front
+
+        return distances
+
+    def replace_modules(self, other, modules):
+        """
+        Replace the nodes belonging to the given modules by the nodes of another graph.
+        Nodes of the other graph which are unknown to this graph are added as well
+        :param other: CallGraph with the re-analysed modules
+        :param modules: Set of names of the re-analysed (or removed) modules
+        :return: None
+        """
+        self._edges = {node: callees for node, callees in self._edges.items()
+                       if self.node_module(node, modules) is None}
+        for node, callees in other.to_dict().items():
+            if node not in self._edges or self.node_module(node, modules) is not None:
+                self._edges[node] = list(callees)
+        self._callers = None
+
+    @staticmethod
+    def node_module(node, modules):
+        """
+        Find the module the node belongs to
+        :param node: Fully qualified function name
+        :param modules: Set of module names
+        :return: The longest module name which is a prefix of the node, or None
+        """
+        parts = node.split('.')
+        for n_parts in range(len(parts), 0, -1):
+            name = '.'.join(parts[:n_parts])
+            if name in modules:
+                return name
+        return None
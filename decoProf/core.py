@@ -1,44 +1,155 @@
 import os
 import subprocess
 import ast
-import astunparse
 import json
+import hashlib
+import fnmatch
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 from decoProf.io_manager import IOManager
 from decoProf.info import PACKAGE_NAME
+from decoProf.source_patch import SourcePatcher
+from decoProf.call_graph import CallGraph, module_name
+from decoProf.name_index import QualifiedNameIndex, DEFINITION_NODES, FUNCTION_NODES
+
+
+# Block of a function, e.g. "main@12-20" (lines 12 to 20 of the file) or "main@for#2" (the
+# second "for" loop of the function)
+_BLOCK_PATTERN = re.compile(r'@(?:\d+-\d+|(?:for|while)#\d+)$')
+
+# Loop statements addressed by the blocks
+_LOOP_NODES = {'for': (ast.For, ast.AsyncFor), 'while': (ast.While,)}
+
+
+def _unparse(tree):
+    """
+    Convert AST into source code. astunparse is imported on the first use, the commands
+    which don't modify the code don't need it
+    :param tree: AST object
+    :return: Source code
+    """
+    import astunparse
+
+    return astunparse.unparse(tree)
 
 
 class Core:
-    def __init__(self):
+    def __init__(self, io_man=None):
         """
+        :param io_man: Object of the IO manager to be used, a new one is created if None
         :_profiler_types: Dictionary of profiler types and corresponding decorator names
         :_profiler_module_name: Name of the module that should be added to the "import"
                                 statement at the header of the script
         :_profiler_class_name: Name of the class from the "module_name"
+        :_block_timer_name: Name of the context manager wrapping the blocks of functions
         :_io_man: Object of the IO manager
-        :function_name: Function name to which the decorator should be added to
+        :function_name: Function names to which the decorator should be added to. A name can
+                        be a glob pattern and can be prefixed by a file pattern, e.g.
+                        "subfolder/*.py:dot*"
+        :use_regex: Treat function name patterns as regular expressions instead of globs
+        :n_jobs: Number of processes injecting decorators (None - number of CPUs)
         :decorator_name: Name of the decorator that should be injected
+        :decorator_options: Keyword arguments passed to the decorator. If empty, the
+                            decorator is injected without a call, e.g. "@gp.cprofile_decorator"
+        :working_dir_name: Name of a reusable working directory (None - create a new one)
+        :link_mode: How unmodified files are placed into the working directory
+        :ignore_patterns: Patterns of files which are not copied into the working directory
+        :keep: Number of timestamped working directories to keep (None - keep all)
+        :use_call_graph: Generate the call graph of the project
+        :call_graph: Call graph of the project (None if it wasn't generated)
+        :callee_depth: Inject the decorator into the callees of the targets up to this
+                       number of call edges (None - only into the targets)
+        :_patcher: SourcePatcher of the file being modified. The decorators and the import
+                   are inserted into the original text, so the comments, the formatting
+                   and the line numbers are preserved. None if the file is regenerated
+                   from the AST instead
         """
         self._profiler_module_name = 'genericProfiler'
         self._profiler_class_name = 'ProfileDecorators'
+        self._block_timer_name = 'gp.block_timer'
         self._profiler_types = {'cpu': 'gp.cprofile_decorator',
                                 'mem': 'gp.memory_profiler_decorator',
                                 'call_stack': 'gp.pyinstrument_decorator',
                                 'thread': 'gp.yappi_decorator',
                                 'line': 'gp.line_profiler_decorator',
+                                'alloc': 'gp.tracemalloc_decorator',
+                                'sample': 'gp.sampler_decorator',
+                                'latency': 'gp.latency_decorator',
+                                'call_tree': 'gp.call_tree_decorator',
                                 }
-        self._io_man = IOManager()
+        self._io_man = io_man if io_man is not None else IOManager()
 
         self.file_name = ''
         self.project_name = ''
         self.function_name = []
+        self.use_regex = False
+        self.n_jobs = None
         self.decorator_name = ''
+        self.decorator_options = {}
+        self.working_dir_name = None
+        self.link_mode = 'copy'
+        self.ignore_patterns = []
+        self.keep = None
+        self.use_call_graph = True
+        self.call_graph = None
+        self.callee_depth = None
+        self._patcher = None
+
+    def collect_source_files(self):
+        """
+        Collect all Python files of the project, except for the ignored ones
+        :return: Sorted list of paths relative to the project folder
+        """
+        source_files = []
+        patterns = self._io_man.read_ignore_patterns(self.project_name, self.ignore_patterns)
+        for root, dir_names, file_names in os.walk(self.project_name):
+            rel_root = os.path.relpath(root, self.project_name)
+            if rel_root == '.':
+                rel_root = ''
+            dir_names[:] = [name for name in dir_names
+                            if not self._io_man.is_ignored(os.path.join(rel_root, name), patterns)]
+            for name in file_names:
+                rel_path = os.path.join(rel_root, name)
+                if name.endswith('.py') and not self._io_man.is_ignored(rel_path, patterns):
+                    source_files.append(rel_path)
+
+        return sorted(source_files)
+
+    def collect_source_hashes(self):
+        """
+        Compute content hashes of all Python files of the project
+        :return: Dictionary of paths relative to the project folder and hashes
+        """
+        return {rel_path: self._io_man.file_hash(os.path.join(self.project_name, rel_path))
+                for rel_path in self.collect_source_files()}
+
+    def run_pycg(self, entry_points, output_filename):
+        """
+        Run PyCG (see https://github.com/vitsalis/PyCG) using a subprocess
+        :param entry_points: List of files to be analysed, relative to the project folder
+        :param output_filename: Name of the JSON file PyCG writes the call graph into
+        :return: CallGraph object, or None if PyCG failed
+        """
+        try:
+            subprocess.run(['pycg', '--package', self.project_name]
+                           + [os.path.join(self.project_name, name) for name in entry_points]
+                           + ['-o', output_filename])
+        except FileNotFoundError:
+            self._io_man.print_err_info('Can\'t execute PyCG. Is it installed?')
+            return None
+
+        if not os.path.isfile(output_filename):
+            self._io_man.print_err_info('PyCG didn\'t produce a call graph')
+            return None
+        return CallGraph.from_file(output_filename)
 
     def generate_call_tree(self):
         """
         Generate a call tree using PyCG package (see https://github.com/vitsalis/PyCG).
-        PyCG is called using a subprocess and generates a JSON file as a result of its execution
-        :return: Output filename
+        The call graph of the whole project is cached together with the hashes of the
+        source files, so only the modules changed since the previous run are re-analysed
+        :return: Output filename, or None if the call tree can't be generated
         """
         # working_dir_name - name of the working directory where the
         # JSON file will be stored. It's also used as a basename
@@ -46,26 +157,115 @@ class Core:
         working_dir_name = self._io_man.get_working_dir_name()
 
         # Assemble unique output filename
-        output_filename = os.path.join(working_dir_name, working_dir_name + '.json')
+        output_filename = os.path.join(working_dir_name,
+                                       os.path.basename(os.path.normpath(working_dir_name)) + '.json')
+
+        hashes = self.collect_source_hashes()
+        project_key = hashlib.sha1(os.path.abspath(self.project_name).encode()).hexdigest()
+        cache_filename = os.path.join(self._io_man.get_cache_dir('call_graphs'), project_key + '.json')
+
+        cache = None
+        if os.path.isfile(cache_filename):
+            try:
+                with open(cache_filename) as cache_file:
+                    cache = json.load(cache_file)
+            except ValueError:
+                self._io_man.print_dbg_info('Ignoring corrupted call graph cache: ' + cache_filename)
+
+        if cache is None:
+            self._io_man.print_dbg_info('Analysing the whole project with PyCG')
+            call_graph = self.run_pycg(sorted(hashes), output_filename)
+            if call_graph is None:
+                return None
+        else:
+            call_graph = CallGraph(cache['graph'])
+            changed = [name for name, digest in hashes.items() if cache['files'].get(name) != digest]
+            removed = [name for name in cache['files'] if name not in hashes]
+            self._io_man.print_dbg_info('Modules changed since the previous call graph generation: '
+                                        + str(len(changed) + len(removed)))
+
+            if changed or removed:
+                partial_graph = CallGraph()
+                if changed:
+                    partial_graph = self.run_pycg(sorted(changed), output_filename)
+                    if partial_graph is None:
+                        return None
+                call_graph.replace_modules(partial_graph,
+                                           {module_name(name) for name in changed + removed})
+            self._io_man.write_to_file(output_filename, json.dumps(call_graph.to_dict()))
+
+        self._io_man.write_to_file(cache_filename, json.dumps({'files': hashes,
+                                                               'graph': call_graph.to_dict()}))
         self._io_man.print_dbg_info('Call tree is written to the file: \t' + output_filename)
 
-        # Execute PyCG
-        subprocess.run(['pycg', '--package', self.project_name,
-                        os.path.join(self.project_name, self.file_name),
-                        '-o', output_filename])
-
         return output_filename
 
     def read_call_tree(self, filename):
         """
         Read the call tree from a file
         :param filename: Filename
-        :return: Dictionary of a call tree
+        :return: CallGraph object
         """
-        call_tree = None
-        with open(filename) as json_file:
-            call_tree = json.load(json_file)
-        return call_tree
+        return CallGraph.from_file(filename)
+
+    def get_target_callees(self):
+        """
+        Query the call graph for the functions called by the target functions
+        :return: Dictionary of fully qualified target names and their callees
+        """
+        if self.call_graph is None or not self.file_name:
+            return {}
+
+        module = module_name(self.file_name)
+        targets = [module + '.' + name for name in self.function_name
+                   if ':' not in name and not self.is_pattern(name) and self.split_block(name)[1] is None]
+        return {target: self.call_graph.callees(target) for target in targets}
+
+    def target_nodes(self, modules):
+        """
+        Find the call graph nodes of the targets. A target without a file is looked for
+        in every module of the project
+        :param modules: Dictionary of module names of the project and their files
+        :return: List of fully qualified function names
+        """
+        nodes = []
+        for target in self.function_name:
+            file_pattern, function_name = self.split_target(target)
+            function_name = self.split_block(function_name)[0]
+            if self.is_pattern(function_name) or file_pattern is not None and '*' in file_pattern:
+                continue
+            if file_pattern is not None or self.file_name:
+                nodes.append(module_name(file_pattern or self.file_name) + '.' + function_name)
+            else:
+                nodes += [node for node in self.call_graph.nodes()
+                          if node.endswith('.' + function_name)
+                          and node[:-len(function_name) - 1] in modules]
+        return nodes
+
+    def expand_callees(self):
+        """
+        Add the transitive callees of the targets up to "callee_depth" call edges to the
+        targets. Only the functions defined in the files of the project are added, they
+        are addressed by their files, e.g. "subfolder/dot.py:benchmark"
+        :return: List of the added targets
+        """
+        modules = {module_name(name): name for name in self.collect_source_files()}
+        targets = self.target_nodes(modules)
+        added = []
+        for target in targets:
+            for node in self.call_graph.reachable(target, self.callee_depth):
+                # The targets are reachable from themselves (and maybe from each other)
+                if node in targets:
+                    continue
+                module = CallGraph.node_module(node, modules)
+                if module is None or module == node:
+                    continue
+                callee = modules[module] + ':' + node[len(module) + 1:]
+                if callee not in self.function_name and callee not in added:
+                    added.append(callee)
+
+        self.function_name += added
+        return added
 
     def write_modified_src(self, src_tree, working_copy_filename):
         """
@@ -74,75 +274,352 @@ class Core:
         :param working_copy_filename: Filename AST should be written into
         :return: None
         """
-        self._io_man.write_to_file(working_copy_filename, astunparse.unparse(src_tree))
+        self._io_man.replace_file(working_copy_filename, _unparse(src_tree))
+
+    def patch_source(self, edit, *args):
+        """
+        Record an edit of the source text. If the edit can't be done without moving the
+        original code around, e.g. a block shares a line with another statement, the
+        source file is regenerated from the AST instead
+        :param edit: Method recording the edit, it gets the patcher and "args"
+        :param args: Arguments of the edit
+        :return: None
+        """
+        if self._patcher is None:
+            return
+        try:
+            edit(self._patcher, *args)
+        except ValueError as error:
+            self._io_man.print_dbg_info('The source is regenerated from the AST: ' + str(error))
+            self._patcher = None
+
+    def first_line(self, statement):
+        """
+        :param statement: AST node of a statement
+        :return: First line of the statement including its original decorators (the
+                 injected ones have no location)
+        """
+        return min([statement.lineno] + [getattr(decorator, 'lineno', statement.lineno)
+                                         for decorator in getattr(statement, 'decorator_list', [])])
 
-    def append_decorator_to_tree(self, node, function_name, decorator_name):
+    def patch_decorator(self, patcher, node, decorator_source):
         """
-        Append decorator to the AST's structure
-        :param node: Node which should contain the function
-        :param function_name: Function name to which we should add decorator to
+        Insert the decorator right above the function definition
+        :param patcher: SourcePatcher
+        :param node: Node of the function definition
+        :param decorator_source: Source of the decorator, see decorator_source
+        :return: None
+        """
+        indentation = patcher.indentation(node.lineno, node.col_offset)
+        patcher.insert(node.lineno, indentation + '@' + decorator_source + '\n')
+
+    def append_decorator(self, node, decorator_name):
+        """
+        Append decorator to the decorator list of the function node
+        :param node: Node of the function definition
+        :param decorator_name: Name of the decorator
+        :return: None
+        """
+        self._io_man.print_dbg_info('Function_name: ' + node.name)
+        self._io_man.print_dbg_info('Original decorator_list: ')
+        self._io_man.print_dbg_info(node.decorator_list)
+
+        self.patch_source(self.patch_decorator, node, self.decorator_source(decorator_name))
+        node.decorator_list.append(self.build_decorator_node(decorator_name))
+
+        self._io_man.print_dbg_info('Modified decorator_list: ')
+        self._io_man.print_dbg_info(node.decorator_list)
+
+    def build_name_node(self, dotted_name):
+        """
+        Build the AST node of a dotted name. Dotted names have to be represented by
+        attribute nodes to be compilable
+        :param dotted_name: Name, e.g. "gp.cprofile_decorator"
+        :return: AST node
+        """
+        names = dotted_name.split('.')
+        name_node = ast.Name(id=names[0], ctx=ast.Load())
+        for name in names[1:]:
+            name_node = ast.Attribute(value=name_node, attr=name, ctx=ast.Load())
+        return name_node
+
+    def build_decorator_node(self, decorator_name):
+        """
+        Build the AST node of the decorator. If decorator options are specified, the
+        decorator is called with them as keyword arguments, e.g.
+        "@gp.cprofile_decorator(session='function')"
+        :param decorator_name: Name of the decorator
+        :return: AST node
+        """
+        decorator_node = self.build_name_node(decorator_name)
+        if not self.decorator_options:
+            return decorator_node
+
+        keywords = [ast.keyword(arg=key, value=ast.Constant(value=value))
+                    for key, value in self.decorator_options.items()]
+        return ast.Call(func=decorator_node, args=[], keywords=keywords)
+
+    def decorator_source(self, decorator_name):
+        """
+        Build the source of the decorator, see build_decorator_node
         :param decorator_name: Name of the decorator
-        :return: Tuple of the function name and boolean. True, if function was found,
-                 False otherwise
+        :return: Source code, e.g. "gp.cprofile_decorator(session='function')"
         """
-        function_found = ('', False)
+        if not self.decorator_options:
+            return decorator_name
+        return '%s(%s)' % (decorator_name, ', '.join('%s=%r' % (key, value) for key, value
+                                                     in self.decorator_options.items()))
 
-        for child in ast.iter_child_nodes(node):
-            if isinstance(child, ast.FunctionDef):
-                if child.name == function_name:
-                    self._io_man.print_dbg_info('Function_name: ' + child.name)
-                    self._io_man.print_dbg_info('Original decorator_list: ')
-                    self._io_man.print_dbg_info(child.decorator_list)
+    def split_block(self, function_name):
+        """
+        Split the target into the function name and the block inside the function
+        :param function_name: Function name, e.g. "main", "main@12-20" or "main@for#2"
+        :return: Tuple of the function name and the block (None - the whole function)
+        """
+        match = _BLOCK_PATTERN.search(function_name)
+        if match is None:
+            return function_name, None
+        return function_name[:match.start()], function_name[match.start() + 1:]
 
-                    child.decorator_list.append(ast.Name(id=decorator_name, ctx=ast.Load()))
+    def statement_lists(self, node):
+        """
+        Get the lists of statements directly nested into the node, e.g. the body and the
+        "else" branch of a loop or the bodies of the exception handlers
+        :param node: AST node
+        :return: List of lists of statements
+        """
+        statement_lists = []
+        for _, value in ast.iter_fields(node):
+            if not isinstance(value, list) or not value:
+                continue
+            if isinstance(value[0], ast.stmt):
+                statement_lists.append(value)
+            else:
+                # Exception handlers and the cases of "match" have their own bodies
+                statement_lists += [child.body for child in value
+                                    if isinstance(getattr(child, 'body', None), list)]
+        return statement_lists
+
+    def find_loops(self, statements, loop_type):
+        """
+        Find the loops of the given type in the order of the source code. The loops of
+        nested functions and classes are skipped
+        :param statements: List of statements, e.g. the body of a function
+        :param loop_type: "for" or "while"
+        :return: List of (list of statements, index of the loop) tuples
+        """
+        loops = []
+        for index, statement in enumerate(statements):
+            if isinstance(statement, DEFINITION_NODES):
+                continue
+            if isinstance(statement, _LOOP_NODES[loop_type]):
+                loops.append((statements, index))
+            for statement_list in self.statement_lists(statement):
+                loops += self.find_loops(statement_list, loop_type)
+        return loops
+
+    def find_line_range(self, statements, first_line, last_line):
+        """
+        Find the statements lying within the line range. If a statement overlaps the
+        range partially, the range is looked for inside it
+        :param statements: List of statements, e.g. the body of a function
+        :param first_line: First line of the range
+        :param last_line: Last line of the range
+        :return: Tuple of the list of statements, the first and the end index of the
+                 range in it, None if no statement lies within the range
+        """
+        inside = [index for index, statement in enumerate(statements)
+                  if statement.lineno >= first_line and statement.end_lineno <= last_line]
+        if inside:
+            return statements, inside[0], inside[-1] + 1
+
+        for statement in statements:
+            if statement.lineno <= last_line and statement.end_lineno >= first_line \
+                    and not isinstance(statement, DEFINITION_NODES):
+                for statement_list in self.statement_lists(statement):
+                    found = self.find_line_range(statement_list, first_line, last_line)
+                    if found is not None:
+                        return found
+        return None
+
+    def patch_block(self, patcher, statements, start, end, loop, variable, with_source):
+        """
+        Indent the block and insert the "with" statement above it (and the call of
+        "iterate" into the loop). The block has to occupy whole lines
+        :param patcher: SourcePatcher
+        :param statements: List of statements containing the block
+        :param start: Index of the first statement of the block
+        :param end: End index of the block
+        :param loop: Node of the loop if the block is a loop, None otherwise
+        :param variable: Name of the timer variable
+        :param with_source: Source of the "with" statement
+        :return: None
+        """
+        first_line = self.first_line(statements[start])
+        last_line = statements[end - 1].end_lineno
+        if end < len(statements) and self.first_line(statements[end]) <= last_line:
+            raise ValueError('the block ending at line %d shares the line with the next statement'
+                             % last_line)
+
+        indentation = patcher.indentation(first_line, statements[start].col_offset)
+        block_range = patcher.indent(first_line, last_line, '\t' if '\t' in indentation else '    ')
+        patcher.insert(first_line, indentation + with_source + '\n', block_range)
+        if loop is not None:
+            body_line = self.first_line(loop.body[0])
+            patcher.insert(body_line, patcher.indentation(body_line, loop.body[0].col_offset)
+                           + variable + '.iterate()\n')
+
+    def inject_block(self, node, name, block):
+        """
+        Wrap a block of the function into the timer, e.g.
+        "with gp.block_timer(__name__, 'main@for#2') as _decoProf_for_2:". A loop calls
+        the "iterate" method of the timer at the beginning of every iteration
+        :param node: Node of the function definition
+        :param name: Qualified name of the function
+        :param block: Block, e.g. "12-20" or "for#2"
+        :return: True if the block was found
+        """
+        loop = None
+        if '#' in block:
+            loop_type, number = block.split('#')
+            loops = self.find_loops(node.body, loop_type)
+            if not 1 <= int(number) <= len(loops):
+                return False
+            statements, start = loops[int(number) - 1]
+            end = start + 1
+            loop = statements[start]
+        else:
+            first_line, last_line = (int(line) for line in block.split('-'))
+            found = self.find_line_range(node.body, first_line, last_line)
+            if found is None:
+                return False
+            statements, start, end = found
+
+        variable = '_decoProf_' + re.sub(r'\W', '_', block)
+        options = ', output_dir=%r' % self.decorator_options['output_dir'] \
+            if 'output_dir' in self.decorator_options else ''
+        self.patch_source(self.patch_block, statements, start, end, loop, variable,
+                          'with %s(__name__, %r%s) as %s:' % (self._block_timer_name, name + '@' + block,
+                                                              options, variable))
+
+        arguments = [ast.Name(id='__name__', ctx=ast.Load()), ast.Constant(value=name + '@' + block)]
+        keywords = [ast.keyword(arg='output_dir', value=ast.Constant(value=self.decorator_options['output_dir']))] \
+            if 'output_dir' in self.decorator_options else []
+        timer = ast.Call(func=self.build_name_node(self._block_timer_name), args=arguments,
+                         keywords=keywords)
+        with_node = ast.With(items=[ast.withitem(context_expr=timer,
+                                                 optional_vars=ast.Name(id=variable, ctx=ast.Store()))],
+                             body=statements[start:end])
+        ast.copy_location(with_node, statements[start])
+        with_node.lineno = self.first_line(statements[start])
+        with_node.end_lineno = statements[end - 1].end_lineno
+        if loop is not None:
+            iterate = ast.Expr(value=ast.Call(func=self.build_name_node(variable + '.iterate'),
+                                              args=[], keywords=[]))
+            loop.body.insert(0, ast.copy_location(iterate, loop.body[0]))
+        statements[start:end] = [with_node]
+
+        self._io_man.print_dbg_info('Block %s@%s: lines %d-%d' % (name, block, with_node.lineno,
+                                                                  with_node.end_lineno))
+        return True
+
+    def is_pattern(self, function_name):
+        """
+        Check if the function name is a pattern rather than an exact name
+        :param function_name: Function name or pattern
+        :return: True if the name is a glob pattern or regular expressions are used
+        """
+        return self.use_regex or any(char in function_name for char in '*?[')
 
-                    self._io_man.print_dbg_info('Modified decorator_list: ')
-                    self._io_man.print_dbg_info(child.decorator_list)
-                    function_found = (function_name, True)
+    def resolve_function_name(self, function_name, index):
+        """
+        Find the functions matching the name. Glob patterns (or regular expressions, if
+        enabled) are matched against the qualified names of all functions of the module
+        :param function_name: Function name or pattern, e.g. "Vector.add" or "Vector.*"
+        :param index: QualifiedNameIndex of the module
+        :return: List of (qualified name, node) tuples
+        """
+        if not self.is_pattern(function_name):
+            return [(function_name, node) for node in index.find(function_name)
+                    if isinstance(node, FUNCTION_NODES)]
 
-        return function_found
+        if self.use_regex:
+            regex = re.compile(function_name)
+            return [(name, node) for name, node in index.functions() if regex.fullmatch(name)]
+        return [(name, node) for name, node in index.functions()
+                if fnmatch.fnmatchcase(name, function_name)]
 
-    def inject_decorator(self, src_tree):
+    def inject_decorator(self, src_tree, index=None):
         """
-        Inject decorator to the AST
+        Inject decorator to the AST. All function names are resolved using a single
+        qualified name index of the module, so nested functions and methods of any depth,
+        e.g. "Outer.Inner.method", and async functions are supported
+        :param src_tree: AST
+        :param index: QualifiedNameIndex of the AST, built if None
+        :return: Dictionary of function names (or patterns) and lists of qualified names
+                 of the functions the decorator was injected into
+        """
+        if index is None:
+            index = QualifiedNameIndex(src_tree)
+        matches = {}
+
+        for function_name in self.function_name:
+            matches[function_name] = []
+            target_name, block = self.split_block(function_name)
+            for name, node in self.resolve_function_name(target_name, index):
+                if block is None:
+                    self.append_decorator(node, self.decorator_name)
+                    matches[function_name].append(name)
+                elif self.inject_block(node, name, block):
+                    matches[function_name].append(name + '@' + block)
+
+        return matches
+
+    def suggest_function_names(self, function_name, index):
+        """
+        Suggest similar names for a function name which wasn't found
+        :param function_name: Function name
+        :param index: QualifiedNameIndex of the module
+        :return: List of suggestions
+        """
+        function_name, block = self.split_block(function_name)
+        if self.is_pattern(function_name):
+            return []
+        if block is not None:
+            # Suggest the loops of the function
+            return [name + '@%s#%d' % (loop_type, number)
+                    for name, node in self.resolve_function_name(function_name, index)
+                    for loop_type in _LOOP_NODES
+                    for number in range(1, len(self.find_loops(node.body, loop_type)) + 1)]
+        if index.find(function_name):
+            # The name refers to a class, suggest decorating all of its methods
+            return [function_name + '.*']
+        return index.suggest(function_name)
+
+    def dump_ast(self, src_tree):
+        """
+        Write the AST dump into the working directory for debugging purposes
         :param src_tree: AST
         :return: None
         """
-        pattern_names = [elt.split('.') for elt in self.function_name]
-        function_found = ('', False)
+        file_name = os.path.join(self._io_man.get_working_dir_name(), self.file_name + '_ast.json')
+        self._io_man.write_to_file(file_name, ast.dump(src_tree))
+        self._io_man.print_dbg_info('AST is written to the file: ' + file_name)
 
-        for pattern_name in pattern_names:
-            is_class = False
-            if len(pattern_name) > 1:
-                is_class = True
-                self._io_man.print_dbg_info('Function "' + pattern_name[1] + '" is a member of a class or an inner '
-                                                                             'function')
-            else:
-                self._io_man.print_dbg_info('Function "' + pattern_name[0] + '" is a static function')
-
-            # print_dbg_info(ast.dump(src_tree))
-            file_name = os.path.join(self._io_man.get_working_dir_name(), self.file_name + '_ast.json')
-            self._io_man.write_to_file(file_name, ast.dump(src_tree))
-            self._io_man.print_dbg_info('AST is written to the file: ' + file_name)
-
-            for node in ast.walk(src_tree):
-                if is_class:
-                    if isinstance(node, ast.ClassDef) and node.name == pattern_name[0] \
-                            or isinstance(node, ast.FunctionDef) and node.name == pattern_name[0]:
-                        function_found = self.append_decorator_to_tree(node, pattern_name[1], self.decorator_name)
-                        break
-                else:
-                    function_found = self.append_decorator_to_tree(node, pattern_name[0], self.decorator_name)
-                    break
-
-        if not function_found[1]:
-            self._io_man.print_err_info('Function "' + pattern_name[0]
-                                        + '" was not found in the file ' + self.file_name)
-
-        # print_dbg_info(ast.dump(src_tree))
-        #
-        # print_dbg_info('Modified code:')
-        # print_dbg_info(astunparse.unparse(src_tree))
+    def patch_import(self, patcher, statement, import_source):
+        """
+        Insert the import above the statement
+        :param patcher: SourcePatcher
+        :param statement: First statement following the import, None if there is no such
+                          statement
+        :param import_source: Source of the import
+        :return: None
+        """
+        if statement is None:
+            raise ValueError('the module has no statements to insert the import before')
+        line_no = self.first_line(statement)
+        patcher.insert(line_no, patcher.indentation(line_no, statement.col_offset) + import_source + '\n',
+                       first=True)
 
     def inject_import(self, src_tree):
         """
@@ -154,21 +631,38 @@ class Core:
         import_node = ast.ImportFrom(module=full_module_name,
                                      names=[ast.alias(name=self._profiler_class_name, asname='gp')],
                                      level=0)
-        src_tree.body.insert(0, import_node)
-
-    def generate_ast(self, filename):
+        # The import follows the docstring and the "from __future__" imports, which have
+        # to be at the beginning of the module
+        body = src_tree.body
+        position = 0
+        if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            position = 1
+        while position < len(body) and isinstance(body[position], ast.ImportFrom) \
+                and body[position].module == '__future__':
+            position += 1
+        self.patch_source(self.patch_import, body[position] if position < len(body) else None,
+                          'from %s import %s as gp' % (full_module_name, self._profiler_class_name))
+        body.insert(position, import_node)
+
+    def read_src(self, filename):
         """
-        Parse source file to build AST
+        Read source file
         :param filename: Filename
-        :return: AST object
+        :return: Source code
         """
         file = open(filename, 'r')
         code = file.read()
         file.close()
 
-        src_tree = ast.parse(code)
+        return code
 
-        return src_tree
+    def get_profiler_types(self):
+        """
+        Get known profiler types
+        :return: Dictionary of profiler types and corresponding decorator names
+        """
+        return self._profiler_types
 
     def detect_prof_type(self, args):
         """
@@ -178,19 +672,68 @@ class Core:
         """
         return self._profiler_types[args.t]
 
-    def configure(self):
+    def detect_decorator_options(self, args):
+        """
+        Collect the options of the decorator which differ from the defaults
+        :param args: List of CLI arguments
+        :return: Dictionary of decorator options
+        """
+        options = {}
+        if args.s != 'call':
+            options['session'] = args.s
+        if args.flush_every:
+            options['flush_every'] = args.flush_every
+        if args.sample_every != 1:
+            options['sample_every'] = args.sample_every
+        if args.sample_rate != 1.0:
+            options['sample_rate'] = args.sample_rate
+        if args.sample_budget is not None:
+            options['sample_budget'] = args.sample_budget
+        if args.o is not None:
+            options['output_dir'] = args.o
+        if args.subtract_overhead or args.calibration is not None:
+            options['subtract_overhead'] = os.path.abspath(
+                args.calibration or self._io_man.get_calibration_file_name())
+        if args.clock is not None:
+            options['clock'] = args.clock
+        if args.context is not None:
+            options['context'] = args.context
+        if args.traceback_depth is not None:
+            options['depth'] = args.traceback_depth
+        if args.top is not None:
+            options['top'] = args.top
+        if args.frequency is not None:
+            options['frequency'] = args.frequency
+        if args.max_stacks is not None:
+            options['max_stacks'] = args.max_stacks
+        if args.follow_threads:
+            options['follow_threads'] = True
+        return options
+
+    def configure(self, args=None):
         """
         Perform initial configuration of the script
+        :param args: Object of parsed arguments, the CLI arguments are parsed if None
         :return: None
         """
         # Parse CLI arguments
-        args = self._io_man.parse_cli(self._profiler_types)
-        self.file_name = args.f
+        if args is None:
+            args = self._io_man.parse_cli(self.get_profiler_types())
+        self.file_name = args.f or ''
         self.project_name = args.p
-        self.function_name = str(args.n).split(',')
+        self.function_name = [name.strip() for name in str(args.n).split(',')]
+        self.use_regex = args.regex
+        self.n_jobs = args.j
+        self.working_dir_name = args.w
+        self.link_mode = args.link
+        self.ignore_patterns = args.ignore
+        self.keep = args.keep
+        self.use_call_graph = not args.no_call_graph
+        self.callee_depth = args.callee_depth
 
         # Detect the profiler type
         self.decorator_name = self.detect_prof_type(args)
+        self.decorator_options = self.detect_decorator_options(args)
 
     def prepare_fs(self):
         """
@@ -198,11 +741,12 @@ class Core:
         sources in it
         :return: None
         """
-        # Create a temporary directory
-        self._io_man.create_working_dir(self.project_name)
+        # Create a temporary directory or reuse an existing one
+        self._io_man.create_working_dir(self.project_name, self.working_dir_name, self.keep)
 
-        # Make a working copy of the scripts we are going to work with
-        self._io_man.make_working_copy_of_project(self.project_name)
+        # Sync the scripts we are going to work with into the working copy
+        self._io_man.make_working_copy_of_project(self.project_name, self.ignore_patterns,
+                                                  self.link_mode)
 
     def assemble_wrk_copy_filename(self):
         """
@@ -217,16 +761,203 @@ class Core:
         """
         Modify source code by injecting a decorator and import statements
         :param as_tree: AST
-        :return: None
+        :return: Tuple of the decorator matches (see inject_decorator) and suggestions
+                 for the names which weren't found
         """
+        index = QualifiedNameIndex(as_tree)
+
         # Inject decorator into the source code
-        self.inject_decorator(as_tree)
+        matches = self.inject_decorator(as_tree, index)
+        suggestions = {name: self.suggest_function_names(name, index)
+                       for name, found in matches.items() if not found}
 
         # Inject "import" statement into the source code
-        self.inject_import(as_tree)
+        if any(matches.values()):
+            self.inject_import(as_tree)
+
+            self._io_man.print_dbg_info('Modified code:')
+            self._io_man.print_dbg_info(self._patcher.apply()[0] if self._patcher is not None
+                                        else _unparse(as_tree))
 
-        self._io_man.print_dbg_info('Modified code:')
-        self._io_man.print_dbg_info(astunparse.unparse(as_tree))
+        return matches, suggestions
+
+    def modify_file(self, dump_ast=False):
+        """
+        Inject decorators into the working copy of the file "file_name" and write
+        it back if any function was decorated. The decorators are inserted into the
+        original text if possible, otherwise the file is regenerated from the AST
+        :param dump_ast: Write the AST dump next to the file
+        :return: Tuple of the file name, decorator matches, suggestions and the sorted
+                 list of the inserted lines (None if the file wasn't patched)
+        """
+        working_copy_filename = self.assemble_wrk_copy_filename()
+        source = self.read_src(working_copy_filename)
+        as_tree = ast.parse(source)
+        if dump_ast:
+            self.dump_ast(as_tree)
+
+        self._patcher = SourcePatcher(source)
+        matches, suggestions = self.modify_src(as_tree)
+
+        # Write the modified code back into the file
+        inserted_lines = None
+        if any(matches.values()):
+            if self._patcher is not None:
+                patched_source, inserted_lines = self._patcher.apply()
+                self._io_man.replace_file(working_copy_filename, patched_source)
+            else:
+                self.write_modified_src(as_tree, working_copy_filename)
+        self._patcher = None
+
+        return self.file_name, matches, suggestions, inserted_lines
+
+    def split_target(self, target):
+        """
+        Split the target into the file pattern and the function name
+        :param target: Target, e.g. "dot", "Vector.*" or "subfolder/*.py:dot*"
+        :return: Tuple of the file pattern (None if not specified) and the function name
+        """
+        if ':' in target:
+            file_pattern, function_name = target.split(':', 1)
+            return file_pattern, function_name
+        return None, target
+
+    def is_target_file(self, file_pattern, file_name):
+        """
+        Check if a target should be looked for in the file
+        :param file_pattern: File pattern of the target, None if not specified
+        :param file_name: File name relative to the project
+        :return: True if the file is selected by the pattern, or by "file_name" (the
+                 whole project if it isn't specified) for the targets without a pattern
+        """
+        if file_pattern is None:
+            return not self.file_name or file_name == self.file_name
+        return fnmatch.fnmatchcase(file_name.replace(os.sep, '/'), file_pattern)
+
+    def assemble_jobs(self):
+        """
+        Find the files each target should be looked for in. Targets without a file
+        pattern are looked for in the file "file_name" or in the whole project if the
+        file name isn't specified
+        :return: Dictionary of files and the lists of function names to be looked for
+        """
+        source_files = None
+        jobs = {}
+
+        for target in self.function_name:
+            file_pattern, function_name = self.split_target(target)
+            if file_pattern is None and self.file_name:
+                files = [self.file_name]
+            else:
+                if source_files is None:
+                    source_files = self.collect_source_files()
+                files = [name for name in source_files if self.is_target_file(file_pattern, name)]
+                if file_pattern is not None and not files:
+                    self._io_man.print_err_info('No files match the pattern "' + file_pattern + '"')
+
+            for name in files:
+                names = jobs.setdefault(name, [])
+                if function_name not in names:
+                    names.append(function_name)
+
+        return jobs
+
+    def inject_into_files(self, jobs):
+        """
+        Inject decorators into the working copies of the files. Files are processed by
+        a pool of processes if there are several of them
+        :param jobs: Dictionary of files and the lists of function names (see assemble_jobs)
+        :return: List of tuples returned by modify_file
+        """
+        job_args = [{'file_name': name,
+                     'function_name': function_names,
+                     'use_regex': self.use_regex,
+                     'decorator_name': self.decorator_name,
+                     'decorator_options': self.decorator_options,
+                     'working_dir_name': self._io_man.get_working_dir_name(),
+                     # The AST dump is only written for the explicitly specified file
+                     'dump_ast': name == self.file_name,
+                     'debug': name == self.file_name}
+                    for name, function_names in jobs.items()]
+
+        n_jobs = min(self.n_jobs or os.cpu_count() or 1, len(job_args))
+        if n_jobs <= 1:
+            return [_modify_file(job) for job in job_args]
+
+        self._io_man.print_dbg_info('Processing %d files using %d processes' % (len(job_args), n_jobs))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(_modify_file, job_args, chunksize=max(1, len(job_args) // (4 * n_jobs))))
+
+    def report_injection(self, results):
+        """
+        Mark modified files in the working copy, write the map of the inserted lines and
+        print errors for the function names which weren't found in any file
+        :param results: List of tuples returned by modify_file
+        :return: List of modified files
+        """
+        modified_files = []
+        found = {}
+        suggestions = {}
+
+        line_map = {}
+
+        for file_name, file_matches, file_suggestions, inserted_lines in results:
+            if any(file_matches.values()):
+                modified_files.append(file_name)
+            if inserted_lines is not None:
+                line_map[file_name] = {'source': os.path.abspath(os.path.join(self.project_name, file_name)),
+                                       'inserted': inserted_lines}
+            # Files are shared by the targets with the same function name, e.g.
+            # "a.py:foo,b.py:foo", each target only owns the files it selects
+            for target in self.function_name:
+                file_pattern, function_name = self.split_target(target)
+                if not self.is_target_file(file_pattern, file_name):
+                    continue
+                found.setdefault(target, []).extend(file_name + ':' + name
+                                                    for name in file_matches.get(function_name, []))
+                suggestions.setdefault(target, []).extend(file_name + ':' + name
+                                                          for name in file_suggestions.get(function_name, []))
+
+        for target in self.function_name:
+            file_pattern, function_name = self.split_target(target)
+            names = found.get(target)
+            if names:
+                self._io_man.print_dbg_info('Decorated for "' + target + '": ' + ', '.join(names))
+                continue
+
+            message = ('Block "' if self.split_block(function_name)[1] else 'Function "') \
+                + function_name + '" was not found in the '
+            if file_pattern is not None:
+                message += 'files matching "' + file_pattern + '" of the project ' + self.project_name
+            elif self.file_name:
+                message += 'file ' + self.file_name
+            else:
+                message += 'project ' + self.project_name
+            if suggestions.get(target):
+                message += '. Did you mean: ' + ', '.join(suggestions[target]) + '?'
+            self._io_man.print_err_info(message)
+
+        self._io_man.mark_rewritten([os.path.join(self._io_man.get_working_dir_name(), name)
+                                     for name in modified_files])
+        self._io_man.write_line_map(line_map)
+        return modified_files
+
+    def analyse_call_graph(self):
+        """
+        Generate the call graph of the project (incrementally, see generate_call_tree) and
+        add the callees of the targets if "callee_depth" is set
+        :return: None
+        """
+        call_tree_filename = self.generate_call_tree()
+        if call_tree_filename is None:
+            return
+        self.call_graph = self.read_call_tree(call_tree_filename)
+        for target, callees in self.get_target_callees().items():
+            self._io_man.print_dbg_info('Callees of ' + target + ': ' + ', '.join(callees))
+        if self.callee_depth:
+            added = self.expand_callees()
+            self._io_man.print_msg_with_header('', 'Callees within %d calls: %s'
+                                               % (self.callee_depth, ', '.join(added) or '-'))
 
     def run(self):
         """
@@ -246,20 +977,35 @@ class Core:
         self.prepare_fs()
 
         # Run call tree generator
-        call_tree_filename = self.generate_call_tree()
-        # call_tree = self.read_call_tree(call_tree_filename)
-
-        # Run AST
-        working_copy_filename = self.assemble_wrk_copy_filename()
-        as_tree = self.generate_ast(working_copy_filename)
-
-        # Modify original source code
-        self.modify_src(as_tree)
+        if self.use_call_graph:
+            self.analyse_call_graph()
 
-        # Write modified AS tree back into the file
-        self.write_modified_src(as_tree, working_copy_filename)
+        # Run AST and modify the sources
+        results = self.inject_into_files(self.assemble_jobs())
+        modified_files = self.report_injection(results)
 
         self._io_man.print_msg_with_header('', '--------------------')
         self._io_man.print_msg_with_header('', 'Finished...')
-        self._io_man.print_msg_with_header('', 'See %s for the modified copy of the original code'
-                                           % working_copy_filename)
+        for name in modified_files:
+            self._io_man.print_msg_with_header('', 'See %s for the modified copy of the original code'
+                                               % os.path.join(self._io_man.get_working_dir_name(), name))
+
+
+def _modify_file(job):
+    """
+    Inject decorators into a single file of the working copy. This function is executed
+    by the worker processes, so it gets all parameters in a picklable dictionary
+    :param job: Dictionary of parameters, see Core.inject_into_files
+    :return: Tuple returned by Core.modify_file
+    """
+    io_man = IOManager(debug=job['debug'])
+    io_man.set_working_dir_name(job['working_dir_name'])
+
+    core = Core(io_man)
+    core.file_name = job['file_name']
+    core.function_name = job['function_name']
+    core.use_regex = job['use_regex']
+    core.decorator_name = job['decorator_name']
+    core.decorator_options = job['decorator_options']
+
+    return core.modify_file(job['dump_ast'])
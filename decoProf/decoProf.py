@@ -1,6 +1,85 @@
+import sys
+
 from decoProf.io_manager import IOManager
 from decoProf.core import Core
 
+
+def run_command(argv):
+    """
+    Execute a script injecting decorators at import time, e.g.:
+        decoProf run -n subfolder.dot.dot -t cpu dot_main.py
+    """
+    from decoProf.import_hook import ImportHook
+    ImportHook().run(argv)
+
+
+def merge_command(argv):
+    """
+    Aggregate the results of several processes or MPI ranks, e.g.:
+        decoProf merge -o merged profiles/
+    """
+    from decoProf.merge import ProfileMerger
+    ProfileMerger().run(argv)
+
+
+def bench_command(argv):
+    """
+    Measure the overhead of the profilers, e.g.:
+        decoProf bench -p examples --save-calibration
+    """
+    from decoProf.bench import BenchmarkSuite
+    BenchmarkSuite().run(argv)
+
+
+def auto_command(argv):
+    """
+    Find the hottest functions by sampling and profile them in a second run, e.g.:
+        decoProf auto -k 3 -t line dot_main.py
+    """
+    from decoProf.auto import AutoProfiler
+    AutoProfiler().run(argv)
+
+
+def ingest_command(argv):
+    """
+    Save the summaries of a profiled run in the local profile store, e.g.:
+        decoProf ingest profiles/
+    """
+    from decoProf.store import ProfileStore
+    ProfileStore().run_ingest(argv)
+
+
+def compare_command(argv):
+    """
+    Report the change of the time per call between two revisions, e.g.:
+        decoProf compare v1.2 HEAD
+    """
+    from decoProf.store import ProfileStore
+    ProfileStore().run_compare(argv)
+
+
+def watch_command(argv):
+    """
+    Keep the decorators injected into a working copy while the project is edited, e.g.:
+        decoProf watch -p examples -n dot -t cpu --exec "python3 dot_main.py"
+    """
+    from decoProf.watch import SourceWatcher
+    SourceWatcher().run(argv)
+
+
+# Commands which can be passed as the first CLI argument. The modules of the commands
+# are imported by the commands, e.g. genericProfiler registers its exit and fork hooks
+# when it's imported, which only the commands running the profiled code need
+_commands = {'run': run_command,
+             'merge': merge_command,
+             'bench': bench_command,
+             'auto': auto_command,
+             'ingest': ingest_command,
+             'compare': compare_command,
+             'watch': watch_command,
+             }
+
+
 def main():
     """
     User should specify a function name including the class name the function belongs 
@@ -12,6 +91,10 @@ def main():
                 ...
     User input: -f vector.py -n Vector.add 
     """
+    if len(sys.argv) > 1 and sys.argv[1] in _commands:
+        _commands[sys.argv[1]](sys.argv[2:])
+        return
+
     io_man = IOManager()
     core = Core()
 
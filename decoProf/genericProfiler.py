@@ -1,68 +1,2479 @@
-import cProfile
-import pyinstrument
-import yappi
-import line_profiler
-import memory_profiler
+import os
+import sys
+import re
+import csv
+import json
+import bisect
+import pickle
+import atexit
+import functools
+import threading
+import time
+import types
+import signal
+import inspect
+import importlib
 
+from decoProf.histogram import LatencyHistogram, EXACT_BITS, SUB_BUCKET_BITS
+from decoProf.info import LINE_MAP_FILE_NAME
 
-class ProfileDecorators:
+# Profilers are imported by the first decorator using them (see _import_backend), so an
+# instrumented program loads only the selected one
+cProfile = pstats = pyinstrument = yappi = line_profiler = memory_profiler = tracemalloc = None
+
+
+class _CProfileBackend:
+    title = 'CProfile'
+    options = ('follow_threads',)
+    requires = ('cProfile', 'pstats')
+
+    def __init__(self, follow_threads=False):
+        """
+        :param follow_threads: Profile the threads started and the tasks submitted to
+                               thread pools by the profiled calls as well
+        """
+        self._profiler = cProfile.Profile()
+        self._follow_threads = follow_threads
+        self._calls = 0
+        # (thread name, call) -> [tasks, busy time, statistics], filled by the followed threads
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def prepare(cls, follow_threads=False):
+        """
+        Patch the thread and thread pool classes once a function following the threads
+        is decorated
+        :param follow_threads: See __init__
+        :return: None
+        """
+        if follow_threads:
+            _install_thread_hooks()
+
+    def add_function(self, function):
+        pass
+
+    def start(self):
+        self._profiler.enable()
+        if self._follow_threads:
+            self._calls += 1
+            _followed_calls.backends.append((self, self._calls))
+
+    def stop(self):
+        self._profiler.disable()
+        if self._follow_threads:
+            # The shared sessions might be stopped by another thread than started them
+            backends = _followed_calls.backends
+            for index in range(len(backends) - 1, -1, -1):
+                if backends[index][0] is self:
+                    del backends[index]
+                    break
+
+    def add_thread(self, thread_name, call, busy_time, profiler):
+        """
+        Add the statistics of a task executed by another thread on behalf of a call
+        :param thread_name: Name of the thread
+        :param call: Number of the profiled call which started the task
+        :param busy_time: Wall time of the task in seconds
+        :param profiler: cProfile.Profile of the task, None if it wasn't profiled
+        :return: None
+        """
+        with self._lock:
+            thread = self._threads.setdefault((thread_name, call), [0, 0.0, None])
+            thread[0] += 1
+            thread[1] += busy_time
+            if profiler is not None:
+                if thread[2] is None:
+                    thread[2] = pstats.Stats(profiler)
+                else:
+                    thread[2].add(profiler)
+
+    def _merged_stats(self):
+        """
+        :return: Statistics of the profiled calls and of the followed threads
+        """
+        stats = pstats.Stats(self._profiler)
+        with self._lock:
+            for _, _, thread_stats in self._threads.values():
+                if thread_stats is not None:
+                    stats.add(thread_stats)
+        return stats
+
+    def thread_times(self):
+        """
+        :return: List of (thread name, call, tasks, busy time) tuples of the followed threads
+        """
+        with self._lock:
+            return [(name, call, tasks, busy_time)
+                    for (name, call), (tasks, busy_time, _) in sorted(self._threads.items())]
+
+    def summary(self):
+        if not self._follow_threads:
+            return {}
+        return {'threads': [{'thread': name, 'call': call, 'tasks': tasks, 'busy_time': busy_time}
+                            for name, call, tasks, busy_time in self.thread_times()]}
+
+    def report(self):
+        if not self._threads:
+            self._profiler.print_stats()
+            return
+        self._merged_stats().strip_dirs().sort_stats(-1).print_stats()
+        row = '{:<32} {:>6} {:>8} {:>12}'
+        print(row.format('Thread', 'Call', 'Tasks', 'Busy, s'))
+        for name, call, tasks, busy_time in self.thread_times():
+            print(row.format(name, call, tasks, '%.6f' % busy_time))
+
+    def dump(self, base_name):
+        self._merged_stats().dump_stats(base_name + '.prof')
+        if not self._threads:
+            return [base_name + '.prof']
+        with open(base_name + '.threads.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['thread', 'call', 'tasks', 'busy_time'])
+            writer.writerows(self.thread_times())
+        return [base_name + '.prof', base_name + '.threads.csv']
+
+    def release(self):
+        pass
+
+
+class _FollowedCalls(threading.local):
     def __init__(self):
+        # (backend, call) of the running calls whose threads are followed, innermost last
+        self.backends = []
+
+
+_followed_calls = _FollowedCalls()
+_thread_hooks_installed = False
+
+
+def _follow(function, followers):
+    """
+    Wrap a callable executed by another thread, so it is profiled on behalf of the calls
+    which started it. Threads and tasks started by the callable are followed as well
+    :param function: Callable, e.g. the "run" method of a thread or a submitted task
+    :param followers: List of (backend, call) tuples of the calls
+    :return: Wrapped callable
+    """
+    @functools.wraps(function)
+    def followed(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows a single cProfile at a time, it records all the threads
+            profiler = None
+        backends = _followed_calls.backends
+        depth = len(backends)
+        backends.extend(followers)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            busy_time = time.perf_counter() - start
+            del backends[depth:]
+            if profiler is not None:
+                profiler.disable()
+            thread_name = threading.current_thread().name
+            for backend, call in followers:
+                backend.add_thread(thread_name, call, busy_time, profiler)
+
+    return followed
+
+
+def _install_thread_hooks():
+    """
+    Patch threading.Thread.start and ThreadPoolExecutor.submit to follow the threads and
+    the tasks started while a profiled call is running. Nothing is followed otherwise
+    :return: None
+    """
+    global _thread_hooks_installed
+    if _thread_hooks_installed:
+        return
+    _thread_hooks_installed = True
+    from concurrent.futures import ThreadPoolExecutor
+
+    thread_start = threading.Thread.start
+    executor_submit = ThreadPoolExecutor.submit
+
+    @functools.wraps(thread_start)
+    def start(thread):
+        if _followed_calls.backends and _enabled:
+            thread.run = _follow(thread.run, list(_followed_calls.backends))
+        return thread_start(thread)
+
+    @functools.wraps(executor_submit)
+    def submit(executor, function, /, *args, **kwargs):
+        backends = _followed_calls.backends
+        if not backends or not _enabled:
+            return executor_submit(executor, function, *args, **kwargs)
+        # The worker threads started by the pool outlive the call, only the task is followed
+        _followed_calls.backends = []
+        try:
+            return executor_submit(executor, _follow(function, list(backends)), *args, **kwargs)
+        finally:
+            _followed_calls.backends = backends
+
+    threading.Thread.start = start
+    ThreadPoolExecutor.submit = submit
+
+
+class _PyinstrumentBackend:
+    title = 'pyinstrument'
+    options = ()
+    requires = ('pyinstrument', 'pyinstrument.renderers')
+
+    def __init__(self):
+        # Without async support, profilers of nested decorated functions can run in the
+        # same thread at the same time
+        self._profiler = pyinstrument.Profiler(async_mode='disabled')
+
+    def add_function(self, function):
         pass
 
-    def cprofile_decorator(function):
-        def profiler_wrapper(*args, **kwargs):
-            print("Start profiling (CProfile)")
-            pr = cProfile.Profile()
-            pr.enable()
-            function(*args, **kwargs)
-            pr.disable()
-            pr.print_stats()
-            print("End profiling  (CProfile)")
-
-        return profiler_wrapper
-
-    def pyinstrument_decorator(function):
-        def profiler_wrapper(*args,**kwargs):
-            print("Start profiling (pyinstrument)")
-            pr = pyinstrument.Profiler()
-            pr.start()
-            function(*args, **kwargs)
-            pr.stop()
-            pr.print()
-            print("End profiling  (pyinstrument)")
-
-        return profiler_wrapper
-
-    # TODO: Add clock type as a parameter
-    def yappi_decorator(function):
-        def profiler_wrapper(*args, **kwargs):
-            print("Start profiling (yappi)")
-            yappi.set_clock_type("cpu")
+    def start(self):
+        self._profiler.start()
+
+    def stop(self):
+        self._profiler.stop()
+
+    def report(self):
+        self._profiler.print()
+
+    def dump(self, base_name):
+        session = self._profiler.last_session
+        session.save(base_name + '.pyisession')
+        with open(base_name + '.speedscope.json', 'w') as file:
+            file.write(self._profiler.output(renderer=pyinstrument.renderers.SpeedscopeRenderer()))
+        with open(base_name + '.folded', 'w') as file:
+            file.writelines('%s %d\n' % (stack, weight)
+                            for stack, weight in _collapse_frames(session.root_frame()))
+        return [base_name + '.pyisession', base_name + '.speedscope.json', base_name + '.folded']
+
+    def release(self):
+        pass
+
+
+class _YappiBackend:
+    title = 'yappi'
+    options = ('clock', 'context')
+    requires = ('yappi',)
+    clock_types = ('cpu', 'wall')
+    context_types = ('thread', 'greenlet')
+
+    # yappi is a single global profiler shared by all the sessions: it is started by the
+    # first running backend and stopped by the last one. The statistics are cleared once
+    # no backend holds unreported data, so they don't grow over a long run
+    _running = 0
+    _holders = 0
+
+    def __init__(self, clock='cpu', context='thread'):
+        """
+        :param clock: "cpu" - CPU time, "wall" - wall time (the time coroutines spend
+                      awaiting is attributed to them)
+        :param context: "thread" - contexts are native threads, "greenlet" - greenlets
+        """
+        if clock not in self.clock_types:
+            raise ValueError('Unknown yappi clock type "%s". Available options: %s'
+                             % (clock, ', '.join(self.clock_types)))
+        if context not in self.context_types:
+            raise ValueError('Unknown yappi context type "%s". Available options: %s'
+                             % (context, ', '.join(self.context_types)))
+        self._clock = clock
+        self._context = context
+        self._codes = []
+        self._known_threads = None
+        self._known_contexts = None
+        self._holding = False
+        self._clock_ignored = False
+
+    def add_function(self, function):
+        self._codes.append(function.__code__)
+
+    def start(self):
+        if not self._holding:
+            if _YappiBackend._holders == 0:
+                yappi.clear_stats()
+            _YappiBackend._holders += 1
+            self._holding = True
+            # Contexts existing before the first start, the others were spawned by
+            # the profiled code
+            self._known_threads = {thread.ident for thread in threading.enumerate()}
+            self._known_contexts = {stat.id for stat in self._context_stats()}
+
+        # The clock can't be changed while yappi is running or while other backends
+        # hold its statistics, the clock in use is kept then
+        if _YappiBackend._running == 0 and _YappiBackend._holders == 1:
+            if self._context == 'greenlet':
+                yappi.set_context_backend('greenlet')
+            else:
+                yappi.set_context_backend('native_thread')
+            yappi.set_clock_type(self._clock)
+        elif yappi.get_clock_type() != self._clock and not self._clock_ignored:
+            sys.stderr.write('yappi is already used with the %s clock, the %s clock '
+                             'is ignored\n' % (yappi.get_clock_type(), self._clock))
+            self._clock_ignored = True
+        if _YappiBackend._running == 0:
             yappi.start()
-            function(*args, **kwargs)
-            yappi.get_func_stats().print_all()
-            yappi.get_thread_stats().print_all()
-            print("End profiling  (yappi)")
+        _YappiBackend._running += 1
+
+    def stop(self):
+        _YappiBackend._running -= 1
+        if _YappiBackend._running == 0:
+            yappi.stop()
+
+    def _context_stats(self):
+        # Reading the context statistics of a running yappi loses the timings of the
+        # functions on the stack, so yappi is paused like get_func_stats does it. The
+        # pause is internal to yappi, the statistics are read without it if it's missing
+        native = getattr(yappi, '_yappi', None)
+        paused = hasattr(native, '_pause') and hasattr(native, '_resume')
+        if paused:
+            native._pause()
+        try:
+            if self._context == 'greenlet':
+                return yappi.get_greenlet_stats()
+            return yappi.get_thread_stats()
+        finally:
+            if paused:
+                native._resume()
+
+    def _is_spawned(self, context_stat):
+        """
+        :param context_stat: yappi thread or greenlet statistics
+        :return: True, if the context was started while profiling
+        """
+        if context_stat.id in self._known_contexts:
+            return False
+        return self._context == 'greenlet' or context_stat.tid not in self._known_threads
+
+    def _is_root(self, stat):
+        return any(stat.module == code.co_filename and stat.lineno == code.co_firstlineno
+                   and stat.name.split('.')[-1] == code.co_name for code in self._codes)
+
+    def _collect_stats(self):
+        """
+        Filter the global statistics: keep the functions called by the profiled functions
+        (directly or indirectly) and all the functions executed by the threads or
+        greenlets spawned while profiling
+        :return: Tuple of function statistics and context statistics
+        """
+        all_stats = yappi.get_func_stats()
+        subtree = set()
+        stack = [stat.full_name for stat in all_stats if self._is_root(stat)]
+        while stack:
+            full_name = stack.pop()
+            if full_name in subtree:
+                continue
+            subtree.add(full_name)
+            stat = all_stats[full_name]
+            if stat is not None:
+                stack.extend(child.full_name for child in stat.children)
+
+        spawned = {stat.id for stat in self._context_stats() if self._is_spawned(stat)}
+        func_stats = yappi.get_func_stats(
+            filter_callback=lambda stat: stat.full_name in subtree or stat.ctx_id in spawned)
+        contexts = {stat.ctx_id for stat in func_stats} | spawned
+        context_stats = [stat for stat in self._context_stats() if stat.id in contexts]
+        return func_stats, context_stats
+
+    def report(self):
+        func_stats, context_stats = self._collect_stats()
+        func_stats.print_all()
+        for stat in context_stats:
+            print('%s (id: %d), total time: %.6f, scheduled: %d times'
+                  % (stat.name, stat.id, stat.ttot, stat.sched_count))
+
+    def dump(self, base_name):
+        func_stats, _ = self._collect_stats()
+        func_stats.save(base_name + '.pstat', type='pstat')
+        func_stats.save(base_name + '.callgrind', type='callgrind')
+        return [base_name + '.pstat', base_name + '.callgrind']
+
+    def release(self):
+        """
+        Give up the statistics after they were reported or discarded
+        :return: None
+        """
+        if self._holding:
+            self._holding = False
+            _YappiBackend._holders -= 1
+            if _YappiBackend._holders == 0 and _YappiBackend._running == 0:
+                yappi.clear_stats()
+
+
+class _LineProfilerBackend:
+    title = 'line_profiler'
+    options = ()
+    requires = ('line_profiler',)
+
+    def __init__(self):
+        self._profiler = line_profiler.LineProfiler()
+
+    def add_function(self, function):
+        self._profiler.add_function(function)
+
+    def start(self):
+        self._profiler.enable_by_count()
+
+    def stop(self):
+        self._profiler.disable_by_count()
+
+    def stats(self):
+        """
+        :return: LineStats of the profiler. The lines of the files patched by the injector
+                 are mapped to the original files (see _line_map_entry)
+        """
+        stats = self._profiler.get_stats()
+        timings = {}
+        for (file_name, first_line, name), lines in stats.timings.items():
+            entry = _line_map_entry(file_name)
+            if entry is not None:
+                inserted = entry['inserted']
+                file_name, first_line = entry['source'], _original_line(inserted, first_line)
+                lines = [(_original_line(inserted, line_no), hits, total) for line_no, hits, total in lines
+                         if not _is_inserted(inserted, line_no)]
+            timings[(file_name, first_line, name)] = lines
+        return line_profiler.LineStats(timings, stats.unit)
+
+    def report(self):
+        stats = self.stats()
+        line_profiler.show_text(stats.timings, stats.unit)
+
+    def dump(self, base_name):
+        # The format of LineProfiler.dump_stats, readable by "python -m line_profiler"
+        with open(base_name + '.lprof', 'wb') as file:
+            pickle.dump(self.stats(), file)
+        return [base_name + '.lprof']
+
+    def release(self):
+        pass
+
+
+class _MemoryProfilerBackend:
+    title = 'memory_profiler'
+    options = ()
+    requires = ('memory_profiler', 'psutil')
+
+    def __init__(self):
+        self._profiler = memory_profiler.LineProfiler(backend='psutil')
+
+    def add_function(self, function):
+        self._profiler.add_function(function)
+
+    def start(self):
+        self._profiler.enable_by_count()
+
+    def stop(self):
+        self._profiler.disable_by_count()
+
+    def code_map_items(self):
+        """
+        :return: List of (file name, list of (line, measures) tuples) tuples of the
+                 profiled functions. The lines of the files patched by the injector are
+                 mapped to the original files (see _line_map_entry)
+        """
+        items = []
+        for file_name, lines in self._profiler.code_map.items():
+            lines = list(lines)
+            entry = _line_map_entry(file_name)
+            if entry is not None:
+                inserted = entry['inserted']
+                file_name = entry['source']
+                lines = [(_original_line(inserted, line_no), measures) for line_no, measures in lines
+                         if not _is_inserted(inserted, line_no)]
+            items.append((file_name, lines))
+        return items
+
+    def report(self):
+        # show_results only iterates over the items of the code map
+        code_map = types.SimpleNamespace(items=self.code_map_items)
+        memory_profiler.show_results(types.SimpleNamespace(code_map=code_map))
+
+    def dump(self, base_name):
+        with open(base_name + '.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['file', 'line', 'increment_mib', 'memory_mib', 'occurrences'])
+            for file_name, lines in self.code_map_items():
+                for line_no, measures in lines:
+                    if measures:
+                        writer.writerow([file_name, line_no] + list(measures))
+        return [base_name + '.csv']
+
+    def release(self):
+        pass
+
+
+class _TracemallocBackend:
+    title = 'tracemalloc'
+    options = ('depth', 'top')
+    requires = ('tracemalloc',)
+
+    # Tracing is shared by all the backends: it is started by the first backend and
+    # stopped by the last one (unless it was started by the program itself)
+    _holders = 0
+    _started_tracing = False
+
+    # A snapshot costs as much as all the live traces, so the snapshots are only taken
+    # while their time stays within this share of the time since the first call
+    snapshot_share = 0.1
+
+    def __init__(self, depth=1, top=10):
+        """
+        :param depth: Number of frames stored in the traceback of an allocation. If it is
+                      greater than 1, allocations are grouped by tracebacks, otherwise by lines
+        :param top: Number of allocation sites in the report
+        """
+        if depth < 1 or top < 1:
+            raise ValueError('depth and top of the tracemalloc profiler should be positive')
+        self._depth = depth
+        self._top = top
+        self._key_type = 'traceback' if depth > 1 else 'lineno'
+        self._filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                         tracemalloc.Filter(False, __file__),
+                         tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                         tracemalloc.Filter(False, '<unknown>')]
+        self._entry_snapshot = None
+        self._entry_memory = 0
+        self._entry_peak = 0
+        self._first_start = None
+        self._snapshot_time = 0.0
+        self._snapshots = 0
+        self._steps = 0
+        self._sites = {}
+        self._calls = 0
+        self._peak = 0
+        self._growth = 0
+        self._holding = False
+
+    def add_function(self, function):
+        pass
+
+    def start(self):
+        if not self._holding:
+            if _TracemallocBackend._holders == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self._depth)
+                _TracemallocBackend._started_tracing = True
+            elif tracemalloc.get_traceback_limit() < self._depth:
+                sys.stderr.write('tracemalloc is already tracing %d frames, the depth of %d '
+                                 'is ignored\n' % (tracemalloc.get_traceback_limit(), self._depth))
+            _TracemallocBackend._holders += 1
+            self._holding = True
+
+        now = time.perf_counter()
+        if self._first_start is None:
+            self._first_start = now
+        if self._snapshot_time <= self.snapshot_share * (now - self._first_start):
+            self._entry_snapshot = tracemalloc.take_snapshot()
+            self._snapshot_time += time.perf_counter() - now
+
+        # reset_peak is available since Python 3.9
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._entry_memory, self._entry_peak = tracemalloc.get_traced_memory()
+
+    def stop(self):
+        """
+        Measure the peak and the growth of the traced memory during the call (or the step
+        of a generator). If a snapshot was taken at the entry, it is compared with the
+        one taken at the exit, so only the memory allocated (and not freed) inside the
+        call is attributed to the sites. Memory freed by a later call is subtracted
+        again, leaks keep growing
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        # Without reset_peak, the peak belongs to the call only if it was exceeded in it
+        if peak > self._entry_peak:
+            self._peak = max(self._peak, peak - self._entry_memory)
+        else:
+            self._peak = max(self._peak, current - self._entry_memory)
+        self._growth += current - self._entry_memory
+        self._steps += 1
+
+        if self._entry_snapshot is not None:
+            start_time = time.perf_counter()
+            exit_snapshot = tracemalloc.take_snapshot().filter_traces(self._filters)
+            entry_snapshot = self._entry_snapshot.filter_traces(self._filters)
+            for stat in exit_snapshot.compare_to(entry_snapshot, self._key_type):
+                if stat.size_diff or stat.count_diff:
+                    site = self._sites.setdefault(stat.traceback, [0, 0])
+                    site[0] += stat.size_diff
+                    site[1] += stat.count_diff
+            self._entry_snapshot = None
+            self._snapshots += 1
+            self._snapshot_time += time.perf_counter() - start_time
+
+    def record_call(self):
+        """
+        Count an outermost call, the steps of a generator are started and stopped separately
+        :return: None
+        """
+        self._calls += 1
+
+    def allocation_sites(self):
+        """
+        :return: List of (traceback, size, count) tuples of the sites whose memory grew
+                 during the calls, the largest growth first
+        """
+        return sorted(((traceback, size, count) for traceback, (size, count) in self._sites.items()
+                       if size > 0), key=lambda site: site[1], reverse=True)
+
+    def summary(self):
+        return {'peak_memory': self._peak,
+                'memory_growth': self._growth,
+                'snapshots': self._snapshots,
+                }
+
+    def report(self):
+        print('Peak traced memory: %s above the memory at the entry'
+              % _format_size(self._peak))
+        print('Traced memory growth: %s in %d calls (%s per call)'
+              % (_format_size(self._growth), self._calls,
+                 _format_size(self._growth / max(self._calls, 1))))
+        print('Top %d allocation sites by memory allocated in the calls and not freed '
+              '(snapshots of %d of %d executions):' % (self._top, self._snapshots, self._steps))
+        for traceback, size, count in self.allocation_sites()[:self._top]:
+            # Frames are sorted from the oldest to the most recent (the allocation itself)
+            frame = traceback[-1]
+            print('%s:%d: %s in %d blocks' % (frame.filename, frame.lineno, _format_size(size), count))
+            if self._depth > 1:
+                # The callers, except for the frames of the decorators
+                for caller in reversed(traceback[:-1]):
+                    if caller.filename != __file__:
+                        print('    %s:%d' % (caller.filename, caller.lineno))
+
+    def dump(self, base_name):
+        with open(base_name + '.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['traceback', 'size', 'count'])
+            for traceback, size, count in self.allocation_sites():
+                writer.writerow([' <- '.join('%s:%d' % (frame.filename, frame.lineno)
+                                             for frame in reversed(traceback)), size, count])
+        return [base_name + '.csv']
+
+    def release(self):
+        """
+        Stop tracing after the results were reported or discarded
+        :return: None
+        """
+        if self._holding:
+            self._holding = False
+            _TracemallocBackend._holders -= 1
+            if _TracemallocBackend._holders == 0 and _TracemallocBackend._started_tracing:
+                tracemalloc.stop()
+                _TracemallocBackend._started_tracing = False
+
+
+class _StackSamplerBackend:
+    title = 'sampler'
+    options = ('frequency', 'clock', 'max_stacks', 'top')
+    requires = ()
+    # Interval timers, their signals and the clocks measuring the time between samples
+    clock_types = {'cpu': ('ITIMER_PROF', 'SIGPROF', time.process_time),
+                   'wall': ('ITIMER_REAL', 'SIGALRM', time.perf_counter)}
+
+    # A timer is shared by all the backends with the same clock: it is armed by the first
+    # backend and disarmed when the last one is released
+    _backends = {}
+    _intervals = {}
+    _sample_times = {}
+    _previous_handlers = {}
+
+    def __init__(self, frequency=1000, clock='cpu', max_stacks=10000, top=20):
+        """
+        :param frequency: Number of samples per second of the clock
+        :param clock: "cpu" (samples the CPU time of the process) or "wall"
+        :param max_stacks: Number of distinct stacks kept, samples of new stacks are
+                           counted as dropped when the limit is reached
+        :param top: Number of functions in the report
+        """
+        self.prepare(clock)
+        if frequency <= 0 or max_stacks < 1 or top < 1:
+            raise ValueError('frequency, max_stacks and top of the sampler should be positive')
+        self._interval = 1.0 / frequency
+        self._clock = clock
+        self._max_stacks = max_stacks
+        self._top = top
+        # Threads running the profiled calls: thread ID -> number of nested starts
+        self._threads = {}
+        # Stack (code objects from the innermost frame outwards) -> sampled time in seconds
+        self._stacks = {}
+        self._samples = 0
+        self._sampled_time = 0.0
+        self._dropped_time = 0.0
+        self._registered = False
+
+    @classmethod
+    def prepare(cls, clock='cpu', **options):
+        """
+        Install the signal handler of the clock. Python allows it only in the main thread,
+        so it is done when a function is decorated rather than on its first call, which
+        can happen in another thread. The handler does nothing while no timer is armed
+        :param clock: Clock type
+        :param options: Other options of the backend
+        :return: None
+        """
+        if not hasattr(signal, 'setitimer'):
+            raise RuntimeError('The sampler requires interval timers, which are not '
+                               'supported by this platform')
+        if clock not in cls.clock_types:
+            raise ValueError('Unknown clock type of the sampler: ' + str(clock)
+                             + '. Available options: ' + ', '.join(cls.clock_types))
+        if clock not in cls._previous_handlers \
+                and threading.current_thread() is threading.main_thread():
+            cls._previous_handlers[clock] = signal.signal(
+                getattr(signal, cls.clock_types[clock][1]), _sample_stacks)
+
+    def add_function(self, function):
+        pass
+
+    def start(self):
+        if not self._registered:
+            self._register()
+        ident = threading.get_ident()
+        self._threads[ident] = self._threads.get(ident, 0) + 1
+
+    def stop(self):
+        ident = threading.get_ident()
+        if self._threads.get(ident, 0) > 1:
+            self._threads[ident] -= 1
+        else:
+            self._threads.pop(ident, None)
+
+    def _register(self):
+        """
+        Add the backend to the ones sampled by the timer of its clock, arm the timer if
+        it is not running yet. The timer keeps running between the profiled calls, so the
+        overhead doesn't depend on the frequency of the calls
+        :return: None
+        """
+        cls = _StackSamplerBackend
+        if self._clock not in cls._previous_handlers:
+            self.prepare(self._clock)
+            if self._clock not in cls._previous_handlers:
+                sys.stderr.write('The signal handler of the sampler can be installed only by the '
+                                 'main thread, the calls are not sampled\n')
+                return
+
+        backends = cls._backends.setdefault(self._clock, [])
+        timer_name, _, clock = self.clock_types[self._clock]
+        if not backends:
+            cls._intervals[self._clock] = self._interval
+            cls._sample_times[self._clock] = clock()
+            signal.setitimer(getattr(signal, timer_name), self._interval, self._interval)
+        elif cls._intervals[self._clock] != self._interval:
+            sys.stderr.write('The sampler timer is already running at %g Hz, the frequency '
+                             'of %g Hz is ignored\n' % (1.0 / cls._intervals[self._clock],
+                                                        1.0 / self._interval))
+        backends.append(self)
+        self._registered = True
+
+    def sample(self, frame, elapsed):
+        """
+        Attribute the time elapsed since the previous sample to the current stacks of the
+        profiled threads. Called by the signal handler
+        :param frame: Frame interrupted by the signal in the main thread
+        :param elapsed: Time of the clock since the previous signal. Timers based on the
+                        CPU time often fire at the scheduler tick rate, slower than requested
+        :return: None
+        """
+        frames = None
+        # Other threads can start and stop profiled calls meanwhile
+        for ident in tuple(self._threads):
+            if ident == _main_thread_id:
+                thread_frame = frame
+            else:
+                if frames is None:
+                    frames = sys._current_frames()
+                thread_frame = frames.get(ident)
+
+            # Code objects from the innermost frame outwards, without the decorators
+            codes = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                if code.co_filename != __file__:
+                    codes.append(code)
+                thread_frame = thread_frame.f_back
+            stack = tuple(codes)
+
+            self._samples += 1
+            self._sampled_time += elapsed
+            if stack in self._stacks:
+                self._stacks[stack] += elapsed
+            elif len(self._stacks) < self._max_stacks:
+                self._stacks[stack] = elapsed
+            else:
+                self._dropped_time += elapsed
+
+    def collapsed_stacks(self):
+        """
+        :return: List of (stack, weight in microseconds) tuples in the format of
+                 flamegraph.pl, the same as the pyinstrument backend writes
+        """
+        stacks = [(';'.join(_frame_label(code.co_name, code.co_filename, code.co_firstlineno)
+                            for code in reversed(stack)), int(weight * 1e6))
+                  for stack, weight in self._stacks.items()]
+        if self._dropped_time:
+            stacks.append(('[dropped]', int(self._dropped_time * 1e6)))
+        return stacks
+
+    def function_times(self):
+        """
+        :return: List of (code, self time, total time) tuples, the highest total time first
+        """
+        own = {}
+        total = {}
+        for stack, weight in self._stacks.items():
+            if stack:
+                own[stack[0]] = own.get(stack[0], 0.0) + weight
+            for code in set(stack):
+                total[code] = total.get(code, 0.0) + weight
+        return sorted(((code, own.get(code, 0.0), weight) for code, weight in total.items()),
+                      key=lambda item: (item[2], item[1]), reverse=True)
+
+    def summary(self):
+        return {'samples': self._samples,
+                'sampled_time': self._sampled_time,
+                'dropped_time': self._dropped_time,
+                'clock': self._clock,
+                }
+
+    def report(self):
+        print('%d samples of %.3f s (%s clock, %.0f Hz), %d stacks, %.3f s dropped'
+              % (self._samples, self._sampled_time, self._clock,
+                 self._samples / self._sampled_time if self._sampled_time else 0.0,
+                 len(self._stacks), self._dropped_time))
+        if not self._sampled_time:
+            return
+        row = '{:>8} {:>8}  {}'
+        print(row.format('Self, %', 'Total, %', 'Function'))
+        for code, own, total in self.function_times()[:self._top]:
+            print(row.format('%.1f' % (100.0 * own / self._sampled_time),
+                             '%.1f' % (100.0 * total / self._sampled_time),
+                             _frame_label(code.co_name, code.co_filename, code.co_firstlineno)))
+
+    def dump(self, base_name):
+        with open(base_name + '.folded', 'w') as file:
+            file.writelines('%s %d\n' % (stack, weight) for stack, weight in self.collapsed_stacks())
+        return [base_name + '.folded']
+
+    def release(self):
+        """
+        Stop sampling after the results were reported or discarded. The signal handler
+        stays installed, a signal might still be pending
+        :return: None
+        """
+        if not self._registered:
+            return
+        self._registered = False
+        backends = _StackSamplerBackend._backends[self._clock]
+        backends.remove(self)
+        if not backends:
+            signal.setitimer(getattr(signal, self.clock_types[self._clock][0]), 0)
+
+
+_main_thread_id = threading.main_thread().ident
+
+
+def _sample_stacks(signum, frame):
+    """
+    Signal handler of the sampler timers. Python runs it in the main thread between
+    bytecodes, the stacks of the other threads are looked up by their IDs
+    :param signum: Signal number
+    :param frame: Interrupted frame of the main thread
+    :return: None
+    """
+    cls = _StackSamplerBackend
+    for clock_type, (_, signal_name, clock) in cls.clock_types.items():
+        if signum != getattr(signal, signal_name):
+            continue
+        backends = cls._backends.get(clock_type)
+        if backends:
+            now = clock()
+            elapsed = now - cls._sample_times[clock_type]
+            cls._sample_times[clock_type] = now
+            for backend in tuple(backends):
+                backend.sample(frame, elapsed)
+        previous = cls._previous_handlers.get(clock_type)
+        if callable(previous):
+            previous(signum, frame)
+
+
+def _format_size(size):
+    """
+    :param size: Size in bytes
+    :return: Human-readable size, e.g. "1.5 KiB"
+    """
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
+
+
+def _frame_label(function, file_name, line_no):
+    """
+    Assemble the label of a stack frame used in collapsed stacks
+    :param function: Function name
+    :param file_name: Filename
+    :param line_no: Line number
+    :return: Label
+    """
+    return '%s (%s:%d)' % (function, file_name, line_no)
+
+
+def _line_map_entry(file_name):
+    """
+    Find the entry of the file in the line map written by the injector into the root of
+    the working copy (see IOManager.write_line_map). The maps are read once per directory
+    :param file_name: Path to the source file
+    :return: Dictionary with the path to the original file ("source") and the sorted list
+             of the inserted lines ("inserted"), None if the file wasn't patched
+    """
+    file_name = os.path.abspath(file_name)
+    dir_name = os.path.dirname(file_name)
+    searched = []
+    while dir_name not in _line_maps:
+        searched.append(dir_name)
+        map_file_name = os.path.join(dir_name, LINE_MAP_FILE_NAME)
+        if os.path.isfile(map_file_name):
+            try:
+                with open(map_file_name) as map_file:
+                    _line_maps[dir_name] = (dir_name, json.load(map_file))
+            except (OSError, ValueError):
+                _line_maps[dir_name] = None
+            break
+        parent_name = os.path.dirname(dir_name)
+        if parent_name == dir_name:
+            _line_maps[dir_name] = None
+            break
+        dir_name = parent_name
+    for name in searched:
+        _line_maps[name] = _line_maps[dir_name]
+
+    if _line_maps[dir_name] is None:
+        return None
+    root_name, line_map = _line_maps[dir_name]
+    return line_map.get(os.path.relpath(file_name, root_name))
+
+
+_line_maps = {}
+
+
+def _original_line(inserted, line_no):
+    """
+    :param inserted: Sorted list of the lines inserted into the file
+    :param line_no: Line number in the patched file
+    :return: Line number in the original file. An inserted line is mapped to the
+             following original line, e.g. a decorator to its function
+    """
+    return line_no - bisect.bisect_left(inserted, line_no)
+
+
+def _is_inserted(inserted, line_no):
+    """
+    :param inserted: Sorted list of the lines inserted into the file
+    :param line_no: Line number in the patched file
+    :return: True if the line was inserted
+    """
+    index = bisect.bisect_left(inserted, line_no)
+    return index < len(inserted) and inserted[index] == line_no
+
+
+def _collapse_frames(root_frame):
+    """
+    Convert the pyinstrument frame tree into collapsed stacks (the input format of
+    flamegraph.pl and speedscope)
+    :param root_frame: Root frame of the pyinstrument session
+    :return: List of (stack, weight in microseconds) tuples
+    """
+    stacks = []
+    frames = [(root_frame, '')] if root_frame is not None else []
+    while frames:
+        frame, prefix = frames.pop()
+        stack = prefix + _frame_label(frame.function, frame.file_path, frame.line_no or 0)
+        self_time = frame.time - sum(child.time for child in frame.children)
+        if self_time > 0:
+            stacks.append((stack, int(self_time * 1e6)))
+        frames.extend((child, stack + ';') for child in frame.children)
+
+    return stacks
+
+
+# Environment variables holding the rank of the process set by MPI implementations
+# and by the Slurm launcher
+_RANK_VARIABLES = ('OMPI_COMM_WORLD_RANK', 'PMI_RANK', 'PMIX_RANK', 'MV2_COMM_WORLD_RANK',
+                   'SLURM_PROCID')
+
+
+def _process_rank():
+    """
+    Detect the rank of the process in an MPI (or Slurm) job
+    :return: Rank, or None if the process was not started by a parallel launcher
+    """
+    for variable in _RANK_VARIABLES:
+        value = os.environ.get(variable, '')
+        if value.isdigit():
+            return int(value)
+    return None
+
+
+def _host_name():
+    """
+    :return: Name of the host. socket is imported only when the results are written
+    """
+    import socket
+
+    return socket.gethostname()
+
+
+def _output_base_name(output_dir, name):
+    """
+    Assemble a unique base name of the output files: the session name, the rank of the
+    process (if any), the host name, the process ID and the sequence number of the dump,
+    e.g. "output/module.function.host.1234.0" or "output/module.function.rank3.host.1234.0"
+    :param output_dir: Output directory
+    :param name: Name of the session
+    :return: Path without an extension
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    name = re.sub(r'[^\w.-]', '_', name)
+    rank = _process_rank()
+    if rank is not None:
+        name += '.rank%d' % rank
+    prefix = '%s.%s.%d' % (name, re.sub(r'[^\w.-]', '_', _host_name()), os.getpid())
+
+    sequence = _output_sequences.get(prefix, 0)
+    _output_sequences[prefix] = sequence + 1
+    return os.path.join(output_dir, '%s.%d' % (prefix, sequence))
+
+
+_output_sequences = {}
+
+
+class _Session:
+    def __init__(self, backend_class, name, output_dir=None, backend_options=None):
+        """
+        Profiler backend shared by a number of profiled calls. Statistics are accumulated
+        until the session is flushed
+        :param backend_class: Class of the profiler backend
+        :param name: Name of the session printed in the report header
+        :param output_dir: Directory the results are written into. If None, the report
+                           is printed to stdout
+        :param backend_options: Dictionary of keyword arguments of the backend
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.backend_options = backend_options or {}
+        self.overhead = 0.0
+        self.total_time = 0.0
+        self.wait_time = 0.0
+        self.calls = 0
+        self.recursive_calls = 0
+        self.max_depth = 0
+        self.skipped_calls = 0
+        self._backend_class = backend_class
+        self._backend = None
+        self._functions = []
+        self._samplers = []
+        self._active = 0
+
+    def add_function(self, function):
+        """
+        Register a function the backend should trace (used by the line-based profilers)
+        :param function: Decorated function
+        :return: None
+        """
+        self._functions.append(function)
+        if self._backend is not None:
+            self._backend.add_function(function)
+
+    def add_sampler(self, sampler):
+        """
+        Register a sampler whose skipped calls should be counted in the report
+        :param sampler: Sampler object
+        :return: None
+        """
+        self._samplers.append(sampler)
+
+    def start(self):
+        """
+        Start profiling. Nested starts (e.g. a decorated function calling another
+        decorated function sharing the same session) are reference counted
+        :return: None
+        """
+        if self._active == 0:
+            _register_exit_hook()
+            if self._backend is None:
+                self._backend = self._backend_class(**self.backend_options)
+                for function in self._functions:
+                    self._backend.add_function(function)
+            self._backend.start()
+        self._active += 1
+
+    def stop(self):
+        """
+        Stop profiling
+        :return: None
+        """
+        self._active -= 1
+        if self._active == 0:
+            self._backend.stop()
+
+    def record_call(self, elapsed, run_time, recursive_calls, max_depth):
+        """
+        Record statistics of an outermost call
+        :param elapsed: Wall time between the start and the end of the call
+        :param run_time: Time the call was actually running. Coroutines and generators
+                         are suspended in between (awaiting or waiting for the consumer)
+        :param recursive_calls: Number of recursive calls made inside the outermost call
+        :param max_depth: Maximum recursion depth reached (1 - no recursion)
+        :return: None
+        """
+        self.calls += 1
+        self.total_time += elapsed
+        self.wait_time += elapsed - run_time
+        # Backends measuring the start-stop pairs (e.g. the steps of generators) count the calls here
+        backend_record_call = getattr(self._backend, 'record_call', None)
+        if backend_record_call is not None:
+            backend_record_call()
+        self.recursive_calls += recursive_calls
+        self.max_depth = max(self.max_depth, max_depth)
+
+    def reset(self):
+        """
+        Drop the accumulated statistics, e.g. the ones inherited from the parent process
+        after a fork, which would be reported twice otherwise
+        :return: None
+        """
+        if not self._active and self._backend is not None:
+            self._backend.release()
+            self._backend = None
+        self.total_time = 0.0
+        self.wait_time = 0.0
+        self.calls = 0
+        self.recursive_calls = 0
+        self.max_depth = 0
+        self.skipped_calls = 0
+
+    def flush(self):
+        """
+        Print the accumulated report and reset the statistics
+        :return: None
+        """
+        if self._backend is None or self._active:
+            return
+
+        for sampler in self._samplers:
+            self.skipped_calls += sampler.take_skipped()
+
+        title = self._backend_class.title
+        if self.output_dir is not None:
+            self.dump()
+        else:
+            header = '%s, calls: %d' % (self.name, self.calls)
+            if self.recursive_calls:
+                header += ', recursive calls: %d, max recursion depth: %d' \
+                          % (self.recursive_calls, self.max_depth)
+            if self.skipped_calls:
+                header += ', skipped (not sampled) calls: %d' % self.skipped_calls
+            if self.wait_time > 0.0:
+                header += ', on-CPU: %.6f s, waiting: %.6f s' \
+                          % (self.total_time - self.wait_time, self.wait_time)
+            if self.overhead:
+                header += ', time without overhead: %.6f s (%.3f us per call subtracted)' \
+                          % (self.corrected_time(), self.overhead * 1e6)
+            print("Start profiling (%s) [%s]" % (title, header))
+            self._backend.report()
+            print("End profiling  (%s)" % title)
+
+        self.reset()
+
+    def corrected_time(self):
+        """
+        :return: Total time of the profiled calls without the calibrated overhead
+        """
+        return max(0.0, self.total_time - self.calls * self.overhead)
+
+    def summary(self):
+        """
+        Summary of the session written next to the profiler output files. If the overhead
+        is subtracted, "total_time" is the corrected time
+        :return: Dictionary
+        """
+        return {'function': self.name,
+                'profiler': self._backend_class.title,
+                'host': _host_name(),
+                'pid': os.getpid(),
+                'rank': _process_rank(),
+                'calls': self.calls,
+                'recursive_calls': self.recursive_calls,
+                'max_depth': self.max_depth,
+                'skipped_calls': self.skipped_calls,
+                'total_time': self.corrected_time(),
+                'wait_time': self.wait_time,
+                'overhead_per_call': self.overhead,
+                }
+
+    def dump(self):
+        """
+        Write the profiler results and the summary of the session into the output directory
+        :return: None
+        """
+        base_name = _output_base_name(self.output_dir, self.name)
+        summary = self.summary()
+        summary['files'] = [os.path.basename(name) for name in self._backend.dump(base_name)]
+        # Values specific to the profiler, e.g. the peak memory
+        backend_summary = getattr(self._backend, 'summary', None)
+        if backend_summary is not None:
+            summary.update(backend_summary())
+        with open(base_name + '.json', 'w') as file:
+            json.dump(summary, file, indent=1)
+
+        sys.stderr.write('Profile (%s) of %s is written to %s.*\n'
+                         % (self._backend_class.title, self.name, base_name))
+
+
+class _Sampler:
+    def __init__(self, every, rate, budget):
+        """
+        Sampling policy deciding which calls of a decorated function are profiled
+        :param every: Profile every N-th call
+        :param rate: Profile a random fraction of calls (0 < rate <= 1)
+        :param budget: Stop profiling after this many seconds were spent in profiled calls
+        """
+        if every < 1:
+            raise ValueError('sample_every should be a positive integer')
+        if not 0.0 < rate <= 1.0:
+            raise ValueError('sample_rate should be in the range (0, 1]')
+        self.skipped = 0
+        self._every = every
+        self._countdown = every
+        self._rate = rate
+        self._budget = budget
+        # A private generator keeps the random state of the profiled program intact
+        import random
+
+        self._random = random.Random()
 
-        return profiler_wrapper
+    def skip(self):
+        """
+        Decide whether the current call should go through without profiling
+        :return: True, if the call should not be profiled
+        """
+        self._countdown -= 1
+        if self._countdown \
+                or self._rate < 1.0 and self._random.random() >= self._rate \
+                or self._budget is not None and self._budget <= 0.0:
+            if not self._countdown:
+                self._countdown = self._every
+            self.skipped += 1
+            return True
+        self._countdown = self._every
+        return False
 
-    def line_profiler_decorator(function):
+    def spend(self, seconds):
+        """
+        Subtract the duration of a profiled call from the time budget
+        :param seconds: Duration of the profiled call
+        :return: None
+        """
+        if self._budget is not None:
+            self._budget -= seconds
+
+    def take_skipped(self):
+        """
+        Return and reset the number of calls skipped since the last profiled call
+        :return: Number of skipped calls
+        """
+        skipped = self.skipped
+        self.skipped = 0
+        return skipped
+
+
+class _CallDepth(threading.local):
+    """
+    Per-thread recursion state of a decorated function
+    """
+    depth = 0
+    max_depth = 0
+    recursive_calls = 0
+
+
+_calibrations = {}
+
+
+def _calibrated_overhead(file_name, title):
+    """
+    Read the overhead of a profiler measured by "decoProf bench"
+    :param file_name: Calibration file
+    :param title: Title of the profiler
+    :return: Overhead per profiled call in seconds, 0 if it wasn't calibrated
+    """
+    if file_name not in _calibrations:
+        try:
+            with open(file_name) as file:
+                _calibrations[file_name] = json.load(file)['overhead']
+        except (OSError, ValueError, KeyError):
+            sys.stderr.write('Can\'t read the calibration file %s, the overhead is not '
+                             'subtracted\n' % file_name)
+            _calibrations[file_name] = None
+
+    if _calibrations[file_name] is None:
+        return 0.0
+    overhead = _calibrations[file_name].get(title)
+    if overhead is None:
+        sys.stderr.write('The overhead of %s is not calibrated in %s\n' % (title, file_name))
+        return 0.0
+    return overhead
+
+
+def _reentrant_step(frames):
+    """
+    Count a recursive call of a generator or a coroutine made inside a step of the
+    outermost call. The depth is not decreased, since the nested generator might be
+    suspended, instead it is reset when the step ends
+    :param frames: Recursion state of the function
+    :return: None
+    """
+    frames.depth += 1
+    frames.recursive_calls += 1
+    if frames.depth > frames.max_depth:
+        frames.max_depth = frames.depth
+
+
+class _Steps:
+    def __init__(self, session, frames):
+        """
+        Step-by-step execution of a generator or a coroutine. Only the steps (from resuming
+        the generator to its next suspension) are profiled, the time it is suspended
+        (waiting for the event loop or for the consumer) is not
+        :param session: Session the steps are profiled in
+        :param frames: Recursion state of the decorated function
+        """
+        self.session = session
+        self.run_time = 0.0
+        self.recursive_calls = 0
+        self.max_depth = 1
+        self._frames = frames
+
+    def drive(self, iterator):
+        """
+        Generator passing values and exceptions between the caller and the iterator,
+        profiling every step of the iterator
+        :param iterator: Generator, coroutine or another object with send() and throw()
+        :return: Return value of the iterator
+        """
+        frames = self._frames
+        send_value, error = None, None
+        while True:
+            frames.depth = frames.max_depth = 1
+            frames.recursive_calls = 0
+            start_time = time.perf_counter()
+            self.session.start()
+            try:
+                if error is None:
+                    value = iterator.send(send_value)
+                else:
+                    value = iterator.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.session.stop()
+                self.run_time += time.perf_counter() - start_time
+                frames.depth = 0
+                self.recursive_calls += frames.recursive_calls
+                self.max_depth = max(self.max_depth, frames.max_depth)
+
+            try:
+                send_value, error = (yield value), None
+            except GeneratorExit:
+                iterator.close()
+                raise
+            except BaseException as exception:
+                send_value, error = None, exception
+
+
+@types.coroutine
+def _await_steps(steps, awaitable):
+    """
+    Await an awaitable (a coroutine or a step of an asynchronous generator) profiling
+    every step of it
+    :param steps: _Steps object, None - await without profiling
+    :param awaitable: Awaitable object with send() and throw()
+    :return: Result of the awaitable
+    """
+    if steps is None:
+        return (yield from awaitable.__await__())
+    return (yield from steps.drive(awaitable))
+
+
+_session_modes = ('call', 'function', 'process')
+_sessions = []
+_process_sessions = {}
+
+
+def _env_switch(value):
+    """
+    :param value: Value of an environment variable
+    :return: False for "0", "false", "no" and "off", True otherwise
+    """
+    return value.strip().lower() not in ('0', 'false', 'no', 'off')
+
+
+# Global switch checked by the wrappers before anything else, so disabled profiling costs
+# a single branch per call. Calls which already started are completed as usual
+_enabled = _env_switch(os.environ.get('DECOPROF_ENABLED', '1'))
+
+
+_exit_hook_pid = None
+
+
+def _terminate_worker(signum, frame):
+    """
+    SIGTERM handler of the worker processes, see _register_exit_hook
+    :param signum: Signal number
+    :param frame: Current stack frame
+    :return: None
+    """
+    raise SystemExit(128 + signum)
+
+
+def _register_exit_hook():
+    """
+    Make sure the sessions of a worker process are flushed when it exits. Processes
+    started by multiprocessing leave via os._exit() skipping the atexit handlers, but
+    run the multiprocessing finalizers. Pool.terminate() (also called when leaving
+    "with Pool() as pool") kills the workers by SIGTERM, which is turned into SystemExit
+    so that the finalizers run too
+    :return: None
+    """
+    global _exit_hook_pid
+    if _exit_hook_pid == os.getpid():
+        return
+    _exit_hook_pid = os.getpid()
+
+    multiprocessing = sys.modules.get('multiprocessing')
+    if multiprocessing is not None and multiprocessing.parent_process() is not None:
+        from multiprocessing import util
+        util.Finalize(None, ProfileDecorators.flush, exitpriority=0)
+        # Handlers can only be installed by the main thread, the handlers of the profiled
+        # program are kept
+        if threading.current_thread() is threading.main_thread() \
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _terminate_worker)
+
+
+def _reset_after_fork():
+    """
+    Reset the sessions in a forked child process
+    :return: None
+    """
+    _output_sequences.clear()
+    for session in _sessions:
+        session.reset()
+    # Threads don't survive a fork
+    if _signal_flusher is not None:
+        _start_signal_flusher()
+    if _control_file_watcher is not None:
+        _start_control_file_watcher(_control_file_watcher.file_name, _control_file_watcher.interval)
+
+
+def _function_name(function):
+    """
+    :param function: Decorated function
+    :return: Full name of the function including the module name
+    """
+    module = function.__module__
+    # The main module of the processes started by multiprocessing with "spawn"
+    if module == '__mp_main__':
+        module = '__main__'
+    return module + '.' + function.__qualname__
+
+
+def _get_session(backend_class, function, mode, output_dir, backend_options):
+    """
+    Find or create a session the decorated function should report to
+    :param backend_class: Class of the profiler backend
+    :param function: Decorated function
+    :param mode: Session mode, one of "call", "function" or "process"
+    :param output_dir: Directory the results are written into (None - print to stdout)
+    :param backend_options: Dictionary of keyword arguments of the backend
+    :return: Session object
+    """
+    if mode == 'process':
+        key = (backend_class, output_dir, tuple(sorted(backend_options.items())))
+        session = _process_sessions.get(key)
+        if session is None:
+            session = _Session(backend_class, 'process', output_dir, backend_options)
+            _process_sessions[key] = session
+            _sessions.append(session)
+    else:
+        session = _Session(backend_class, _function_name(function), output_dir, backend_options)
+        _sessions.append(session)
+
+    session.add_function(function)
+    return session
+
+
+# Backends whose modules can't be imported
+_missing_backends = set()
+
+
+def _import_backend(backend_class):
+    """
+    Import the modules required by the backend on the first use and make them available
+    as globals of this module. A failure is reported once
+    :param backend_class: Class of the profiler backend
+    :return: True if the modules are available
+    """
+    if backend_class in _missing_backends:
+        return False
+    for name in backend_class.requires:
+        try:
+            importlib.import_module(name)
+        except ImportError as error:
+            sys.stderr.write('The %s profiler is disabled, %s can\'t be imported: %s\n'
+                             % (backend_class.title, name, error))
+            _missing_backends.add(backend_class)
+            return False
+        top_name = name.split('.')[0]
+        globals()[top_name] = sys.modules[top_name]
+    return True
+
+
+def _decorate(backend_class, function, session='call', flush_every=0,
+              sample_every=1, sample_rate=1.0, sample_budget=None, output_dir=None,
+              subtract_overhead=None, **backend_options):
+    """
+    Wrap a function into a profiler
+    :param backend_class: Class of the profiler backend
+    :param function: Function to be profiled
+    :param session: "call" - profile and report every call separately,
+                    "function" - accumulate statistics of all calls of the function,
+                    "process" - accumulate statistics of all decorated functions
+                    in a single report
+    :param flush_every: Print an intermediate report every N calls (0 - report at exit only)
+    :param sample_every: Profile only every N-th call
+    :param sample_rate: Profile only a random fraction of calls
+    :param sample_budget: Stop profiling after the given number of seconds was spent
+                          in profiled calls
+    :param output_dir: Write the results into files in this directory instead of
+                       printing the reports
+    :param subtract_overhead: Calibration file written by "decoProf bench". The calibrated
+                              overhead of the profiler is subtracted from the reported time
+    :param backend_options: Options specific to the profiler backend, e.g. "clock" for yappi
+    :return: Wrapped function
+    """
+    if session not in _session_modes:
+        raise ValueError('Unknown session mode "%s". Available options: %s'
+                         % (session, ', '.join(_session_modes)))
+    for option in backend_options:
+        if option not in backend_class.options:
+            raise ValueError('Unknown option "%s" of the %s profiler'
+                             % (option, backend_class.title))
+    # A missing optional profiler doesn't break the instrumented program, the function
+    # is left undecorated
+    if not _import_backend(backend_class):
+        return function
+
+    # Some backends have to be prepared by the thread decorating the function, e.g. signal
+    # handlers can be installed only by the main thread
+    prepare = getattr(backend_class, 'prepare', None)
+    if prepare is not None:
+        prepare(**backend_options)
+
+    per_call = session == 'call'
+    overhead = 0.0
+    if subtract_overhead is not None:
+        overhead = _calibrated_overhead(subtract_overhead, backend_class.title)
+    shared_session = None if per_call \
+        else _get_session(backend_class, function, session, output_dir, backend_options)
+    if shared_session is not None and overhead:
+        shared_session.overhead = overhead
+    frames = _CallDepth()
+    sampler = None
+    if sample_every != 1 or sample_rate != 1.0 or sample_budget is not None:
+        sampler = _Sampler(sample_every, sample_rate, sample_budget)
+        if shared_session is not None:
+            shared_session.add_sampler(sampler)
+
+    def open_session():
+        if per_call:
+            call_session = _Session(backend_class, _function_name(function), output_dir,
+                                    backend_options)
+            call_session.add_function(function)
+            call_session.overhead = overhead
+            return call_session
+        return shared_session
+
+    def close_session(call_session, elapsed, run_time, recursive_calls, max_depth):
+        call_session.record_call(elapsed, run_time, recursive_calls, max_depth)
+        if sampler is not None:
+            sampler.spend(run_time)
+            if per_call:
+                call_session.skipped_calls += sampler.take_skipped()
+        if per_call or flush_every and call_session.calls >= flush_every:
+            call_session.flush()
+
+    if inspect.isasyncgenfunction(function):
+        async def profiler_wrapper(*args, **kwargs):
+            steps = None
+            if not _enabled:
+                pass
+            elif frames.depth:
+                _reentrant_step(frames)
+            elif sampler is None or not sampler.skip():
+                steps = _Steps(open_session(), frames)
+
+            start_time = time.perf_counter()
+            try:
+                generator = function(*args, **kwargs)
+                send_value, error = None, None
+                while True:
+                    step = generator.asend(send_value) if error is None \
+                        else generator.athrow(error)
+                    try:
+                        item = await _await_steps(steps, step)
+                    except StopAsyncIteration:
+                        return
+                    try:
+                        send_value, error = (yield item), None
+                    except GeneratorExit:
+                        await _await_steps(steps, generator.aclose())
+                        raise
+                    except BaseException as exception:
+                        send_value, error = None, exception
+            finally:
+                if steps is not None:
+                    close_session(steps.session, time.perf_counter() - start_time,
+                                  steps.run_time, steps.recursive_calls, steps.max_depth)
+
+    elif inspect.iscoroutinefunction(function):
+        async def profiler_wrapper(*args, **kwargs):
+            if not _enabled:
+                return await function(*args, **kwargs)
+
+            if frames.depth:
+                _reentrant_step(frames)
+                return await function(*args, **kwargs)
+
+            if sampler is not None and sampler.skip():
+                return await function(*args, **kwargs)
+
+            steps = _Steps(open_session(), frames)
+            start_time = time.perf_counter()
+            try:
+                return await _await_steps(steps, function(*args, **kwargs))
+            finally:
+                close_session(steps.session, time.perf_counter() - start_time,
+                              steps.run_time, steps.recursive_calls, steps.max_depth)
+
+    elif inspect.isgeneratorfunction(function):
         def profiler_wrapper(*args, **kwargs):
-            print("Start profiling (line_profiler)")
-            lp = line_profiler.LineProfiler()
-            lp_wrapper = lp(function)
-            lp_wrapper(*args, **kwargs)
-            lp.print_stats()
-            print("End profiling  (line_profiler)")
+            if not _enabled:
+                return (yield from function(*args, **kwargs))
+
+            if frames.depth:
+                _reentrant_step(frames)
+                return (yield from function(*args, **kwargs))
 
-        return profiler_wrapper
+            if sampler is not None and sampler.skip():
+                return (yield from function(*args, **kwargs))
 
-    def memory_profiler_decorator(function):
+            steps = _Steps(open_session(), frames)
+            start_time = time.perf_counter()
+            try:
+                return (yield from steps.drive(function(*args, **kwargs)))
+            finally:
+                close_session(steps.session, time.perf_counter() - start_time,
+                              steps.run_time, steps.recursive_calls, steps.max_depth)
+
+    else:
         def profiler_wrapper(*args, **kwargs):
-            print("Start profiling (memory_profiler)")
-            lp = memory_profiler.profile()
-            lp_wrapper = lp(function)
-            lp_wrapper(*args, **kwargs)
-            print("End profiling  (memory_profiler)")
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            # Only the outermost frame of a recursive function is profiled, the nested
+            # calls are counted inline, so the wrapper adds a single frame per level
+            if frames.depth:
+                frames.depth += 1
+                frames.recursive_calls += 1
+                if frames.depth > frames.max_depth:
+                    frames.max_depth = frames.depth
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    frames.depth -= 1
+
+            if sampler is not None and sampler.skip():
+                return function(*args, **kwargs)
+
+            call_session = open_session()
+            frames.depth = frames.max_depth = 1
+            frames.recursive_calls = 0
+            start_time = time.perf_counter()
+            call_session.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                call_session.stop()
+                elapsed = time.perf_counter() - start_time
+                frames.depth = 0
+                close_session(call_session, elapsed, elapsed,
+                              frames.recursive_calls, frames.max_depth)
+
+    return functools.wraps(function)(profiler_wrapper)
+
+
+class _LatencySession:
+    title = 'latency'
+
+    def __init__(self, name, output_dir=None):
+        """
+        Histogram of the call durations of a decorated function
+        :param name: Name of the session printed in the report header
+        :param output_dir: Directory the results are written into. If None, the report
+                           is printed to stdout
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.overhead = 0.0
+        self.histogram = LatencyHistogram()
+
+    def reset(self):
+        self.histogram.clear()
+
+    def percentiles(self):
+        """
+        :return: Dictionary of percentiles of the call durations in nanoseconds (without
+                 the calibrated overhead, if any)
+        """
+        overhead = int(self.overhead * 1e9)
+        return {'p50': max(0, self.histogram.percentile(50) - overhead),
+                'p90': max(0, self.histogram.percentile(90) - overhead),
+                'p99': max(0, self.histogram.percentile(99) - overhead),
+                'p999': max(0, self.histogram.percentile(99.9) - overhead),
+                'max': max(0, self.histogram.max() - overhead),
+                }
+
+    def corrected_time(self):
+        """
+        :return: Estimated total time of the calls without the calibrated overhead in seconds
+        """
+        return max(0.0, self.histogram.total() / 1e9 - self.histogram.count() * self.overhead)
+
+    def flush(self):
+        """
+        Print the percentiles of the call durations and reset the histogram
+        :return: None
+        """
+        calls = self.histogram.count()
+        if not calls:
+            return
+
+        if self.output_dir is not None:
+            self.dump()
+        else:
+            print('Latency [%s, calls: %d, mean: %.3f us] %s'
+                  % (self.name, calls, self.corrected_time() / calls * 1e6,
+                     ', '.join('%s: %.3f us' % (key, value / 1e3)
+                               for key, value in self.percentiles().items())))
+        self.reset()
+
+    def dump(self):
+        """
+        Write the summary including the percentiles and the non-empty buckets of the
+        histogram into the output directory
+        :return: None
+        """
+        base_name = _output_base_name(self.output_dir, self.name)
+        summary = {'function': self.name,
+                   'profiler': self.title,
+                   'host': _host_name(),
+                   'pid': os.getpid(),
+                   'rank': _process_rank(),
+                   'calls': self.histogram.count(),
+                   'total_time': self.corrected_time(),
+                   'overhead_per_call': self.overhead,
+                   'latency_ns': self.percentiles(),
+                   'buckets_ns': self.histogram.buckets(),
+                   'files': [],
+                   }
+        with open(base_name + '.json', 'w') as file:
+            json.dump(summary, file, indent=1)
+
+        sys.stderr.write('Latency histogram of %s is written to %s.json\n'
+                         % (self.name, base_name))
+
+
+def _decorate_latency(function, output_dir=None, subtract_overhead=None):
+    """
+    Wrap a function into a lightweight timer recording the duration of every call
+    (including recursive ones) into a histogram
+    :param function: Function to be timed
+    :param output_dir: Write the results into files in this directory instead of
+                       printing the reports
+    :param subtract_overhead: Calibration file written by "decoProf bench". The calibrated
+                              overhead is subtracted from the reported durations
+    :return: Wrapped function
+    """
+    session = _LatencySession(_function_name(function), output_dir)
+    if subtract_overhead is not None:
+        session.overhead = _calibrated_overhead(subtract_overhead, _LatencySession.title)
+    _sessions.append(session)
+    record = session.histogram.record
+    clock = time.perf_counter_ns
+
+    if inspect.isasyncgenfunction(function):
+        async def latency_wrapper(*args, **kwargs):
+            start_time = clock() if _enabled else None
+            try:
+                generator = function(*args, **kwargs)
+                send_value, error = None, None
+                while True:
+                    try:
+                        if error is None:
+                            item = await generator.asend(send_value)
+                        else:
+                            item = await generator.athrow(error)
+                    except StopAsyncIteration:
+                        return
+                    try:
+                        send_value, error = (yield item), None
+                    except GeneratorExit:
+                        await generator.aclose()
+                        raise
+                    except BaseException as exception:
+                        send_value, error = None, exception
+            finally:
+                if start_time is not None:
+                    record(clock() - start_time)
+
+    elif inspect.iscoroutinefunction(function):
+        async def latency_wrapper(*args, **kwargs):
+            if not _enabled:
+                return await function(*args, **kwargs)
+
+            start_time = clock()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                record(clock() - start_time)
+
+    elif inspect.isgeneratorfunction(function):
+        def latency_wrapper(*args, **kwargs):
+            if not _enabled:
+                return (yield from function(*args, **kwargs))
+
+            start_time = clock()
+            try:
+                return (yield from function(*args, **kwargs))
+            finally:
+                record(clock() - start_time)
+
+    else:
+        counts = session.histogram.counts
+        exact_limit = 1 << EXACT_BITS
+
+        def latency_wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            start_time = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                # LatencyHistogram.record() inlined
+                duration = clock() - start_time
+                if duration < exact_limit:
+                    counts[duration] += 1
+                else:
+                    shift = duration.bit_length() - EXACT_BITS
+                    counts[(shift << SUB_BUCKET_BITS) + (duration >> shift)] += 1
+
+    return functools.wraps(function)(latency_wrapper)
+
+
+def _latency_decorator(function=None, **options):
+    """
+    Decorator which can be used both as "@decorator" and "@decorator(**options)"
+    """
+    if function is None:
+        return lambda func: _decorate_latency(func, **options)
+    return _decorate_latency(function, **options)
+
+
+_latency_decorator.title = _LatencySession.title
+
+
+class _BlockSession:
+    title = 'block'
+
+    def __init__(self, name, output_dir=None):
+        """
+        Statistics of a block of statements (a line range or a loop) inside a function
+        :param name: Name of the block, e.g. "__main__.main@for#2"
+        :param output_dir: Directory the results are written into. If None, the report
+                           is printed to stdout
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.reset()
+
+    def reset(self):
+        self.executions = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.iterations = 0
+        self.max_iterations = 0
+        self.iteration_time = 0.0
+        self.min_iteration_time = float('inf')
+        self.max_iteration_time = 0.0
+
+    def record(self, elapsed, iterations, iteration_time, min_iteration_time, max_iteration_time):
+        """
+        Record an execution of the block
+        :param elapsed: Duration of the execution in seconds
+        :param iterations: Number of iterations of the loop (0 for a line range)
+        :param iteration_time: Time from the start of the first iteration to the end of
+                               the loop
+        :param min_iteration_time: Duration of the shortest iteration
+        :param max_iteration_time: Duration of the longest iteration
+        :return: None
+        """
+        self.executions += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if iterations:
+            self.iterations += iterations
+            self.max_iterations = max(self.max_iterations, iterations)
+            self.iteration_time += iteration_time
+            self.min_iteration_time = min(self.min_iteration_time, min_iteration_time)
+            self.max_iteration_time = max(self.max_iteration_time, max_iteration_time)
+
+    def summary(self):
+        summary = {'function': self.name,
+                   'profiler': self.title,
+                   'host': _host_name(),
+                   'pid': os.getpid(),
+                   'rank': _process_rank(),
+                   'calls': self.executions,
+                   'total_time': self.total_time,
+                   'max_time': self.max_time,
+                   'files': [],
+                   }
+        if self.iterations:
+            summary['iterations'] = self.iterations
+            summary['max_iterations'] = self.max_iterations
+            summary['iteration_time'] = {'min': self.min_iteration_time,
+                                         'mean': self.iteration_time / self.iterations,
+                                         'max': self.max_iteration_time}
+        return summary
+
+    def flush(self):
+        """
+        Print the statistics of the block and reset them
+        :return: None
+        """
+        if not self.executions:
+            return
+
+        if self.output_dir is not None:
+            self.dump()
+        else:
+            line = 'Block [%s, executions: %d, mean: %.3f us, max: %.3f us]' \
+                   % (self.name, self.executions, self.total_time / self.executions * 1e6,
+                      self.max_time * 1e6)
+            if self.iterations:
+                line += ' iterations: %d (%.1f per execution, max: %d), per iteration: ' \
+                        'min: %.3f us, mean: %.3f us, max: %.3f us' \
+                        % (self.iterations, self.iterations / self.executions, self.max_iterations,
+                           self.min_iteration_time * 1e6, self.iteration_time / self.iterations * 1e6,
+                           self.max_iteration_time * 1e6)
+            print(line)
+        self.reset()
+
+    def dump(self):
+        """
+        Write the summary into the output directory
+        :return: None
+        """
+        base_name = _output_base_name(self.output_dir, self.name)
+        with open(base_name + '.json', 'w') as file:
+            json.dump(self.summary(), file, indent=1)
+
+        sys.stderr.write('Block statistics of %s are written to %s.json\n'
+                         % (self.name, base_name))
+
+
+class _BlockTimer:
+    def __init__(self, session):
+        """
+        Context manager timing a single execution of a block. The injected code of a loop
+        calls iterate() at the beginning of every iteration
+        :param session: _BlockSession object
+        """
+        self._session = session
+        self._start_time = 0.0
+        self._iterations = 0
+        self._first_iteration = 0.0
+        self._last_iteration = 0.0
+        self._min_iteration_time = float('inf')
+        self._max_iteration_time = 0.0
+
+    def __enter__(self):
+        self._start_time = time.perf_counter()
+        return self
+
+    def iterate(self):
+        now = time.perf_counter()
+        if self._iterations:
+            duration = now - self._last_iteration
+            if duration < self._min_iteration_time:
+                self._min_iteration_time = duration
+            if duration > self._max_iteration_time:
+                self._max_iteration_time = duration
+        else:
+            self._first_iteration = now
+        self._iterations += 1
+        self._last_iteration = now
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        now = time.perf_counter()
+        if self._iterations:
+            # The last iteration ends with the loop
+            self.iterate()
+            self._iterations -= 1
+        self._session.record(now - self._start_time, self._iterations,
+                             now - self._first_iteration, self._min_iteration_time,
+                             self._max_iteration_time)
+        return False
+
+
+class _DisabledBlockTimer:
+    """
+    Context manager returned while profiling is turned off
+    """
+    def __enter__(self):
+        return self
+
+    def iterate(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_disabled_block_timer = _DisabledBlockTimer()
+_block_sessions = {}
+
+
+def _block_timer(module_name, block_name, output_dir=None):
+    """
+    Context manager timing a block of statements, injected around line ranges and loops
+    of the functions, e.g. "with gp.block_timer(__name__, 'main@for#2') as block:"
+    :param module_name: Name of the module the block is defined in
+    :param block_name: Qualified name of the function and the block
+    :param output_dir: Write the results into files in this directory instead of
+                       printing the reports
+    :return: Context manager
+    """
+    if not _enabled:
+        return _disabled_block_timer
+    session = _block_sessions.get((module_name, block_name, output_dir))
+    if session is None:
+        # The main module of the processes started by multiprocessing with "spawn"
+        name = ('__main__' if module_name == '__mp_main__' else module_name) + '.' + block_name
+        session = _BlockSession(name, output_dir)
+        _block_sessions[(module_name, block_name, output_dir)] = session
+        _sessions.append(session)
+        _register_exit_hook()
+    return _BlockTimer(session)
+
+
+class _CallTreeSession:
+    title = 'call_tree'
+
+    def __init__(self, output_dir=None):
+        """
+        Inclusive and exclusive time of the calls between the decorated functions. All
+        functions decorated by the timing decorator share the session of the process
+        :param output_dir: Directory the results are written into. If None, the report
+                           is printed to stdout
+        """
+        self.name = 'call_tree'
+        self.output_dir = output_dir
+        # Call path (names of the decorated functions from the outermost one down to the
+        # callee) -> [calls, recursive calls, inclusive time, exclusive time]. A recursive
+        # call is attributed to the path of the call already running
+        self.nodes = {}
+        self.stacks = _TimedCallStacks()
+
+    def reset(self):
+        self.nodes.clear()
+
+    def root_time(self):
+        """
+        :return: Inclusive time of the calls which were not made by a decorated function
+        """
+        return sum(node[2] for path, node in self.nodes.items() if len(path) == 1)
+
+    def tree_lines(self):
+        """
+        Walk the call paths from the outermost calls down to the callees
+        :return: List of (depth, callee name, calls, inclusive time, exclusive time)
+                 tuples. The calls of the recursive functions are "<all calls>/<outermost
+                 calls>", like in pstats
+        """
+        children = {}
+        for path, node in self.nodes.items():
+            children.setdefault(path[:-1], []).append((path, node))
+        for paths in children.values():
+            paths.sort(key=lambda item: item[1][2], reverse=True)
+
+        lines = []
+        stack = list(reversed(children.get((), [])))
+        while stack:
+            path, (calls, recursive_calls, inclusive, exclusive) = stack.pop()
+            calls = '%d/%d' % (calls + recursive_calls, calls) if recursive_calls else str(calls)
+            lines.append((len(path) - 1, path[-1], calls, inclusive, exclusive))
+            stack.extend(reversed(children.get(path, [])))
+        return lines
+
+    def flush(self):
+        """
+        Print the call tree and reset the statistics
+        :return: None
+        """
+        if not self.nodes:
+            return
+
+        if self.output_dir is not None:
+            self.dump()
+        else:
+            print('Start profiling (%s) [time: %.6f s]' % (self.title, self.root_time()))
+            row = '{:<60} {:>12} {:>14} {:>14}'
+            print(row.format('Function', 'Calls', 'Inclusive, s', 'Exclusive, s'))
+            for depth, name, calls, inclusive, exclusive in self.tree_lines():
+                print(row.format('  ' * depth + name, calls, '%.6f' % inclusive, '%.6f' % exclusive))
+            print('End profiling  (%s)' % self.title)
+        self.reset()
+
+    def dump(self):
+        """
+        Write the call paths into a CSV file and the summary into the output directory
+        :return: None
+        """
+        base_name = _output_base_name(self.output_dir, self.name)
+        with open(base_name + '.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['caller', 'callee', 'path', 'calls', 'recursive_calls',
+                             'inclusive_time', 'exclusive_time'])
+            for path, node in sorted(self.nodes.items(), key=lambda item: item[1][2], reverse=True):
+                writer.writerow([path[-2] if len(path) > 1 else '', path[-1], ';'.join(path)] + node)
+
+        summary = {'function': self.name,
+                   'profiler': self.title,
+                   'host': _host_name(),
+                   'pid': os.getpid(),
+                   'rank': _process_rank(),
+                   'calls': sum(node[0] for path, node in self.nodes.items() if len(path) == 1),
+                   'total_time': self.root_time(),
+                   'files': [os.path.basename(base_name + '.csv')],
+                   }
+        with open(base_name + '.json', 'w') as file:
+            json.dump(summary, file, indent=1)
+
+        sys.stderr.write('Call tree is written to %s.*\n' % base_name)
+
+
+class _TimedCallStacks(threading.local):
+    def __init__(self):
+        """
+        Per-thread stack of the running timed calls: [call path, time of the timed callees]
+        """
+        self.stack = []
+
+
+# Sessions of the timing decorator: output directory -> session
+_call_tree_sessions = {}
+
+
+def _decorate_call_tree(function, output_dir=None):
+    """
+    Wrap a function into a timer attributing the duration of every call to its call path,
+    i.e. to the running decorated functions (the callers) and this one
+    :param function: Function to be timed
+    :param output_dir: Write the results into files in this directory instead of
+                       printing the reports
+    :return: Wrapped function. Generators and coroutines are returned undecorated, their
+             calls return before the body runs
+    """
+    if inspect.isgeneratorfunction(function) or inspect.iscoroutinefunction(function) \
+            or inspect.isasyncgenfunction(function):
+        return function
+
+    session = _call_tree_sessions.get(output_dir)
+    if session is None:
+        session = _CallTreeSession(output_dir)
+        _call_tree_sessions[output_dir] = session
+        _sessions.append(session)
+    name = _function_name(function)
+    nodes = session.nodes
+    stacks = session.stacks
+    clock = time.perf_counter
+
+    def call_tree_wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+
+        stack = stacks.stack
+        caller = stack[-1] if stack else None
+        path = caller[0] if caller is not None else ()
+        # A recursive call belongs to the running call of the function, its time is
+        # already included in the inclusive time of that call
+        recursive = name in path
+        path = path[:path.index(name) + 1] if recursive else path + (name,)
+        frame = [path, 0.0]
+        stack.append(frame)
+        start_time = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = clock() - start_time
+            stack.pop()
+            if caller is not None:
+                caller[1] += elapsed
+            node = nodes.get(path)
+            if node is None:
+                node = nodes[path] = [0, 0, 0.0, 0.0]
+            if recursive:
+                node[1] += 1
+            else:
+                node[0] += 1
+                node[2] += elapsed
+            node[3] += elapsed - frame[1]
+
+    return functools.wraps(function)(call_tree_wrapper)
+
+
+def _call_tree_decorator(function=None, **options):
+    """
+    Decorator which can be used both as "@decorator" and "@decorator(**options)"
+    """
+    if function is None:
+        return lambda func: _decorate_call_tree(func, **options)
+    return _decorate_call_tree(function, **options)
+
+
+_call_tree_decorator.title = _CallTreeSession.title
+
+
+def _profiler_decorator(backend_class):
+    """
+    Build a decorator which can be used both as "@decorator" and "@decorator(**options)"
+    :param backend_class: Class of the profiler backend
+    :return: Decorator
+    """
+    def decorator(function=None, **options):
+        if function is None:
+            return lambda func: _decorate(backend_class, func, **options)
+        return _decorate(backend_class, function, **options)
+
+    decorator.title = backend_class.title
+    return decorator
+
+
+class ProfileDecorators:
+    def __init__(self):
+        pass
+
+    cprofile_decorator = staticmethod(_profiler_decorator(_CProfileBackend))
+    pyinstrument_decorator = staticmethod(_profiler_decorator(_PyinstrumentBackend))
+    yappi_decorator = staticmethod(_profiler_decorator(_YappiBackend))
+    line_profiler_decorator = staticmethod(_profiler_decorator(_LineProfilerBackend))
+    memory_profiler_decorator = staticmethod(_profiler_decorator(_MemoryProfilerBackend))
+    tracemalloc_decorator = staticmethod(_profiler_decorator(_TracemallocBackend))
+    sampler_decorator = staticmethod(_profiler_decorator(_StackSamplerBackend))
+    latency_decorator = staticmethod(_latency_decorator)
+    call_tree_decorator = staticmethod(_call_tree_decorator)
+    block_timer = staticmethod(_block_timer)
+
+    @staticmethod
+    def flush():
+        """
+        Print reports of all sessions accumulated so far
+        :return: None
+        """
+        for session in _sessions:
+            session.flush()
+
+    @staticmethod
+    def reset():
+        """
+        Drop the statistics of all sessions accumulated so far without reporting them,
+        e.g. after a warm-up phase
+        :return: None
+        """
+        for session in _sessions:
+            session.reset()
+
+    @staticmethod
+    def enable():
+        """
+        Turn profiling of the decorated functions on
+        :return: None
+        """
+        global _enabled
+        _enabled = True
+
+    @staticmethod
+    def disable(flush=True):
+        """
+        Turn profiling of the decorated functions off, the wrappers only call the functions
+        :param flush: Report the statistics accumulated so far. Sessions of the calls which
+                      are still running are reported later
+        :return: None
+        """
+        global _enabled
+        _enabled = False
+        if flush:
+            ProfileDecorators.flush()
+
+    @staticmethod
+    def is_enabled():
+        return _enabled
+
+
+class _SignalFlusher(threading.Thread):
+    def __init__(self):
+        """
+        Daemon thread reporting the statistics when the profiling is stopped by the control
+        signal. The handler interrupts the main thread at any point, e.g. inside print(),
+        so it only wakes this thread up
+        """
+        super().__init__(name='decoProf control signal flusher', daemon=True)
+        self.requested = threading.Event()
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            ProfileDecorators.flush()
+
+
+def _control_signal_handler(signum, frame):
+    """
+    Start profiling on the first control signal, stop and report on the second one
+    :param signum: Signal number
+    :param frame: Interrupted frame
+    :return: None
+    """
+    if signum == _control_signals[0]:
+        ProfileDecorators.enable()
+    else:
+        ProfileDecorators.disable(flush=False)
+        _signal_flusher.requested.set()
+
+
+# Signals starting and stopping the profiling (None - not installed)
+_control_signals = None
+_signal_flusher = None
+
+
+def _start_signal_flusher():
+    """
+    :return: None
+    """
+    global _signal_flusher
+    _signal_flusher = _SignalFlusher()
+    _signal_flusher.start()
+
+
+def _install_control_signals(value):
+    """
+    Install the handlers of the control signals
+    :param value: "1" for SIGUSR1 and SIGUSR2, or the names of two signals separated by
+                  a comma, e.g. "SIGUSR1,SIGUSR2"
+    :return: None
+    """
+    global _control_signals
+    names = ('SIGUSR1', 'SIGUSR2') if ',' not in value else value.split(',')
+    try:
+        signals = tuple(getattr(signal, name.strip().upper()) for name in names)
+    except AttributeError:
+        raise ValueError('DECOPROF_SIGNALS should be "1" or the names of two signals, e.g. '
+                         '"SIGUSR1,SIGUSR2", not "%s"' % value)
+    if len(signals) != 2:
+        raise ValueError('DECOPROF_SIGNALS should contain the names of two signals, not "%s"'
+                         % value)
+    if threading.current_thread() is not threading.main_thread():
+        sys.stderr.write('Control signals can be installed only by the main thread\n')
+        return
+    _start_signal_flusher()
+    for signum in signals:
+        signal.signal(signum, _control_signal_handler)
+    _control_signals = signals
+
+
+class _ControlFileWatcher(threading.Thread):
+    def __init__(self, file_name, interval):
+        """
+        Daemon thread polling the control file. Its first word switches the profiling:
+        "on" (or "1") enables it, "off" (or "0") disables it and reports the statistics,
+        "flush" reports the statistics without disabling. A command is executed once, when
+        the file appears or its contents change
+        :param file_name: Path to the control file
+        :param interval: Polling interval in seconds
+        """
+        super().__init__(name='decoProf control file watcher', daemon=True)
+        self.file_name = file_name
+        self.interval = interval
+        self._command = None
+
+    def read_command(self):
+        """
+        :return: First word of the control file in lower case, None if there is no file
+        """
+        try:
+            with open(self.file_name) as file:
+                words = file.read().split()
+        except OSError:
+            return None
+        return words[0].lower() if words else ''
+
+    def run(self):
+        while True:
+            command = self.read_command()
+            if command != self._command:
+                self._command = command
+                if command in ('on', '1', 'enable'):
+                    ProfileDecorators.enable()
+                elif command in ('off', '0', 'disable'):
+                    ProfileDecorators.disable()
+                elif command == 'flush':
+                    ProfileDecorators.flush()
+            time.sleep(self.interval)
+
+
+_control_file_watcher = None
+
+
+def _start_control_file_watcher(file_name, interval):
+    """
+    :param file_name: Path to the control file
+    :param interval: Polling interval in seconds
+    :return: None
+    """
+    global _control_file_watcher
+    _control_file_watcher = _ControlFileWatcher(os.path.abspath(file_name), interval)
+    _control_file_watcher.start()
+
 
-        return profiler_wrapper
+atexit.register(ProfileDecorators.flush)
+os.register_at_fork(after_in_child=_reset_after_fork)
+if _env_switch(os.environ.get('DECOPROF_SIGNALS', '0')):
+    _install_control_signals(os.environ['DECOPROF_SIGNALS'])
+if os.environ.get('DECOPROF_CONTROL_FILE'):
+    _start_control_file_watcher(os.environ['DECOPROF_CONTROL_FILE'],
+                                float(os.environ.get('DECOPROF_CONTROL_INTERVAL', '1')))
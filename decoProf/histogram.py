@@ -0,0 +1,97 @@
+from array import array
+
+
+# Every power of two is split into 2 ** SUB_BUCKET_BITS buckets, so the relative error
+# of the recorded values doesn't exceed 1 / 2 ** SUB_BUCKET_BITS (6.25%)
+SUB_BUCKET_BITS = 4
+# Values below 2 ** EXACT_BITS have their own buckets
+EXACT_BITS = SUB_BUCKET_BITS + 1
+# Enough buckets for any 64-bit value
+N_BUCKETS = (64 - SUB_BUCKET_BITS + 1) << SUB_BUCKET_BITS
+
+
+def bucket_bounds(index):
+    """
+    :param index: Index of the bucket
+    :return: Tuple of the lowest and the highest values falling into the bucket
+    """
+    if index < 1 << EXACT_BITS:
+        return index, index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    low = (index & ((1 << SUB_BUCKET_BITS) - 1) | 1 << SUB_BUCKET_BITS) << shift
+    return low, low + (1 << shift) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        """
+        Histogram of durations in nanoseconds with a fixed memory footprint: an array of
+        N_BUCKETS counters (less than 8 KiB) regardless of the number of recorded values.
+        Only the counters are updated on recording, so the sum and the maximum of the
+        values are estimated from the buckets. Recording is not synchronized, concurrent
+        threads might rarely lose an increment
+        """
+        self.counts = array('Q', bytes(8 * N_BUCKETS))
+
+    def record(self, value):
+        """
+        Count the value in its bucket. Values below 2 ** EXACT_BITS have their own
+        buckets, larger ones are grouped logarithmically. Hot paths inline this code
+        :param value: Duration in nanoseconds
+        :return: None
+        """
+        if value < 1 << EXACT_BITS:
+            self.counts[value] += 1
+        else:
+            shift = value.bit_length() - EXACT_BITS
+            self.counts[(shift << SUB_BUCKET_BITS) + (value >> shift)] += 1
+
+    def count(self):
+        return sum(self.counts)
+
+    def total(self):
+        """
+        :return: Estimated sum of the recorded values (using the middles of the buckets)
+        """
+        return sum(sum(bucket_bounds(index)) * count // 2
+                   for index, count in enumerate(self.counts) if count)
+
+    def max(self):
+        """
+        :return: Highest value of the highest non-empty bucket, 0 if the histogram is empty
+        """
+        for index in range(N_BUCKETS - 1, -1, -1):
+            if self.counts[index]:
+                return bucket_bounds(index)[1]
+        return 0
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile of the recorded values
+        :param percent: Percentile in the range [0, 100], e.g. 99.9
+        :return: Highest value of the bucket containing the percentile, 0 if the histogram
+                 is empty
+        """
+        count = self.count()
+        if not count:
+            return 0
+        rank = max(1, -(-count * percent // 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket_bounds(index)[1]
+        return self.max()
+
+    def buckets(self):
+        """
+        :return: List of (lowest value, highest value, count) tuples of non-empty buckets
+        """
+        return [bucket_bounds(index) + (count,) for index, count in enumerate(self.counts) if count]
+
+    def clear(self):
+        """
+        Reset the counters. The array is reset in place, so references to it stay valid
+        :return: None
+        """
+        self.counts[:] = array('Q', bytes(8 * N_BUCKETS))
@@ -0,0 +1,237 @@
+import os
+import sys
+import ast
+import atexit
+import hashlib
+import marshal
+import importlib.abc
+import importlib.machinery
+import types
+import errno
+
+from decoProf.io_manager import IOManager
+from decoProf.core import Core
+from decoProf.name_index import QualifiedNameIndex
+from decoProf.info import PACKAGE_VERSION
+from decoProf.genericProfiler import ProfileDecorators
+
+
+class InjectingLoader(importlib.machinery.SourceFileLoader):
+    def __init__(self, fullname, path, injector):
+        """
+        Source loader which injects decorators into the module before compiling it
+        :param fullname: Full name of the module
+        :param path: Path to the source file
+        :param injector: ImportHook object performing the injection
+        """
+        super().__init__(fullname, path)
+        self._injector = injector
+
+    def get_code(self, fullname):
+        """
+        Compile the modified module. The regular bytecode cache is bypassed, otherwise
+        either the original bytecode would be loaded or the modified one would be cached
+        :param fullname: Full name of the module
+        :return: Code object
+        """
+        return self._injector.compile_module(self.name, self.path, self.get_data(self.path))
+
+    def set_data(self, path, data, *, _mode=0o666):
+        pass
+
+
+class InjectingFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, injector):
+        """
+        Meta path finder which replaces the loader of the modules containing profiled
+        functions with InjectingLoader
+        :param injector: ImportHook object performing the injection
+        """
+        self._injector = injector
+
+    def find_spec(self, fullname, path, target=None):
+        if not self._injector.is_candidate(fullname):
+            return None
+
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+        if spec is None or not isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+            return None
+
+        spec.loader = InjectingLoader(fullname, spec.origin, self._injector)
+        return spec
+
+
+class ImportHook:
+    def __init__(self):
+        """
+        :_io_man: Object of the IO manager
+        :_core: Object of the Core performing the AST transformations
+        :_targets: List of fully qualified names of the functions to be profiled
+        :_found_targets: Set of targets the decorator was injected into
+        :_use_cache: Use the cache of compiled modified modules
+        :_cache_dir: Directory of the cache
+        """
+        self._io_man = IOManager(debug=False)
+        self._core = Core(self._io_man)
+        self._targets = []
+        self._found_targets = set()
+        self._use_cache = True
+        self._cache_dir = ''
+
+    def module_targets(self, module_name):
+        """
+        Get the targets which might be defined in the module
+        :param module_name: Full name of the module
+        :return: Dictionary of target names and the corresponding qualified names
+                 inside the module
+        """
+        prefix = module_name + '.'
+        return {target: target[len(prefix):] for target in self._targets if target.startswith(prefix)}
+
+    def is_candidate(self, module_name):
+        """
+        Check if the module might contain targets
+        :param module_name: Full name of the module
+        :return: True if the module should be loaded by InjectingLoader
+        """
+        return bool(self.module_targets(module_name))
+
+    def cache_key(self, module_name, path, source, targets):
+        """
+        Assemble the cache key of the modified module. The cached code carries the
+        path and the found targets, so they are the part of the key too
+        :param module_name: Full name of the module
+        :param path: Path to the source file
+        :param source: Source of the module
+        :param targets: Dictionary of target names and the corresponding qualified names
+        :return: Hex digest
+        """
+        digest = hashlib.sha256(source)
+        digest.update(repr((module_name, os.path.abspath(path), sorted(targets.items()),
+                            self._core.decorator_name,
+                            sorted(self._core.decorator_options.items()),
+                            sys.version, PACKAGE_VERSION)).encode())
+        return digest.hexdigest()
+
+    def compile_module(self, module_name, path, source, aliases=()):
+        """
+        Inject decorators into the module source and compile it. Compiled modules are
+        cached using the hash of the source and the injection parameters as a key
+        :param module_name: Full name of the module
+        :param path: Path to the source file
+        :param source: Source of the module in bytes
+        :param aliases: Other names the module's targets might be specified with
+        :return: Code object
+        """
+        targets = self.module_targets(module_name)
+        for alias in aliases:
+            targets.update(self.module_targets(alias))
+        if not targets:
+            return compile(source, path, 'exec', dont_inherit=True)
+
+        cache_file_name = None
+        if self._use_cache:
+            cache_file_name = os.path.join(self._cache_dir,
+                                           self.cache_key(module_name, path, source, targets) + '.bin')
+            if os.path.isfile(cache_file_name):
+                with open(cache_file_name, 'rb') as cache_file:
+                    found_targets, code = marshal.load(cache_file)
+                self._found_targets.update(found_targets)
+                return code
+
+        src_tree = ast.parse(source, path)
+        index = QualifiedNameIndex(src_tree)
+        # Names which are not defined here might belong to a submodule of a package
+        targets = {target: name for target, name in targets.items()
+                   if self._core.split_block(name)[0] in index}
+
+        if targets:
+            self._core.file_name = path
+            self._core.function_name = sorted(set(targets.values()))
+            matches = self._core.inject_decorator(src_tree, index)
+            # Blocks which were not found in the function are reported as missing
+            targets = {target: name for target, name in targets.items()
+                       if self._core.split_block(name)[1] is None or matches[name]}
+            self._core.inject_import(src_tree)
+            ast.fix_missing_locations(src_tree)
+        code = compile(src_tree, path, 'exec', dont_inherit=True)
+        self._found_targets.update(targets)
+
+        if cache_file_name is not None:
+            # Write to a temporary file first, concurrent runs might read the cache
+            tmp_file_name = '%s.%d.tmp' % (cache_file_name, os.getpid())
+            with open(tmp_file_name, 'wb') as cache_file:
+                marshal.dump((tuple(targets), code), cache_file)
+            os.replace(tmp_file_name, cache_file_name)
+
+        return code
+
+    def report_missing_targets(self):
+        """
+        Print an error for every target which was not found in any of the imported modules
+        :return: None
+        """
+        for target in self._targets:
+            if target not in self._found_targets:
+                self._io_man.print_err_info(('Block "' if self._core.split_block(target)[1] else 'Function "')
+                                            + target + '" was not found in any of the imported modules')
+
+    def run_script(self, script, script_args):
+        """
+        Execute the script as the __main__ module
+        :param script: Path to the script
+        :param script_args: Arguments passed to the script
+        :return: None
+        """
+        if not os.path.isfile(script):
+            self._io_man.print_err_info('Can\'t find the script: ' + script)
+            exit(errno.EFAULT)
+
+        with open(script, 'rb') as file:
+            source = file.read()
+        script_module_name = os.path.splitext(os.path.basename(script))[0]
+        code = self.compile_module('__main__', script, source, aliases=(script_module_name,))
+
+        main_module = types.ModuleType('__main__')
+        main_module.__file__ = script
+
+        sys.argv = [script] + list(script_args)
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        sys.modules['__main__'] = main_module
+        exec(code, main_module.__dict__)
+
+    def run(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Install the import hook
+        3) Execute the script
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_run_cli(self._core.get_profiler_types(), argv)
+        self.profile([name.strip() for name in args.n.split(',')], args)
+
+    def profile(self, targets, args):
+        """
+        Install the import hook and execute the script
+        :param targets: List of fully qualified names of the functions to be profiled
+        :param args: Object of parsed arguments with the decorator options, the script
+                     and its arguments
+        :return: None
+        """
+        self._targets = targets
+        self._core.decorator_name = self._core.detect_prof_type(args)
+        self._core.decorator_options = self._core.detect_decorator_options(args)
+        self._use_cache = not args.no_cache
+        if self._use_cache:
+            self._cache_dir = self._io_man.get_cache_dir('modules')
+
+        sys.meta_path.insert(0, InjectingFinder(self))
+        # atexit runs the handlers in the reverse order of the registration. The reports
+        # are flushed by a handler registered when genericProfiler was imported, so it is
+        # registered again after the check of the targets to print the reports first
+        atexit.register(self.report_missing_targets)
+        atexit.unregister(ProfileDecorators.flush)
+        atexit.register(ProfileDecorators.flush)
+
+        self.run_script(args.script, args.script_args)
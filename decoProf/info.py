@@ -1,3 +1,7 @@
 PACKAGE_NAME = 'decoProf'
 PACKAGE_VERSION = '0.0.1'
 PACKAGE_HOMEPAGE = 'https://github.com/maxim-masterov/decoProf'
+
+# Name of the file in the working copy mapping the lines of the patched files to the
+# original ones, see IOManager.write_line_map
+LINE_MAP_FILE_NAME = '.decoProf_linemap.json'
@@ -4,14 +4,36 @@ import argparse
 import sys
 import shutil
 import errno
+import fnmatch
+import hashlib
+import json
+import re
 
 
-from decoProf.info import PACKAGE_NAME, PACKAGE_VERSION
+from decoProf.info import PACKAGE_NAME, PACKAGE_VERSION, LINE_MAP_FILE_NAME
+
+
+# Files and folders that are never copied into the working copy
+DEFAULT_IGNORE_PATTERNS = ['.git', '.hg', '.svn', '__pycache__', '*.pyc', '.venv', 'venv',
+                           '.tox', '.nox', '.mypy_cache', '.pytest_cache', '*.egg-info']
+
+# Name of the file with additional ignore patterns in the root of the project
+IGNORE_FILE_NAME = '.decoprofignore'
+
+# Name of the file in the working copy keeping track of the synced files
+MANIFEST_FILE_NAME = '.decoProf_manifest.json'
+
+LINK_MODES = ['copy', 'hardlink', 'symlink']
 
 
 class IOManager:
-    def __init__(self):
+    def __init__(self, debug=True):
+        """
+        :param debug: Print debug messages (only if Python is not run with -O)
+        """
         self._working_dir_name = ''
+        self._manifest = {}
+        self._debug = debug
 
     def get_working_dir_name(self):
         if not self._working_dir_name:
@@ -40,7 +62,7 @@ class IOManager:
         :return: None
         """
         msg_header = "== DEBUG =="
-        if __debug__:
+        if __debug__ and self._debug:
             self.print_msg_with_header(msg_header, msg)
 
     def print_err_info(self, msg):
@@ -71,10 +93,15 @@ class IOManager:
         """
         return os.path.exists(project_name)
 
-    def create_working_dir(self, project_name):
+    def create_working_dir(self, project_name, working_dir_name=None, keep=None):
         """
-        Create temporary directory with a unique name using a timestamp
+        Create temporary directory with a unique name using a timestamp, or reuse
+        an existing working directory
         :param project_name: Name of the project folder
+        :param working_dir_name: Name of a reusable working directory. If None, a new
+                                 directory with a timestamp in its name is created
+        :param keep: Number of the most recent timestamped working directories of the
+                     project to keep, older ones are removed. If None, nothing is removed
         :return: None
         """
         # Before creating the working copy - check if the project actually exists
@@ -82,17 +109,46 @@ class IOManager:
             self.print_err_info('Can\'t find the project folder: ' + project_name)
             exit(errno.EFAULT)
 
-        timestamp = str(time.time()).replace('.', '')
-        self.set_working_dir_name(os.path.basename(project_name) + "_" + timestamp)
+        if working_dir_name:
+            self.set_working_dir_name(working_dir_name)
+            if os.path.isdir(working_dir_name):
+                self.print_dbg_info('Reusing working directory: ' + working_dir_name)
+                return
+        else:
+            # Nanoseconds have a fixed number of digits, so the names sort chronologically
+            timestamp = str(time.time_ns())
+            self.set_working_dir_name(os.path.basename(project_name) + "_" + timestamp)
 
         self.print_dbg_info('Creating temporary directory: ' + self.get_working_dir_name())
 
         try:
             os.mkdir(self.get_working_dir_name())
         except OSError as err:
-            self.print_err_info('Can\'t create a working directory: ' + err)
+            self.print_err_info('Can\'t create a working directory: ' + str(err))
             exit(errno.EFAULT)
 
+        if keep is not None and not working_dir_name:
+            self.remove_old_working_dirs(project_name, keep)
+
+    def remove_old_working_dirs(self, project_name, keep):
+        """
+        Remove timestamped working directories of the project, except for the "keep"
+        most recent ones
+        :param project_name: Name of the project folder
+        :param keep: Number of directories to keep
+        :return: None
+        """
+        pattern = re.compile(re.escape(os.path.basename(project_name)) + r'_(\d+)$')
+        working_dirs = [name for name in os.listdir('.')
+                        if pattern.match(name) and os.path.isdir(name)]
+        # Timestamps of the names created by the older versions have a variable number of
+        # digits and don't sort chronologically, the directories are sorted by mtime
+        working_dirs.sort(key=os.path.getmtime, reverse=True)
+
+        for name in working_dirs[max(keep, 1):]:
+            self.print_dbg_info('Removing old working directory: ' + name)
+            shutil.rmtree(name, ignore_errors=True)
+
     def check_arg_existence(self, arg, arg_name, parser):
         """
         Check existence of a mandatory argument. Throw an error and exit if argument
@@ -107,6 +163,213 @@ class IOManager:
             parser.print_help()
             exit(errno.EFAULT)
 
+    def add_decorator_arguments(self, parser, profiler_keys):
+        """
+        Add arguments defining the injected decorator to the parser
+        :param parser: Parser object
+        :param profiler_keys: Known profiler types
+        :return: None
+        """
+        parser.add_argument('-t', metavar='<profiler type>', type=str,
+                            help='Type of the profiler to be used '
+                                 '(available options: '
+                                 + ', '.join(profiler_keys) + ').')
+        parser.add_argument('-s', metavar='<session mode>', type=str, default='call',
+                            choices=['call', 'function', 'process'],
+                            help='Scope of the profiler session (available options: call, '
+                                 'function, process). "call" creates a new profiler and prints '
+                                 'a report on every call, "function" accumulates statistics '
+                                 'over all calls of the decorated function, "process" shares '
+                                 'one profiler between all decorated functions. Accumulated '
+                                 'reports are printed at exit.')
+        parser.add_argument('--flush-every', metavar='<number of calls>', type=int, default=0,
+                            help='Print an intermediate report every N calls in "function" '
+                                 'and "process" session modes.')
+        parser.add_argument('-o', metavar='<output directory>', type=str, default=None,
+                            help='Write the profiler results into files in the given directory '
+                                 'instead of printing them. File names contain the function '
+                                 'name, the host name and the process ID.')
+        parser.add_argument('--sample-every', metavar='<N>', type=int, default=1,
+                            help='Profile only every N-th call of the decorated function.')
+        parser.add_argument('--sample-rate', metavar='<fraction>', type=float, default=1.0,
+                            help='Profile only a random fraction of calls, e.g. 0.01.')
+        parser.add_argument('--sample-budget', metavar='<seconds>', type=float, default=None,
+                            help='Stop profiling after the given number of seconds was spent '
+                                 'in profiled calls. Later calls are not profiled.')
+        parser.add_argument('--subtract-overhead', action='store_true',
+                            help='Subtract the overhead of the profiler calibrated by '
+                                 '"' + PACKAGE_NAME + ' bench --save-calibration" from the '
+                                 'reported time.')
+        parser.add_argument('--calibration', metavar='<calibration file>', type=str, default=None,
+                            help='Calibration file used by --subtract-overhead. The default '
+                                 'one is stored in the cache directory.')
+        parser.add_argument('--clock', metavar='<clock type>', type=str, default=None,
+                            choices=['cpu', 'wall'],
+                            help='Clock of the "thread" (yappi) profiler and of the "sample" '
+                                 'profiler (available options: cpu, wall). The default is cpu.')
+        parser.add_argument('--context', metavar='<context type>', type=str, default=None,
+                            choices=['thread', 'greenlet'],
+                            help='Execution contexts tracked by the "thread" (yappi) profiler '
+                                 '(available options: thread, greenlet). The default is thread.')
+        parser.add_argument('--traceback-depth', metavar='<N>', type=int, default=None,
+                            help='Number of frames stored for every allocation by the "alloc" '
+                                 '(tracemalloc) profiler. With more than one frame, allocations '
+                                 'are grouped by tracebacks instead of lines. The default is 1.')
+        parser.add_argument('--top', metavar='<N>', type=int, default=None,
+                            help='Number of allocation sites reported by the "alloc" '
+                                 '(tracemalloc) profiler (the default is 10) or of functions '
+                                 'reported by the "sample" profiler (the default is 20).')
+        parser.add_argument('--frequency', metavar='<Hz>', type=float, default=None,
+                            help='Sampling frequency of the "sample" profiler, samples per '
+                                 'second of the clock. The default is 1000.')
+        parser.add_argument('--max-stacks', metavar='<N>', type=int, default=None,
+                            help='Number of distinct stacks kept by the "sample" profiler, '
+                                 'samples of further stacks are dropped. The default is 10000.')
+        parser.add_argument('--follow-threads', action='store_true', default=None,
+                            help='Profile the threads started and the tasks submitted to '
+                                 'thread pools by the calls of the "cpu" (cProfile) profiler as '
+                                 'well, and report the time of every thread.')
+
+    def check_callee_depth(self, args):
+        """
+        Check that the callees can be found and timed. The "call_tree" profiler type is
+        selected if the type was not specified. Throw an error and exit otherwise
+        :param args: Object of parsed arguments
+        :return: None
+        """
+        if args.callee_depth < 0:
+            self.print_err_info('--callee-depth should not be negative')
+            exit(errno.EFAULT)
+        if args.no_call_graph:
+            self.print_err_info('--callee-depth requires the call graph')
+            exit(errno.EFAULT)
+        if args.t is None:
+            args.t = 'call_tree'
+        elif args.t != 'call_tree':
+            self.print_err_info('--callee-depth is supported only by the "call_tree" profiler')
+            exit(errno.EFAULT)
+
+    def check_profiler_type(self, args, profiler_keys):
+        """
+        Set the default profiler type if it was not specified and check that it is known
+        and supports the given options.
+        Throw an error and exit otherwise
+        :param args: Object of parsed arguments
+        :param profiler_keys: Known profiler types
+        :return: None
+        """
+        if args.t is None:
+            args.t = "cpu"
+
+        if args.t not in profiler_keys:
+            self.print_err_info('Unknown profiler type. Available options: '
+                                + ', '.join(profiler_keys))
+            exit(errno.EFAULT)
+
+        # Options specific to some profiler types
+        for option, profiler_types in (('clock', ('thread', 'sample')), ('context', ('thread',)),
+                                       ('traceback_depth', ('alloc',)), ('top', ('alloc', 'sample')),
+                                       ('frequency', ('sample',)), ('max_stacks', ('sample',)),
+                                       ('follow_threads', ('cpu',))):
+            if getattr(args, option) is not None and args.t not in profiler_types:
+                self.print_err_info('--' + option.replace('_', '-') + ' is supported only by the "'
+                                    + '", "'.join(profiler_types)
+                                    + ('" profilers' if len(profiler_types) > 1 else '" profiler'))
+                exit(errno.EFAULT)
+
+        # The latency histogram is always accumulated per function and records every call,
+        # the call tree is shared by all functions of the process
+        if args.t in ('latency', 'call_tree') and (args.s != 'call' or args.flush_every
+                                                   or args.sample_every != 1
+                                                   or args.sample_rate != 1.0
+                                                   or args.sample_budget is not None):
+            self.print_err_info('Sessions, intermediate reports and sampling are not supported '
+                                'by the "' + args.t + '" profiler')
+            exit(errno.EFAULT)
+        if args.t == 'call_tree' and (args.subtract_overhead or args.calibration is not None):
+            self.print_err_info('--subtract-overhead is not supported by the "call_tree" profiler')
+            exit(errno.EFAULT)
+
+    def add_injection_arguments(self, parser, profiler_keys):
+        """
+        Add arguments defining the project, the target functions and the injected
+        decorator to the parser
+        :param parser: Parser object
+        :param profiler_keys: Known profiler types
+        :return: None
+        """
+        parser.add_argument('-f', metavar='<filename>', type=str,
+                            help='Specify the file name. If not specified, functions are looked '
+                                 'for in all files of the project.')
+        parser.add_argument('-p', metavar='<project name>', type=str,
+                            help='Specify the project name.')
+        parser.add_argument('-n', metavar='<function name>', type=str,
+                            help='Function name to be analyzed. If the function is an inner '
+                                 'function or a class member, the name of the corresponding '
+                                 'outer function or class should be prepended to the function '
+                                 'name and separated by the dot, e.g. "-n foo.bar" or '
+                                 '"-n Outer.Inner.method". Several comma-separated names can '
+                                 'be specified. Names can be glob patterns, e.g. "-n Vector.*", '
+                                 'and can be prefixed by a file pattern relative to the project '
+                                 'folder, e.g. "-n subfolder/*.py:dot*". A block of a function '
+                                 'is timed if a line range or a loop is appended, e.g. '
+                                 '"-n main@12-20" or "-n main@for#2".')
+        parser.add_argument('--regex', action='store_true',
+                            help='Treat function name patterns as regular expressions.')
+        parser.add_argument('-j', metavar='<number of processes>', type=int, default=None,
+                            help='Number of processes used to inject decorators into multiple '
+                                 'files (default: number of CPUs).')
+        parser.add_argument('-w', metavar='<working directory>', type=str,
+                            help='Reuse the given working directory. Only the files changed '
+                                 'since the previous run are synced into it. By default, a new '
+                                 'working directory with a timestamp in its name is created.')
+        parser.add_argument('--link', metavar='<link mode>', type=str, default='copy',
+                            choices=LINK_MODES,
+                            help='How unmodified files are placed into the working directory '
+                                 '(available options: ' + ', '.join(LINK_MODES) + '). Hard '
+                                 'links share the content with the original files.')
+        parser.add_argument('--ignore', metavar='<pattern>', type=str, action='append',
+                            default=[],
+                            help='Pattern of files and folders which should not be copied '
+                                 'into the working directory. Can be repeated. Patterns are '
+                                 'also read from the "' + IGNORE_FILE_NAME + '" file in the '
+                                 'project folder.')
+        parser.add_argument('--keep', metavar='<N>', type=int, default=None,
+                            help='Keep only N most recent timestamped working directories of '
+                                 'the project, older ones are removed.')
+        parser.add_argument('--no-call-graph', action='store_true',
+                            help='Skip the generation of the call graph.')
+        parser.add_argument('--callee-depth', metavar='<N>', type=int, default=None,
+                            help='Inject timing decorators (the "call_tree" profiler type) into '
+                                 'the functions and their callees found in the call graph up to '
+                                 'N calls away, and report the time of every call edge.')
+        self.add_decorator_arguments(parser, profiler_keys)
+
+    def check_injection_arguments(self, args, parser, profiler_keys):
+        """
+        Check the arguments added by add_injection_arguments. Throw an error and exit if
+        they are not correct
+        :param args: Object of parsed arguments
+        :param parser: Parser object
+        :param profiler_keys: Known profiler types
+        :return: None
+        """
+        # The filename is optional, other CLI arguments are mandatory
+        self.check_arg_existence(args.p, 'Project name', parser)
+        self.check_arg_existence(args.n, 'Function name', parser)
+        # check_arg_existence(args.t, 'Profiler type', parser)
+        if args.callee_depth is not None:
+            self.check_callee_depth(args)
+        # Set default profiler type if it was not specified and check that it is known
+        self.check_profiler_type(args, profiler_keys)
+
+        # Print some debug info
+        self.print_dbg_info('Filename: \t' + str(args.f))
+        self.print_dbg_info('Project name: \t' + str(args.p))
+        self.print_dbg_info('Function name: \t' + str(args.n))
+        self.print_dbg_info('Profiler type: \t' + str(args.t))
+        self.print_dbg_info('Session mode: \t' + str(args.s))
+
     def parse_cli(self, known_profiler_types):
         """
         Parse CLI arguments passed to this script and check for their correctness.
@@ -120,44 +383,12 @@ class IOManager:
         parser.add_argument('-v', '--version', action='version',
                             version=str(PACKAGE_VERSION),
                             help='Print version of the package.')
-        parser.add_argument('-f', metavar='<filename>', type=str,
-                            help='Specify the file name.')
-        parser.add_argument('-p', metavar='<project name>', type=str,
-                            help='Specify the project name.')
-        parser.add_argument('-n', metavar='<function name>', type=str,
-                            help='Function name to be analyzed. If the function is an inner '
-                                 'function or a class member, the name of the corresponding '
-                                 'outer function or class should be prepended to the function '
-                                 'name and separated by the dot, e.g. "-n foo.bar".')
-        parser.add_argument('-t', metavar='<profiler type>', type=str,
-                            help='Type of the profiler to be used '
-                                 '(available options: '
-                                 + ', '.join(profiler_keys) + ').')
+        self.add_injection_arguments(parser, profiler_keys)
 
         # Check if we have enough arguments, otherwise print an error and the help message
         if len(sys.argv) > 1:
             args = parser.parse_args()
-
-            # All CLI arguments are mandatory
-            self.check_arg_existence(args.f, 'Filename', parser)
-            self.check_arg_existence(args.p, 'Project name', parser)
-            self.check_arg_existence(args.n, 'Function name', parser)
-            # check_arg_existence(args.t, 'Profiler type', parser)
-            # Set default profiler type if it was not specified
-            if args.t is None:
-                args.t = "cpu"
-
-            # Print some debug info
-            self.print_dbg_info('Filename: \t' + str(args.f))
-            self.print_dbg_info('Project name: \t' + str(args.p))
-            self.print_dbg_info('Function name: \t' + str(args.n))
-            self.print_dbg_info('Profiler type: \t' + str(args.t))
-
-            # Check that the profiler type is knowns
-            if args.t not in profiler_keys:
-                self.print_err_info('Unknown profiler type. Available options: '
-                                    + ', '.join(profiler_keys))
-                exit(errno.EFAULT)
+            self.check_injection_arguments(args, parser, profiler_keys)
         else:
             self.print_err_info('No CLI arguments passed.')
             parser.print_help()
@@ -165,12 +396,557 @@ class IOManager:
 
         return args
 
-    def make_working_copy_of_project(self, src_dir_name):
+    def parse_watch_cli(self, known_profiler_types, argv):
+        """
+        Parse CLI arguments of the "watch" command, which keeps the working copy in sync
+        with the project and re-injects the decorators into the changed files
+        :param known_profiler_types: Dictionary of profiler types
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
+        """
+        profiler_keys = known_profiler_types.keys()
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' watch',
+                                         description='Inject the decorators into a working copy '
+                                                     'and update it whenever the project '
+                                                     'changes.')
+        self.add_injection_arguments(parser, profiler_keys)
+        parser.add_argument('--interval', metavar='<seconds>', type=float, default=0.5,
+                            help='How often the project is checked for changes (default: 0.5).')
+        parser.add_argument('--exec', metavar='<command>', type=str, default=None,
+                            help='Shell command executed in the working directory after every '
+                                 'update, e.g. "python3 main.py".')
+
+        args = parser.parse_args(argv)
+        self.check_injection_arguments(args, parser, profiler_keys)
+        if args.interval <= 0:
+            self.print_err_info('--interval should be positive')
+            exit(errno.EFAULT)
+
+        return args
+
+    def parse_run_cli(self, known_profiler_types, argv):
+        """
+        Parse CLI arguments of the "run" command, which executes a script with decorators
+        injected at import time
+        :param known_profiler_types: Dictionary of profiler types
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
+        """
+        profiler_keys = known_profiler_types.keys()
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' run',
+                                         usage='%(prog)s [options] <script> [script arguments]',
+                                         description='Run a script injecting decorators into '
+                                                     'the modules at import time.')
+        parser.add_argument('-n', metavar='<function name>', type=str,
+                            help='Comma-separated list of fully qualified function names '
+                                 'including the module name, e.g. "-n subfolder.dot.dot". '
+                                 'Functions defined in the script itself can be prefixed with '
+                                 'the script name or with "__main__".')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Don\'t use the cache of compiled modified modules.')
+        self.add_decorator_arguments(parser, profiler_keys)
+        parser.add_argument('script', metavar='<script>', type=str,
+                            help='Python script to be executed.')
+        parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                            help='Arguments passed to the script.')
+
+        args = parser.parse_args(argv)
+        self.check_arg_existence(args.n, 'Function name', parser)
+        self.check_profiler_type(args, profiler_keys)
+
+        return args
+
+    def parse_auto_cli(self, known_profiler_types, argv):
+        """
+        Parse CLI arguments of the "auto" command, which finds the hottest functions of a
+        script with a sampling pass and profiles them in the second run
+        :param known_profiler_types: Dictionary of profiler types
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
+        """
+        profiler_keys = known_profiler_types.keys()
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' auto',
+                                         usage='%(prog)s [options] <script> [script arguments]',
+                                         description='Find the hottest functions of a script by '
+                                                     'sampling it, then run it again injecting '
+                                                     'decorators into them.')
+        parser.add_argument('-p', metavar='<project folder>', type=str, default=None,
+                            help='Only functions of the files in this folder are ranked, module '
+                                 'names are relative to it (default: the folder of the script).')
+        parser.add_argument('-k', metavar='<N>', type=int, default=5,
+                            help='Number of the hottest functions to be profiled (default: 5).')
+        parser.add_argument('--rank', metavar='<time>', type=str, default='self',
+                            choices=['self', 'total'],
+                            help='Rank the functions by their own time ("self", default) or '
+                                 'including the functions they call ("total").')
+        parser.add_argument('--sampling-frequency', metavar='<Hz>',
+                            type=float, default=1000,
+                            help='Frequency of the sampling pass (default: 1000).')
+        parser.add_argument('--sampling-clock', metavar='<clock type>', type=str,
+                            default='cpu', choices=['cpu', 'wall'],
+                            help='Clock of the sampling pass (available options: cpu, wall).')
+        parser.add_argument('--no-cache', action='store_true',
+                            help='Don\'t use the cache of compiled modified modules.')
+        self.add_decorator_arguments(parser, profiler_keys)
+        parser.add_argument('script', metavar='<script>', type=str,
+                            help='Python script to be executed.')
+        parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                            help='Arguments passed to the script.')
+
+        args = parser.parse_args(argv)
+        if args.k < 1:
+            self.print_err_info('-k should be positive')
+            exit(errno.EFAULT)
+        self.check_profiler_type(args, profiler_keys)
+
+        return args
+
+    def parse_merge_cli(self, argv):
+        """
+        Parse CLI arguments of the "merge" command, which aggregates the results written
+        by several processes or MPI ranks
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
         """
-        Copy source files to the working directory
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' merge',
+                                         description='Aggregate the profiler output files of '
+                                                     'several processes or MPI ranks.')
+        parser.add_argument('-o', metavar='<output directory>', type=str,
+                            help='Combine the profiles of all processes and write them into '
+                                 'the directory (cProfile, yappi and pyinstrument).')
+        parser.add_argument('--processes', action='store_true',
+                            help='Print the profiled time of every process.')
+        parser.add_argument('dirs', metavar='<directory>', nargs='+',
+                            help='Output directories of the profiled runs.')
+
+        return parser.parse_args(argv)
+
+    def parse_bench_cli(self, known_profiler_types, argv):
+        """
+        Parse CLI arguments of the "bench" command, which measures the overhead of the
+        profilers
+        :param known_profiler_types: Dictionary of profiler types
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments. "t" is converted into a list of types
+        """
+        profiler_keys = list(known_profiler_types.keys())
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' bench',
+                                         description='Measure the overhead of the profilers on '
+                                                     'synthetic kernels and on the examples.')
+        parser.add_argument('-p', metavar='<examples folder>', type=str, default=None,
+                            help='Folder with the examples of the repository. If given, the '
+                                 'functions of the examples are measured as well.')
+        parser.add_argument('-t', metavar='<profiler types>', type=str,
+                            default=','.join(profiler_keys),
+                            help='Comma-separated list of profiler types to be measured '
+                                 '(default: all of them).')
+        parser.add_argument('-s', metavar='<session mode>', type=str, default='function',
+                            choices=['call', 'function', 'process'],
+                            help='Session mode of the decorators (default: function).')
+        parser.add_argument('--budget', metavar='<seconds>', type=float, default=0.2,
+                            help='Minimum duration of a single measurement.')
+        parser.add_argument('--repeat', metavar='<N>', type=int, default=3,
+                            help='Number of measurements, the fastest one is reported.')
+        parser.add_argument('--save-calibration', metavar='<calibration file>', type=str,
+                            nargs='?', const='', default=None,
+                            help='Save the overhead per call of every profiler, so it can be '
+                                 'subtracted from the reported time (--subtract-overhead). '
+                                 'The default file is stored in the cache directory.')
+        parser.add_argument('--import-time', action='store_true',
+                            help='Measure the startup cost of an instrumented program instead: '
+                                 'the import of the decorators and the loading of every '
+                                 'profiler in a fresh interpreter.')
+
+        args = parser.parse_args(argv)
+        args.t = [name.strip() for name in args.t.split(',')]
+        for name in args.t:
+            if name not in profiler_keys:
+                self.print_err_info('Unknown profiler type "' + name + '". Available options: '
+                                    + ', '.join(profiler_keys))
+                exit(errno.EFAULT)
+
+        return args
+
+    def parse_ingest_cli(self, argv):
+        """
+        Parse CLI arguments of the "ingest" command, which saves the summaries of the
+        profiled runs in the local profile store
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
+        """
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' ingest',
+                                         description='Save the profiler summaries of a run in '
+                                                     'the local profile store.')
+        parser.add_argument('--db', metavar='<store file>', type=str, default=None,
+                            help='SQLite file of the store. The default file is stored in the '
+                                 'cache directory.')
+        parser.add_argument('--project', metavar='<name>', type=str, default=None,
+                            help='Project name (default: name of the git repository).')
+        parser.add_argument('--revision', metavar='<revision>', type=str, default=None,
+                            help='Revision of the project (default: the current git commit, '
+                                 'with "-dirty" if there are uncommitted changes).')
+        parser.add_argument('--label', metavar='<text>', type=str, default=None,
+                            help='Description of the run, e.g. the machine or the input.')
+        parser.add_argument('dirs', metavar='<directory>', nargs='+',
+                            help='Output directories of the profiled run (-o).')
+
+        return parser.parse_args(argv)
+
+    def parse_compare_cli(self, argv):
+        """
+        Parse CLI arguments of the "compare" command, which reports the change of the time
+        per call between two revisions stored by "ingest"
+        :param argv: List of CLI arguments following the command name
+        :return: Object of parsed arguments.
+        """
+        parser = argparse.ArgumentParser(prog=PACKAGE_NAME + ' compare',
+                                         description='Compare the time per call of the profiled '
+                                                     'functions in two revisions and fail if '
+                                                     'one of them got slower.')
+        parser.add_argument('--db', metavar='<store file>', type=str, default=None,
+                            help='SQLite file of the store. The default file is stored in the '
+                                 'cache directory.')
+        parser.add_argument('--project', metavar='<name>', type=str, default=None,
+                            help='Project name (default: name of the git repository).')
+        parser.add_argument('-n', metavar='<function names>', type=str, default=None,
+                            help='Comma-separated list of function names to be compared, '
+                                 'glob patterns are accepted (default: all of them).')
+        parser.add_argument('-t', metavar='<profiler>', type=str, default=None,
+                            help='Compare the results of this profiler only, e.g. cProfile '
+                                 'or latency (default: all of them).')
+        parser.add_argument('--threshold', metavar='<fraction>', type=float, default=0.05,
+                            help='Minimum relative change of the time per call reported as a '
+                                 'regression or an improvement (default: 0.05).')
+        parser.add_argument('--sigma', metavar='<N>', type=float, default=2.0,
+                            help='The change should also exceed N standard errors estimated '
+                                 'from the runs of each revision (default: 2).')
+        parser.add_argument('--all', action='store_true',
+                            help='Print the functions which did not change as well.')
+        parser.add_argument('base', metavar='<base revision>',
+                            help='Revision to compare with, a prefix is accepted.')
+        parser.add_argument('new', metavar='<new revision>', nargs='?', default=None,
+                            help='Revision to be checked (default: the most recently '
+                                 'ingested one).')
+
+        args = parser.parse_args(argv)
+        if args.threshold < 0 or args.sigma < 0:
+            self.print_err_info('--threshold and --sigma should not be negative')
+            exit(errno.EFAULT)
+
+        return args
+
+    def get_store_file_name(self):
+        """
+        :return: Path to the default file of the profile store
+        """
+        return os.path.join(self.get_cache_dir(), 'profiles.sqlite')
+
+    def get_calibration_file_name(self):
+        """
+        :return: Path to the default calibration file of the profilers' overhead
+        """
+        return os.path.join(self.get_cache_dir(), 'calibration.json')
+
+    def get_cache_dir(self, *sub_dirs):
+        """
+        Get the directory for cached data and create it if needed. The location can be
+        overridden by the DECOPROF_CACHE_DIR environment variable
+        :param sub_dirs: Names of subdirectories inside the cache directory
+        :return: Path to the directory
+        """
+        cache_dir = os.environ.get('DECOPROF_CACHE_DIR')
+        if not cache_dir:
+            cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                                    os.path.join(os.path.expanduser('~'), '.cache')),
+                                     PACKAGE_NAME)
+        cache_dir = os.path.join(cache_dir, *sub_dirs)
+        os.makedirs(cache_dir, exist_ok=True)
+        return cache_dir
+
+    def read_ignore_patterns(self, src_dir_name, extra_patterns=None):
+        """
+        Assemble the list of ignore patterns from the defaults, the ".decoprofignore"
+        file in the project folder and the user-defined patterns
+        :param src_dir_name: Path to the directory with source files
+        :param extra_patterns: List of user-defined patterns
+        :return: List of patterns
+        """
+        patterns = DEFAULT_IGNORE_PATTERNS + list(extra_patterns or [])
+
+        ignore_file_name = os.path.join(src_dir_name, IGNORE_FILE_NAME)
+        if os.path.isfile(ignore_file_name):
+            with open(ignore_file_name) as ignore_file:
+                for line in ignore_file:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        patterns.append(line.rstrip('/'))
+
+        return patterns
+
+    def is_ignored(self, rel_path, patterns):
+        """
+        Check if the path matches one of the ignore patterns. Patterns are matched
+        against the base name and against the path relative to the project folder
+        :param rel_path: Path relative to the project folder
+        :param patterns: List of patterns
+        :return: True if the path should be ignored, False otherwise
+        """
+        rel_path = rel_path.replace(os.sep, '/')
+        name = os.path.basename(rel_path)
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern)
+                   for pattern in patterns)
+
+    def read_manifest(self):
+        """
+        Read the manifest of the files synced into the working directory
+        :return: None
+        """
+        self._manifest = {}
+        manifest_name = os.path.join(self.get_working_dir_name(), MANIFEST_FILE_NAME)
+        if os.path.isfile(manifest_name):
+            with open(manifest_name) as manifest_file:
+                self._manifest = json.load(manifest_file)
+
+    def write_manifest(self):
+        """
+        Write the manifest of the files synced into the working directory
+        :return: None
+        """
+        manifest_name = os.path.join(self.get_working_dir_name(), MANIFEST_FILE_NAME)
+        self.write_to_file(manifest_name, json.dumps(self._manifest))
+
+    def write_line_map(self, line_map):
+        """
+        Write the map of the lines inserted into the files of the working copy. The
+        profilers use it to report the lines of the original files
+        :param line_map: Dictionary of the paths relative to the working directory and
+                         the dictionaries with the path to the original file ("source")
+                         and the sorted list of the inserted lines ("inserted")
+        :return: None
+        """
+        file_name = os.path.join(self.get_working_dir_name(), LINE_MAP_FILE_NAME)
+        self.write_to_file(file_name, json.dumps(line_map))
+
+    def file_hash(self, file_name):
+        """
+        Compute the hash of the file content
+        :param file_name: Filename
+        :return: Hex digest of the content
+        """
+        digest = hashlib.sha1()
+        with open(file_name, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_up_to_date(self, src_name, dst_name, entry, src_stat, link_mode):
+        """
+        Check if the file in the working copy corresponds to the original file
+        :param src_name: Path to the original file
+        :param dst_name: Path to the file in the working copy
+        :param entry: Manifest entry of the file, or None
+        :param src_stat: Result of os.stat() of the original file
+        :param link_mode: Requested sync mode: "copy", "hardlink" or "symlink"
+        :return: True if the file doesn't need to be synced again
+        """
+        if entry is None or entry.get('rewritten') or entry['requested'] != link_mode \
+                or not os.path.lexists(dst_name):
+            return False
+
+        # Mode which was actually used, links might have fallen back to copies
+        if entry['mode'] == 'hardlink':
+            return os.path.samefile(src_name, dst_name)
+        if entry['mode'] == 'symlink':
+            return os.path.islink(dst_name) and os.readlink(dst_name) == os.path.abspath(src_name)
+
+        if entry['size'] != src_stat.st_size:
+            return False
+        if entry['mtime'] == src_stat.st_mtime_ns:
+            return True
+        # The file was touched, but the content might still be the same
+        return self.file_hash(src_name) == self.file_hash(dst_name)
+
+    def sync_file(self, src_name, dst_name, link_mode):
+        """
+        Copy or link a single file into the working copy
+        :param src_name: Path to the original file
+        :param dst_name: Path to the file in the working copy
+        :param link_mode: "copy", "hardlink" or "symlink"
+        :return: Mode that was actually used
+        """
+        if os.path.lexists(dst_name):
+            os.remove(dst_name)
+
+        # Python resolves symlinks of the executed script, so the directory of a symlinked
+        # script would point back to the original sources. Python files are always copied
+        if link_mode == 'symlink' and not src_name.endswith('.py'):
+            os.symlink(os.path.abspath(src_name), dst_name)
+            return link_mode
+        if link_mode == 'hardlink':
+            try:
+                os.link(src_name, dst_name)
+                return link_mode
+            except OSError as err:
+                self.print_dbg_info('Can\'t create a hard link, copying instead: ' + str(err))
+
+        shutil.copy2(src_name, dst_name)
+        return 'copy'
+
+    def make_working_copy_of_project(self, src_dir_name, ignore_patterns=None, link_mode='copy'):
+        """
+        Incrementally sync source files into the working directory. Files which didn't
+        change since the last sync are skipped, files removed from the project are removed
+        from the working copy
         :param src_dir_name: Path to the directory with source files
+        :param ignore_patterns: List of additional patterns of files to be ignored
+        :param link_mode: "copy" - copy files,
+                          "hardlink" - hard link files to the originals,
+                          "symlink" - symlink non-Python files to the originals
+        :return: None
+        """
+        working_dir_name = self.get_working_dir_name()
+        self.print_dbg_info('Syncing sources to the working directory: ' + src_dir_name
+                            + ' --> ' + working_dir_name)
+
+        patterns = self.read_ignore_patterns(src_dir_name, ignore_patterns)
+        # Don't copy the working directory into itself if it is located inside the project
+        abs_working_dir_name = os.path.abspath(working_dir_name)
+
+        self.read_manifest()
+        synced_files = set()
+        n_updated = 0
+
+        for root, dir_names, file_names in os.walk(src_dir_name):
+            rel_root = os.path.relpath(root, src_dir_name)
+            if rel_root == '.':
+                rel_root = ''
+
+            dir_names[:] = [name for name in dir_names
+                            if not self.is_ignored(os.path.join(rel_root, name), patterns)
+                            and os.path.abspath(os.path.join(root, name)) != abs_working_dir_name]
+            os.makedirs(os.path.join(working_dir_name, rel_root), exist_ok=True)
+
+            for name in file_names:
+                rel_path = os.path.join(rel_root, name)
+                if self.is_ignored(rel_path, patterns):
+                    continue
+
+                src_name = os.path.join(root, name)
+                dst_name = os.path.join(working_dir_name, rel_path)
+                src_stat = os.stat(src_name)
+                synced_files.add(rel_path)
+
+                if self.is_up_to_date(src_name, dst_name, self._manifest.get(rel_path),
+                                      src_stat, link_mode):
+                    continue
+
+                mode = self.sync_file(src_name, dst_name, link_mode)
+                self._manifest[rel_path] = {'size': src_stat.st_size,
+                                            'mtime': src_stat.st_mtime_ns,
+                                            'requested': link_mode,
+                                            'mode': mode}
+                n_updated += 1
+
+        # Remove files which no longer exist in the project
+        for rel_path in set(self._manifest) - synced_files:
+            dst_name = os.path.join(working_dir_name, rel_path)
+            if os.path.lexists(dst_name):
+                os.remove(dst_name)
+            del self._manifest[rel_path]
+
+        self.write_manifest()
+        self.print_dbg_info('Files updated in the working directory: %d of %d'
+                            % (n_updated, len(synced_files)))
+
+    def scan_project(self, src_dir_name, ignore_patterns=None):
+        """
+        Collect the files of the project which are synced into the working directory
+        :param src_dir_name: Path to the directory with source files
+        :param ignore_patterns: List of additional patterns of files to be ignored
+        :return: Dictionary of paths relative to the project folder and (mtime, size) tuples
+        """
+        patterns = self.read_ignore_patterns(src_dir_name, ignore_patterns)
+        abs_working_dir_name = os.path.abspath(self.get_working_dir_name())
+        files = {}
+
+        for root, dir_names, file_names in os.walk(src_dir_name):
+            rel_root = os.path.relpath(root, src_dir_name)
+            if rel_root == '.':
+                rel_root = ''
+
+            dir_names[:] = [name for name in dir_names
+                            if not self.is_ignored(os.path.join(rel_root, name), patterns)
+                            and os.path.abspath(os.path.join(root, name)) != abs_working_dir_name]
+            for name in file_names:
+                rel_path = os.path.join(rel_root, name)
+                if self.is_ignored(rel_path, patterns):
+                    continue
+                try:
+                    src_stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    # The file was removed while walking the tree
+                    continue
+                files[rel_path] = (src_stat.st_mtime_ns, src_stat.st_size)
+
+        return files
+
+    def sync_project_file(self, src_dir_name, rel_path, link_mode='copy'):
+        """
+        Sync a single file of the project into the working directory, or remove it from
+        the working directory if it no longer exists in the project. The manifest is
+        updated, but not written (see write_manifest)
+        :param src_dir_name: Path to the directory with source files
+        :param rel_path: Path to the file relative to the project folder
+        :param link_mode: "copy", "hardlink" or "symlink"
+        :return: True if the file exists in the project
+        """
+        src_name = os.path.join(src_dir_name, rel_path)
+        dst_name = os.path.join(self.get_working_dir_name(), rel_path)
+        if not os.path.isfile(src_name):
+            if os.path.lexists(dst_name):
+                os.remove(dst_name)
+            self._manifest.pop(rel_path, None)
+            return False
+
+        os.makedirs(os.path.dirname(dst_name), exist_ok=True)
+        src_stat = os.stat(src_name)
+        mode = self.sync_file(src_name, dst_name, link_mode)
+        self._manifest[rel_path] = {'size': src_stat.st_size,
+                                    'mtime': src_stat.st_mtime_ns,
+                                    'requested': link_mode,
+                                    'mode': mode}
+        return True
+
+    def replace_file(self, file_name, body):
+        """
+        Write a modified source file into the working copy. If the file is linked to
+        the original one, the link is replaced by a regular file first
+        :param file_name: Path to the file in the working copy
+        :param body: File body
+        :return: None
+        """
+        if os.path.lexists(file_name):
+            os.remove(file_name)
+        self.write_to_file(file_name, body)
+
+    def mark_rewritten(self, file_names):
+        """
+        Mark files of the working copy as modified, so they are restored on the next sync
+        :param file_names: List of paths to the files in the working copy
+        :return: None
+        """
+        for file_name in file_names:
+            rel_path = os.path.relpath(file_name, self.get_working_dir_name())
+            if rel_path in self._manifest:
+                self._manifest[rel_path]['rewritten'] = True
+        self.write_manifest()
+
+    def write_working_copy_file(self, file_name, body):
+        """
+        Write a modified source file into the working copy and mark it as modified
+        :param file_name: Path to the file in the working copy
+        :param body: File body
         :return: None
         """
-        self.print_dbg_info('Copying sources to the temporary directory: ' + src_dir_name
-                            + ' --> ' + self.get_working_dir_name())
-        shutil.copytree(src_dir_name, self.get_working_dir_name(), dirs_exist_ok=True)
+        self.replace_file(file_name, body)
+        self.mark_rewritten([file_name])
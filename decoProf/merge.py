@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import glob
+import errno
+import pstats
+import statistics
+
+from decoProf.io_manager import IOManager
+
+
+# Profilers whose output files can be combined into a single statistics file
+_PSTATS_EXTENSIONS = ('.prof', '.pstat')
+_PYINSTRUMENT_EXTENSION = '.pyisession'
+_FOLDED_EXTENSION = '.folded'
+
+
+class ProfileMerger:
+    def __init__(self, io_man=None):
+        """
+        :_io_man: Object of the IO manager
+        :_summaries: List of loaded summaries, each one extended by the "dir" key
+        """
+        self._io_man = io_man if io_man is not None else IOManager(debug=False)
+        self._summaries = []
+
+    @staticmethod
+    def process_label(summary):
+        """
+        Identify the process which produced the summary
+        :param summary: Summary dictionary
+        :return: "rank N" for MPI ranks, "host:pid" otherwise
+        """
+        if summary.get('rank') is not None:
+            return 'rank %d' % summary['rank']
+        return '%s:%d' % (summary['host'], summary['pid'])
+
+    @staticmethod
+    def read_summaries(dir_name):
+        """
+        Read the JSON summaries written by the profiler decorators into a directory
+        :param dir_name: Output directory
+        :return: List of summaries, each one extended by the "dir" key
+        """
+        summaries = []
+        for file_name in sorted(glob.glob(os.path.join(dir_name, '*.json'))):
+            try:
+                with open(file_name) as file:
+                    summary = json.load(file)
+            except (OSError, ValueError):
+                continue
+            # Skip the other JSON files, e.g. speedscope profiles
+            if not isinstance(summary, dict) or 'function' not in summary \
+                    or 'profiler' not in summary:
+                continue
+            summary['dir'] = dir_name
+            summaries.append(summary)
+        return summaries
+
+    def load_summaries(self, dir_names):
+        """
+        Read the JSON summaries written by the profiler decorators
+        :param dir_names: List of output directories
+        :return: None
+        """
+        for dir_name in dir_names:
+            if not os.path.isdir(dir_name):
+                self._io_man.print_err_info('Can\'t find the directory: ' + dir_name)
+                exit(errno.EFAULT)
+            self._summaries += self.read_summaries(dir_name)
+
+        if not self._summaries:
+            self._io_man.print_err_info('No profiler summaries were found in: '
+                                        + ', '.join(dir_names))
+            exit(errno.EFAULT)
+
+    def group_summaries(self):
+        """
+        Group the summaries by the profiled function (session) and the profiler, and
+        accumulate the dumps of every process
+        :return: Dictionary {(function, profiler): {process label: [summaries]}}
+        """
+        groups = {}
+        for summary in self._summaries:
+            processes = groups.setdefault((summary['function'], summary['profiler']), {})
+            processes.setdefault(self.process_label(summary), []).append(summary)
+        return groups
+
+    @staticmethod
+    def process_statistics(processes):
+        """
+        Compute the distribution of the profiled time over the processes
+        :param processes: Dictionary of process labels and their summaries
+        :return: Dictionary of statistics. The imbalance is the relative excess of the
+                 slowest process over the mean: max / mean - 1
+        """
+        times = {label: sum(summary['total_time'] for summary in summaries)
+                 for label, summaries in processes.items()}
+        calls = sum(summary['calls'] for summaries in processes.values() for summary in summaries)
+        mean = statistics.mean(times.values())
+        slowest = max(times, key=times.get)
+        return {'processes': len(times),
+                'calls': calls,
+                'min': min(times.values()),
+                'mean': mean,
+                'max': times[slowest],
+                'stdev': statistics.pstdev(times.values()),
+                'imbalance': times[slowest] / mean - 1.0 if mean > 0 else 0.0,
+                'slowest': slowest,
+                }
+
+    @staticmethod
+    def profile_files(processes, extensions):
+        """
+        Collect the profiler output files of all processes with the given extensions
+        :param processes: Dictionary of process labels and their summaries
+        :param extensions: Tuple of file extensions
+        :return: List of paths
+        """
+        return [os.path.join(summary['dir'], file_name)
+                for summaries in processes.values() for summary in summaries
+                for file_name in summary.get('files', [])
+                if file_name.endswith(extensions)
+                and os.path.isfile(os.path.join(summary['dir'], file_name))]
+
+    def merge_profiles(self, function, profiler, processes, output_dir):
+        """
+        Combine the profiles of all processes into a single file: pstats for cProfile
+        and yappi, a session for pyinstrument, collapsed stacks for pyinstrument and
+        the sampler
+        :param function: Name of the profiled function (session)
+        :param profiler: Name of the profiler
+        :param processes: Dictionary of process labels and their summaries
+        :param output_dir: Directory the merged profiles are written into
+        :return: List of written files
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        base_name = os.path.join(output_dir,
+                                 re.sub(r'[^\w.-]', '_', '%s.%s.merged' % (function, profiler)))
+        merged_files = []
+
+        file_names = self.profile_files(processes, _PSTATS_EXTENSIONS)
+        if file_names:
+            stats = pstats.Stats(*file_names)
+            stats.dump_stats(base_name + '.prof')
+            merged_files.append(base_name + '.prof')
+
+        file_names = self.profile_files(processes, (_PYINSTRUMENT_EXTENSION,))
+        if file_names:
+            from pyinstrument.session import Session
+
+            session = Session.load(file_names[0])
+            for file_name in file_names[1:]:
+                session = Session.combine(session, Session.load(file_name))
+            session.save(base_name + _PYINSTRUMENT_EXTENSION)
+            merged_files.append(base_name + _PYINSTRUMENT_EXTENSION)
+
+        file_names = self.profile_files(processes, (_FOLDED_EXTENSION,))
+        if file_names:
+            weights = {}
+            for file_name in file_names:
+                with open(file_name) as file:
+                    for line in file:
+                        stack, _, weight = line.rstrip('\n').rpartition(' ')
+                        if stack:
+                            weights[stack] = weights.get(stack, 0) + int(weight)
+            with open(base_name + _FOLDED_EXTENSION, 'w') as file:
+                file.writelines('%s %d\n' % item for item in weights.items())
+            merged_files.append(base_name + _FOLDED_EXTENSION)
+
+        return merged_files
+
+    def print_report(self, groups, show_processes):
+        """
+        Print the per-process statistics of every profiled function
+        :param groups: Grouped summaries, see group_summaries()
+        :param show_processes: Print the profiled time of every process as well
+        :return: None
+        """
+        row = '{:<40} {:<16} {:>6} {:>8} {:>10} {:>10} {:>10} {:>10}  {}'
+        print(row.format('Function', 'Profiler', 'Procs', 'Calls',
+                         'Min, s', 'Mean, s', 'Max, s', 'Imbalance', 'Slowest'))
+        for (function, profiler), processes in sorted(groups.items()):
+            stats = self.process_statistics(processes)
+            print(row.format(function, profiler, stats['processes'], stats['calls'],
+                             '%.4f' % stats['min'], '%.4f' % stats['mean'],
+                             '%.4f' % stats['max'], '%.1f%%' % (stats['imbalance'] * 100),
+                             stats['slowest']))
+            if show_processes:
+                for label, summaries in sorted(processes.items()):
+                    print('    {:<36} calls: {:>8}, time: {:.4f} s'.format(
+                        label, sum(summary['calls'] for summary in summaries),
+                        sum(summary['total_time'] for summary in summaries)))
+
+    def run(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Load and group the summaries of all processes
+        3) Print the aggregated report and merge the profiles
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_merge_cli(argv)
+        self.load_summaries(args.dirs)
+        groups = self.group_summaries()
+        self.print_report(groups, args.processes)
+
+        if args.o is not None:
+            for (function, profiler), processes in sorted(groups.items()):
+                for file_name in self.merge_profiles(function, profiler, processes, args.o):
+                    self._io_man.print_msg_with_header('Merged profile:', file_name)
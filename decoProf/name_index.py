@@ -0,0 +1,70 @@
+import ast
+
+
+# Nodes which define a new scope and a new component of the qualified name
+DEFINITION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+# Nodes which might contain definitions without being definitions themselves,
+# e.g. functions defined inside "if" or "try" blocks
+_CONTAINER_NODES = (ast.stmt, ast.excepthandler) + ((ast.match_case,) if hasattr(ast, 'match_case') else ())
+
+
+class QualifiedNameIndex:
+    def __init__(self, src_tree):
+        """
+        Index mapping qualified names of all functions and classes of a module to their
+        AST nodes. Names of nested definitions are separated by dots, e.g. "foo",
+        "Vector.add", "Outer.Inner.method" or "foo.bar" for an inner function. The index
+        is built in a single pass over the AST
+        :param src_tree: AST of the module
+        """
+        self._nodes = {}
+
+        stack = [(node, '') for node in reversed(src_tree.body)]
+        while stack:
+            node, prefix = stack.pop()
+            if isinstance(node, DEFINITION_NODES):
+                name = prefix + node.name
+                self._nodes.setdefault(name, []).append(node)
+                prefix = name + '.'
+            children = [child for child in ast.iter_child_nodes(node)
+                        if isinstance(child, _CONTAINER_NODES)]
+            stack.extend((child, prefix) for child in reversed(children))
+
+    def __contains__(self, qualified_name):
+        return qualified_name in self._nodes
+
+    def names(self):
+        """
+        :return: List of all qualified names in the order of definition
+        """
+        return list(self._nodes)
+
+    def find(self, qualified_name):
+        """
+        Find the definitions with the given qualified name. There might be several of them
+        if the name is redefined, e.g. in different branches of an "if" statement
+        :param qualified_name: Qualified name
+        :return: List of AST nodes
+        """
+        return self._nodes.get(qualified_name, [])
+
+    def functions(self):
+        """
+        Iterate over all function definitions
+        :return: Generator of (qualified name, node) tuples
+        """
+        for name, nodes in self._nodes.items():
+            for node in nodes:
+                if isinstance(node, FUNCTION_NODES):
+                    yield name, node
+
+    def suggest(self, qualified_name):
+        """
+        Find qualified names of the definitions with the same base name as the given one
+        :param qualified_name: Qualified name which wasn't found
+        :return: List of similar qualified names
+        """
+        base_name = qualified_name.split('.')[-1]
+        return [name for name in self._nodes if name.split('.')[-1] == base_name]
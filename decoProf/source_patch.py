@@ -0,0 +1,118 @@
+import io
+import tokenize
+
+
+class SourcePatcher:
+    def __init__(self, source):
+        """
+        Edits of a source file addressed by the line numbers of the original source.
+        The edits are applied in a single pass over the lines, so the comments and the
+        formatting are preserved and the inserted lines can be mapped back to the
+        original ones
+        :param source: Source code
+        :_lines: Lines of the source including the line endings
+        :_insertions: Dictionary of line numbers and the lists of (text, range) tuples
+                      inserted before the line. The range is the one opened by the line
+        :_ranges: List of (first line, last line, indentation unit) tuples of the ranges
+                  indented by one more level
+        """
+        self._source = source
+        self._lines = source.splitlines(keepends=True)
+        self._insertions = {}
+        self._ranges = []
+
+    def indentation(self, line_no, col_offset):
+        """
+        Get the indentation of a statement. Throw ValueError if the statement doesn't
+        start the line, e.g. it follows a semicolon or the colon of a compound statement
+        :param line_no: Line number of the statement
+        :param col_offset: Column of the statement (UTF-8 bytes, as reported by ast)
+        :return: Whitespace preceding the statement
+        """
+        prefix = self._lines[line_no - 1].encode()[:col_offset].decode()
+        if prefix.strip():
+            raise ValueError('the statement at line %d doesn\'t start the line' % line_no)
+        return prefix
+
+    def insert(self, line_no, text, opened_range=None, first=False):
+        """
+        Insert a line before a line of the original source
+        :param line_no: Line number in the original source
+        :param text: Line including the indentation and the line ending
+        :param opened_range: Range (see indent) opened by the line, e.g. by "with", it is
+                             not indented by this range
+        :param first: Insert the line before the lines inserted before the same line
+        :return: None
+        """
+        insertions = self._insertions.setdefault(line_no, [])
+        insertions.insert(0 if first else len(insertions), (text, opened_range))
+
+    def indent(self, first_line, last_line, unit):
+        """
+        Indent the lines by one more level. Lines inside multi-line strings are kept
+        :param first_line: First line of the range
+        :param last_line: Last line of the range
+        :param unit: Indentation added to every line, e.g. four spaces
+        :return: Index of the range
+        """
+        self._ranges.append((first_line, last_line, unit))
+        return len(self._ranges) - 1
+
+    def string_lines(self):
+        """
+        :return: Set of the lines starting inside a multi-line token, i.e. a string
+        """
+        lines = set()
+        for token in tokenize.generate_tokens(io.StringIO(self._source).readline):
+            lines.update(range(token.start[0] + 1, token.end[0] + 1))
+        return lines
+
+    def is_outer(self, index, other):
+        """
+        :param index: Index of a range
+        :param other: Index of another range
+        :return: True if the range contains the other one. Of two equal ranges, the one
+                 added later contains the other one (it wraps the statement wrapped before)
+        """
+        first, last, _ = self._ranges[index]
+        other_first, other_last, _ = self._ranges[other]
+        if (first, last) == (other_first, other_last):
+            return index > other
+        return first <= other_first and other_last <= last
+
+    def extra_indentation(self, line_no, opened_range=None):
+        """
+        :param line_no: Line number in the original source
+        :param opened_range: Range opened by the inserted line, None for the other lines
+        :return: Indentation added to the line by the ranges containing it
+        """
+        if opened_range is not None:
+            return ''.join(unit for index, (_, _, unit) in enumerate(self._ranges)
+                           if index != opened_range and self.is_outer(index, opened_range))
+        return ''.join(unit for first, last, unit in self._ranges if first <= line_no <= last)
+
+    def apply(self):
+        """
+        Apply the edits
+        :return: Tuple of the patched source and the sorted list of the line numbers of
+                 the inserted lines in the patched source
+        """
+        string_lines = self.string_lines() if self._ranges else set()
+        output = []
+        inserted = []
+        for line_no, line in enumerate(self._lines, 1):
+            # Lines opening ranges go first, the outer ones before the inner ones
+            insertions = self._insertions.get(line_no, [])
+            openers = [item for item in insertions if item[1] is not None]
+            for position in range(1, len(openers)):
+                for previous in range(position, 0, -1):
+                    if self.is_outer(openers[previous][1], openers[previous - 1][1]):
+                        openers[previous - 1], openers[previous] = openers[previous], openers[previous - 1]
+            for text, opened_range in openers + [item for item in insertions if item[1] is None]:
+                output.append(self.extra_indentation(line_no, opened_range) + text)
+                inserted.append(len(output))
+            if line.strip() and line_no not in string_lines:
+                line = self.extra_indentation(line_no) + line
+            output.append(line)
+
+        return ''.join(output), inserted
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import errno
+import fnmatch
+import sqlite3
+import statistics
+import subprocess
+
+from decoProf.io_manager import IOManager
+from decoProf.merge import ProfileMerger
+
+
+# Exit code of "compare" if a regression was found (errors exit with errno codes)
+REGRESSION_EXIT_CODE = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    label TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_revision ON runs (project, revision);
+CREATE TABLE IF NOT EXISTS measurements (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    function TEXT NOT NULL,
+    profiler TEXT NOT NULL,
+    host TEXT,
+    pid INTEGER,
+    rank INTEGER,
+    calls INTEGER NOT NULL,
+    total_time REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measurements_run ON measurements (run_id);
+'''
+
+
+class ProfileStore:
+    def __init__(self, io_man=None):
+        """
+        Local SQLite store of the summaries written by the profiler decorators (-o).
+        Every ingestion is a run of a project at a git revision
+        :_io_man: Object of the IO manager
+        """
+        self._io_man = io_man if io_man is not None else IOManager(debug=False)
+
+    def connect(self, file_name):
+        """
+        Open the store and create the tables if needed
+        :param file_name: Path to the SQLite file (None - the default one)
+        :return: Connection object
+        """
+        file_name = file_name or self._io_man.get_store_file_name()
+        try:
+            connection = sqlite3.connect(file_name)
+            connection.executescript(_SCHEMA)
+        except sqlite3.Error as error:
+            self._io_man.print_err_info('Can\'t open the profile store ' + file_name + ': '
+                                        + str(error))
+            exit(errno.EFAULT)
+        return connection
+
+    @staticmethod
+    def git(*args):
+        """
+        :param args: Arguments of git
+        :return: Output of git without the trailing newline, None if git failed
+        """
+        try:
+            process = subprocess.run(('git',) + args, capture_output=True, text=True)
+        except FileNotFoundError:
+            return None
+        return process.stdout.strip() if process.returncode == 0 else None
+
+    def current_project(self):
+        """
+        :return: Name of the git repository of the working directory, or of the directory
+        """
+        top_level = self.git('rev-parse', '--show-toplevel')
+        return os.path.basename(top_level or os.path.abspath(os.getcwd()))
+
+    def current_revision(self):
+        """
+        :return: Abbreviated git revision of the working directory with the "-dirty" suffix
+                 if there are uncommitted changes, None outside of a repository
+        """
+        revision = self.git('rev-parse', '--short=12', 'HEAD')
+        if revision is not None and self.git('status', '--porcelain', '--untracked-files=no'):
+            revision += '-dirty'
+        return revision
+
+    def ingest(self, connection, project, revision, label, summaries):
+        """
+        Store the summaries as a new run
+        :param connection: Connection object
+        :param project: Project name
+        :param revision: Revision of the project
+        :param label: Optional description of the run
+        :param summaries: List of summaries
+        :return: ID of the run
+        """
+        with connection:
+            cursor = connection.execute('INSERT INTO runs (project, revision, label, created) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (project, revision, label, time.time()))
+            run_id = cursor.lastrowid
+            connection.executemany('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [(run_id, summary['function'], summary['profiler'],
+                                     summary.get('host'), summary.get('pid'), summary.get('rank'),
+                                     summary.get('calls', 0), summary.get('total_time', 0.0),
+                                     json.dumps(summary)) for summary in summaries])
+        return run_id
+
+    def find_revision(self, connection, project, revision):
+        """
+        Find the stored revision by its prefix, e.g. an abbreviated git hash
+        :param connection: Connection object
+        :param project: Project name
+        :param revision: Revision or its prefix
+        :return: Stored revision
+        """
+        revisions = [row[0] for row in connection.execute(
+            'SELECT DISTINCT revision FROM runs WHERE project = ? AND substr(revision, 1, ?) = ?',
+            (project, len(revision), revision))]
+        if revision in revisions:
+            return revision
+        if len(revisions) != 1:
+            self._io_man.print_err_info('%s revision "%s" of the project "%s" in the store'
+                                        % ('Ambiguous' if revisions else 'No runs of the',
+                                           revision, project))
+            exit(errno.EFAULT)
+        return revisions[0]
+
+    def latest_revision(self, connection, project, excluded):
+        """
+        :param connection: Connection object
+        :param project: Project name
+        :param excluded: Revision which should not be returned
+        :return: Revision of the most recent run, None if there is no such run
+        """
+        row = connection.execute('SELECT revision FROM runs WHERE project = ? AND revision != ? '
+                                 'ORDER BY created DESC LIMIT 1', (project, excluded)).fetchone()
+        return row[0] if row is not None else None
+
+    def time_per_call(self, connection, project, revision, functions, profiler):
+        """
+        Collect the time per call of every function in every run of the revision. The
+        processes of a run are summed up
+        :param connection: Connection object
+        :param project: Project name
+        :param revision: Revision
+        :param functions: List of glob patterns of function names (empty - all functions)
+        :param profiler: Profiler name (None - all profilers)
+        :return: Dictionary {(function, profiler): [time per call of every run]}
+        """
+        rows = connection.execute(
+            'SELECT m.function, m.profiler, SUM(m.total_time), SUM(m.calls) '
+            'FROM measurements AS m JOIN runs AS r ON m.run_id = r.id '
+            'WHERE r.project = ? AND r.revision = ? '
+            'GROUP BY m.run_id, m.function, m.profiler', (project, revision))
+
+        samples = {}
+        for function, profiler_name, total_time, calls in rows:
+            if not calls or profiler is not None and profiler_name != profiler:
+                continue
+            if functions and not any(fnmatch.fnmatchcase(function, pattern) for pattern in functions):
+                continue
+            samples.setdefault((function, profiler_name), []).append(total_time / calls)
+        return samples
+
+    @staticmethod
+    def compare_samples(base, new, threshold, sigma):
+        """
+        Classify the change of the time per call. A change is significant if the relative
+        difference of the means exceeds the threshold and the absolute difference exceeds
+        "sigma" standard errors of the difference (runs of the same revision give an
+        estimate of the noise; with a single run per revision only the threshold applies)
+        :param base: List of times per call of the base revision
+        :param new: List of times per call of the new revision
+        :param threshold: Relative threshold, e.g. 0.05
+        :param sigma: Number of standard errors
+        :return: Dictionary with the means, the relative delta and the status
+        """
+        base_mean = statistics.mean(base)
+        new_mean = statistics.mean(new)
+        noise = 0.0
+        for samples in (base, new):
+            if len(samples) > 1:
+                noise += statistics.variance(samples) / len(samples)
+        delta = new_mean / base_mean - 1.0 if base_mean > 0 else 0.0
+
+        status = 'ok'
+        if abs(delta) > threshold and abs(new_mean - base_mean) > sigma * noise ** 0.5:
+            status = 'regression' if delta > 0 else 'improvement'
+        return {'base': base_mean, 'new': new_mean, 'delta': delta, 'status': status}
+
+    def print_comparison(self, results, show_all):
+        """
+        :param results: List of (function, profiler, base runs, new runs, comparison) tuples
+        :param show_all: Print unchanged functions as well
+        :return: None
+        """
+        row = '{:<40} {:<16} {:>12} {:>12} {:>9} {:>7}  {}'
+        print(row.format('Function', 'Profiler', 'Base, us', 'New, us', 'Delta', 'Runs', 'Status'))
+        for function, profiler, base_runs, new_runs, comparison in results:
+            if not show_all and comparison['status'] == 'ok':
+                continue
+            print(row.format(function, profiler,
+                             '%.3f' % (comparison['base'] * 1e6) if base_runs else '-',
+                             '%.3f' % (comparison['new'] * 1e6) if new_runs else '-',
+                             '%+.1f%%' % (comparison['delta'] * 100) if base_runs and new_runs else '-',
+                             '%d/%d' % (base_runs, new_runs), comparison['status']))
+
+    def run_ingest(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Read the summaries of the output directories
+        3) Store them as a run of the project at the revision
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_ingest_cli(argv)
+        project = args.project or self.current_project()
+        revision = args.revision or self.current_revision()
+        if revision is None:
+            self._io_man.print_err_info('Can\'t detect the git revision, use --revision')
+            exit(errno.EFAULT)
+
+        summaries = []
+        for dir_name in args.dirs:
+            if not os.path.isdir(dir_name):
+                self._io_man.print_err_info('Can\'t find the directory: ' + dir_name)
+                exit(errno.EFAULT)
+            summaries += ProfileMerger.read_summaries(dir_name)
+        if not summaries:
+            self._io_man.print_err_info('No profiler summaries were found in: '
+                                        + ', '.join(args.dirs))
+            exit(errno.EFAULT)
+
+        connection = self.connect(args.db)
+        run_id = self.ingest(connection, project, revision, args.label, summaries)
+        connection.close()
+        self._io_man.print_msg_with_header('', 'Run %d: %d summaries of %s at %s'
+                                           % (run_id, len(summaries), project, revision))
+
+    def run_compare(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Compare the time per call of the functions in two revisions
+        3) Print the deltas and exit with REGRESSION_EXIT_CODE if a function got slower
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_compare_cli(argv)
+        project = args.project or self.current_project()
+        connection = self.connect(args.db)
+        base_revision = self.find_revision(connection, project, args.base)
+        if args.new is not None:
+            new_revision = self.find_revision(connection, project, args.new)
+        else:
+            new_revision = self.latest_revision(connection, project, base_revision)
+            if new_revision is None:
+                self._io_man.print_err_info('No runs of the project "%s" to compare with %s'
+                                            % (project, base_revision))
+                exit(errno.EFAULT)
+
+        functions = [name.strip() for name in args.n.split(',')] if args.n else []
+        base = self.time_per_call(connection, project, base_revision, functions, args.t)
+        new = self.time_per_call(connection, project, new_revision, functions, args.t)
+        connection.close()
+
+        results = []
+        for key in sorted(set(base) | set(new)):
+            if key in base and key in new:
+                comparison = self.compare_samples(base[key], new[key], args.threshold, args.sigma)
+            else:
+                samples = base.get(key) or new.get(key)
+                comparison = {'base': statistics.mean(samples), 'new': statistics.mean(samples),
+                              'delta': 0.0, 'status': 'removed' if key in base else 'new'}
+            results.append(key + (len(base.get(key, [])), len(new.get(key, [])), comparison))
+        results.sort(key=lambda result: result[4]['delta'], reverse=True)
+
+        self._io_man.print_msg_with_header('', '%s: %s -> %s' % (project, base_revision, new_revision))
+        self.print_comparison(results, args.all)
+        regressions = [result for result in results if result[4]['status'] == 'regression']
+        if regressions:
+            self._io_man.print_err_info('%d functions got slower by more than %.1f%%'
+                                        % (len(regressions), args.threshold * 100))
+            exit(REGRESSION_EXIT_CODE)
@@ -0,0 +1,149 @@
+import os
+import time
+import subprocess
+
+from decoProf.io_manager import IOManager
+from decoProf.core import Core
+
+
+class SourceWatcher:
+    def __init__(self, io_man=None):
+        """
+        Keep the working copy of a project in sync with the project and re-inject the
+        decorators into the changed files only
+        :_io_man: Object of the IO manager
+        :_core: Object of the Core, it keeps the configuration and the call graph
+        :_targets: Targets given by the user, before the callees are added
+        :_files: Dictionary of the project files and their (mtime, size) tuples
+        :_jobs: Dictionary of files and the function names injected into them
+        :_results: Dictionary of files and the results of the injection (see Core.modify_file)
+        """
+        self._io_man = io_man if io_man is not None else IOManager(debug=False)
+        self._core = Core(self._io_man)
+        self._targets = []
+        self._files = {}
+        self._jobs = {}
+        self._results = {}
+
+    def inject(self, jobs):
+        """
+        Inject the decorators into the working copies of the files. A file which can't be
+        parsed, e.g. because it is being edited, is left undecorated
+        :param jobs: Dictionary of files and the lists of function names
+        :return: List of the files which were parsed
+        """
+        try:
+            results = self._core.inject_into_files(jobs)
+        except SyntaxError:
+            results = []
+            for name, function_names in jobs.items():
+                try:
+                    results += self._core.inject_into_files({name: function_names})
+                except SyntaxError as err:
+                    self._io_man.print_err_info('Can\'t parse %s: %s' % (name, err))
+
+        for result in results:
+            self._results[result[0]] = result
+        return [result[0] for result in results]
+
+    def start(self, args):
+        """
+        Prepare the working copy and inject the decorators, like the injector does
+        :param args: Object of parsed arguments
+        :return: None
+        """
+        self._core.configure(args)
+        self._targets = list(self._core.function_name)
+        self._core.prepare_fs()
+        if self._core.use_call_graph:
+            self._core.analyse_call_graph()
+
+        self._files = self._io_man.scan_project(self._core.project_name, self._core.ignore_patterns)
+        self._jobs = self._core.assemble_jobs()
+        self.inject(self._jobs)
+        self._core.report_injection(list(self._results.values()))
+
+    def update(self, changed):
+        """
+        Sync the changed files into the working copy and re-inject the decorators into
+        them. The call graph is updated if the callees of the targets are profiled, the
+        files whose targets changed are re-injected as well
+        :param changed: List of the changed, added or removed files
+        :return: List of the re-parsed files
+        """
+        project_name = self._core.project_name
+        for name in changed:
+            self._io_man.sync_project_file(project_name, name, self._core.link_mode)
+            self._results.pop(name, None)
+
+        if self._core.callee_depth and self._core.call_graph is not None \
+                and any(name.endswith('.py') for name in changed):
+            self._core.function_name = list(self._targets)
+            self._core.analyse_call_graph()
+
+        jobs = self._core.assemble_jobs()
+        for name in set(self._jobs) - set(changed):
+            # Restore the original file if the decorators have to be removed or re-injected
+            if jobs.get(name) != self._jobs[name]:
+                self._io_man.sync_project_file(project_name, name, self._core.link_mode)
+                self._results.pop(name, None)
+        self._jobs = jobs
+
+        injected = self.inject({name: function_names for name, function_names in jobs.items()
+                                if name not in self._results})
+        self._core.report_injection(list(self._results.values()))
+        return injected
+
+    def watch(self, interval, command):
+        """
+        Poll the project for changes until interrupted
+        :param interval: Time between two checks in seconds
+        :param command: Shell command executed in the working directory after every update
+        :return: None
+        """
+        while True:
+            time.sleep(interval)
+            files = self._io_man.scan_project(self._core.project_name, self._core.ignore_patterns)
+            changed = sorted(name for name in set(files) | set(self._files)
+                             if files.get(name) != self._files.get(name))
+            self._files = files
+            if not changed:
+                continue
+
+            start = time.perf_counter()
+            injected = self.update(changed)
+            self._io_man.print_msg_with_header('', '%d files changed, re-parsed and re-injected: '
+                                                   '%s (%.0f ms)'
+                                               % (len(changed), ', '.join(injected) or '-',
+                                                  (time.perf_counter() - start) * 1e3))
+            if command:
+                self.execute(command)
+
+    def execute(self, command):
+        """
+        :param command: Shell command executed in the working directory
+        :return: None
+        """
+        process = subprocess.run(command, shell=True, cwd=self._io_man.get_working_dir_name())
+        if process.returncode != 0:
+            self._io_man.print_err_info('The command exited with code %d' % process.returncode)
+
+    def run(self, argv):
+        """
+        1) Analyze CLI arguments
+        2) Prepare the working copy and inject the decorators
+        3) Update the working copy whenever the project changes
+        :param argv: List of CLI arguments following the command name
+        :return: None
+        """
+        args = self._io_man.parse_watch_cli(self._core.get_profiler_types(), argv)
+        self.start(args)
+        self._io_man.print_msg_with_header('', 'Watching %s, the working copy is %s (Ctrl+C to stop)'
+                                           % (self._core.project_name,
+                                              os.path.abspath(self._io_man.get_working_dir_name())))
+        if args.exec:
+            self.execute(args.exec)
+        try:
+            self.watch(args.interval, args.exec)
+        except KeyboardInterrupt:
+            pass